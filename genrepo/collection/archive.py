@@ -0,0 +1,417 @@
+'''Streaming zip archives of entire collections.
+
+:func:`collection_archive` generates a zip file containing the master
+file of every member of a collection, plus a ``manifest.csv`` with the
+Dublin Core metadata of each member, as it is sent to the client.
+Members are listed one page at a time as the archive is generated,
+only a few chunks of content are held in memory at a time (see
+:class:`ZipStream`), and the manifest is written to a temporary file
+that is only kept in memory while it is small, so the size of a
+collection is limited only by the zip format.
+
+To keep the response busy while each master is read from Fedora, the
+next few members are loaded in background threads (see
+:func:`prefetch`), each reading ahead a limited number of chunks.  The
+manifest uses the same format as :mod:`genrepo.file.manifest`, so an
+extracted archive can be ingested again with the ``ingest_manifest``
+command.
+'''
+
+from collections import deque
+import csv
+from datetime import datetime
+import logging
+import mimetypes
+import os
+import Queue
+import struct
+from tempfile import SpooledTemporaryFile
+import threading
+import zlib
+
+from django.conf import settings
+from eulcore.fedora.util import PermissionDenied
+
+from genrepo.collection.models import DC_FIELDS
+from genrepo.file.download import CHUNK_SIZE, DatastreamCache, DatastreamStream, \
+     LocalFileStream
+from genrepo.file.manifest import MULTIVALUE_SEPARATOR
+from genrepo.file.models import FileObject
+from genrepo.repository import release_connections
+
+logger = logging.getLogger(__name__)
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+ZIP64_LIMIT = 0xffffffff
+'sizes, offsets, and counts that must be recorded in zip64 fields'
+
+PAGE_SIZE = 1000
+'number of collection members listed per query'
+
+SPOOL_MAX_SIZE = 1024 * 1024
+'''size up to which the manifest and list of errors are kept in memory,
+before being written to a temporary file'''
+
+# general purpose flags: sizes and crc follow the data (bit 3), and file
+# names are utf-8 (bit 11)
+_FLAGS = 0x08 | 0x800
+# unix, for file permissions
+_CREATE_SYSTEM = 3
+
+
+def _may_need_zip64(size, compress):
+    # whether an entry of the expected size (None if unknown) may need
+    # zip64 sizes, allowing for deflate expanding incompressible data
+    # (see zlib's deflateBound)
+    if size is None:
+        return True
+    if compress:
+        size += (size >> 12) + (size >> 14) + (size >> 25) + 13
+    return size >= ZIP64_LIMIT
+
+def _dos_datetime(date):
+    # zip (ms-dos) time and date for a datetime
+    if date is None or date.year < 1980:
+        date = datetime(1980, 1, 1)
+    return (date.hour << 11 | date.minute << 5 | date.second // 2,
+            (date.year - 1980) << 9 | date.month << 5 | date.day)
+
+
+class ZipStream(object):
+    '''Iterable content of a zip archive, generated as it is read.
+    The content of each file is written as it is received, followed by
+    its size and checksum (in a data descriptor), so the files do not
+    need to be read in advance or kept in memory, and the output does
+    not need to be seekable.  Zip64 extensions are used where sizes or
+    offsets require them; since the local header of each file is
+    written before its content, the expected size of each file is used
+    to decide whether it needs zip64 sizes.
+
+    :param entries: iterable of ``(name, date, content, size)`` tuples,
+        where content is an iterable of strings and size is the expected
+        size of the content in bytes (None if unknown); if the entries
+        have a ``close`` method, it is called when the stream is closed
+    :param compress: if True, deflate file content; otherwise files are
+        stored as is (most master files are already compressed)
+    '''
+    def __init__(self, entries, compress=False):
+        self.entries = entries
+        self.compress = compress
+        self.size = 0
+
+    def _out(self, data):
+        # all output goes through here, to keep track of offsets
+        self.size += len(data)
+        return data
+
+    def __iter__(self):
+        try:
+            directory = []
+            for name, date, content, size in self.entries:
+                for data in self._entry(name, date, content, size, directory):
+                    yield data
+            for data in self._central_directory(directory):
+                yield data
+        finally:
+            self.close()
+
+    def _entry(self, name, date, content, expected_size, directory):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        offset = self.size
+        method = ZIP_DEFLATED if self.compress else ZIP_STORED
+        dostime, dosdate = _dos_datetime(date)
+        # sizes follow the data; a zip64 extra field in the local header
+        # tells readers to expect zip64 sizes in the data descriptor
+        zip64 = _may_need_zip64(expected_size, self.compress)
+        if zip64:
+            version, header_size = 45, 0xffffffff
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+        else:
+            version, header_size, extra = 20, 0, ''
+        yield self._out(struct.pack('<4sHHHHHLLLHH', 'PK\x03\x04', version, _FLAGS, method,
+                                    dostime, dosdate, 0, header_size, header_size,
+                                    len(name), len(extra)) + name + extra)
+
+        compressor = None
+        if self.compress:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        crc = size = compressed = 0
+        for data in content:
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                compressed += len(data)
+                yield self._out(data)
+        if compressor is not None:
+            data = compressor.flush()
+            compressed += len(data)
+            yield self._out(data)
+
+        crc &= 0xffffffff
+        if zip64 or size >= ZIP64_LIMIT or compressed >= ZIP64_LIMIT:
+            if not zip64:
+                logger.warning('%s is larger than expected; zip64 sizes may not be read correctly' \
+                               % name)
+            yield self._out(struct.pack('<4sLQQ', 'PK\x07\x08', crc, compressed, size))
+        else:
+            yield self._out(struct.pack('<4sLLL', 'PK\x07\x08', crc, compressed, size))
+        directory.append((name, method, dostime, dosdate, crc, compressed, size, offset))
+
+    def _central_directory(self, directory):
+        start = self.size
+        for name, method, dostime, dosdate, crc, compressed, size, offset in directory:
+            # values too large for the header are recorded in a zip64 extra field
+            zip64 = [value for value in (size, compressed, offset) if value >= ZIP64_LIMIT]
+            extra = ''
+            version = 20
+            if zip64:
+                extra = struct.pack('<HH%dQ' % len(zip64), 1, 8 * len(zip64), *zip64)
+                version = 45
+            size, compressed, offset = [min(value, ZIP64_LIMIT)
+                                        for value in (size, compressed, offset)]
+            yield self._out(struct.pack('<4sHHHHHHLLLHHHHHLL', 'PK\x01\x02',
+                                        _CREATE_SYSTEM << 8 | version, version, _FLAGS,
+                                        method, dostime, dosdate, crc, compressed, size,
+                                        len(name), len(extra), 0, 0, 0, 0100644 << 16,
+                                        offset) + name + extra)
+
+        directory_size = self.size - start
+        count = len(directory)
+        if count >= 0xffff or directory_size >= ZIP64_LIMIT or start >= ZIP64_LIMIT:
+            end64 = self.size
+            yield self._out(struct.pack('<4sQHHLLQQQQ', 'PK\x06\x06', 44,
+                                        _CREATE_SYSTEM << 8 | 45, 45, 0, 0, count, count,
+                                        directory_size, start))
+            yield self._out(struct.pack('<4sLQL', 'PK\x06\x07', 0, end64, 1))
+        yield self._out(struct.pack('<4sHHHHLLH', 'PK\x05\x06', 0, 0,
+                                    min(count, 0xffff), min(count, 0xffff),
+                                    min(directory_size, ZIP64_LIMIT), min(start, ZIP64_LIMIT), 0))
+
+    def close(self):
+        close = getattr(self.entries, 'close', None)
+        if close is not None:
+            close()
+
+
+class _Prefetch(threading.Thread):
+    # loads a single item and reads its content in a background thread,
+    # buffering at most buffer_size chunks until they are consumed
+
+    def __init__(self, load, item, buffer_size, stopped):
+        threading.Thread.__init__(self, name='prefetch')
+        self.setDaemon(True)
+        self.load = load
+        self.item = item
+        self.stopped = stopped
+        self.result = self.error = None
+        self.loaded = threading.Event()
+        self.queue = Queue.Queue(buffer_size)
+
+    def run(self):
+        try:
+            self._run()
+        finally:
+            # prefetch threads don't finish a request, so return their
+            # Fedora connections explicitly
+            release_connections()
+
+    def _run(self):
+        try:
+            self.result, content = self.load(self.item)
+        except Exception as err:
+            self.error = err
+            self.loaded.set()
+            return
+        self.loaded.set()
+        try:
+            for data in content:
+                if not self._put(('data', data)):
+                    break
+            else:
+                self._put(('end', None))
+        except Exception as err:
+            self._put(('error', err))
+        finally:
+            content.close()
+
+    def _put(self, item):
+        # wait for room in the buffer, unless the consumer has gone away
+        while not self.stopped.isSet():
+            try:
+                self.queue.put(item, True, 1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def content(self):
+        while True:
+            kind, value = self.queue.get()
+            if kind == 'data':
+                yield value
+            elif kind == 'end':
+                return
+            else:
+                raise value
+
+
+def prefetch(items, load, count=3, buffer_size=4):
+    '''Load a series of items with content (e.g., datastreams), each in
+    a background thread, up to ``count`` items ahead of the item being
+    consumed.  Items are returned in order.
+
+    :param items: iterable of items to load
+    :param load: callable that takes an item and returns a tuple of a
+        result and an iterable of content chunks with a ``close`` method
+    :param count: number of items to load ahead
+    :param buffer_size: number of content chunks to read ahead for each
+        item; memory used is at most ``count * buffer_size`` chunks
+    :returns: generator of ``(item, result, error, content)`` tuples;
+        if the item could not be loaded, result and content are None
+        and error is the exception raised.  Content must be read before
+        the next item is requested.  Closing the generator stops any
+        background threads.
+    '''
+    items = iter(items)
+    stopped = threading.Event()
+    pending = deque()
+
+    def fill():
+        while len(pending) < count:
+            try:
+                item = items.next()
+            except StopIteration:
+                return
+            task = _Prefetch(load, item, buffer_size, stopped)
+            task.start()
+            pending.append(task)
+
+    try:
+        fill()
+        while pending:
+            task = pending.popleft()
+            fill()
+            task.loaded.wait()
+            if task.error is not None:
+                yield task.item, None, task.error, None
+            else:
+                yield task.item, task.result, None, task.content()
+    finally:
+        stopped.set()
+
+
+def member_filename(obj, profile):
+    '''File name for the master file of a collection member within a
+    collection archive: the pid (with ``:`` replaced by ``_``), and an
+    extension taken from the object label (usually the original file
+    name) or guessed from the mimetype.'''
+    extension = os.path.splitext(obj.label or '')[1]
+    if not extension or len(extension) > 10 or ' ' in extension:
+        extension = mimetypes.guess_extension(profile.mimetype or '') or ''
+    return obj.pid.replace(':', '_') + extension
+
+
+def _load_member(repo, cache, info):
+    # load a collection member's master datastream profile and Dublin Core,
+    # and open its content (from the local master cache, if available)
+    obj = repo.get_object(info.pid, type=FileObject)
+    profile = obj.getDatastreamProfile(FileObject.master.id)
+    dc = obj.dc.content
+    cached = cache.get(obj.pid, FileObject.master.id, profile.version_id, profile.size)
+    if cached is not None:
+        content = LocalFileStream(cached)
+    else:
+        content = DatastreamStream(repo, obj.pid, FileObject.master.id)
+    return (obj, profile, dc), content
+
+def _spooled_content(spool):
+    # content of a spooled temporary file in chunks, from the beginning;
+    # the file is closed when all content has been read
+    try:
+        spool.seek(0)
+        while True:
+            data = spool.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+    finally:
+        spool.close()
+
+def _archive_entries(repo, collection, members, prefetch_count):
+    # zip entries for all collection members, followed by the manifest
+    cache = DatastreamCache()
+    manifest = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    writer = csv.writer(manifest)
+    writer.writerow(('path', 'collection') + DC_FIELDS)
+    errors = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+    loaded = prefetch(members, lambda info: _load_member(repo, cache, info),
+                      count=prefetch_count)
+    try:
+        for info, result, error, content in loaded:
+            if error is not None:
+                logger.warning('Could not add %s to archive of %s: %s' % \
+                               (info.pid, collection.pid, error))
+                # members the current user may not read are left out
+                # silently, so the archive does not reveal them
+                if not isinstance(error, PermissionDenied):
+                    errors.write((u'%s: %s\n' % (info.pid, unicode(error) or repr(error)))
+                                 .encode('utf-8'))
+                continue
+            obj, profile, dc = result
+            name = member_filename(obj, profile)
+            yield name, profile.created or info.modified, content, profile.size or None
+            writer.writerow([name, collection.pid] +
+                            [MULTIVALUE_SEPARATOR.join(getattr(dc, '%s_list' % field))
+                             .encode('utf-8') for field in DC_FIELDS])
+    except:
+        manifest.close()
+        errors.close()
+        raise
+    finally:
+        loaded.close()
+
+    now = datetime.now()
+    yield 'manifest.csv', now, _spooled_content(manifest), manifest.tell()
+    if errors.tell():
+        yield 'errors.txt', now, _spooled_content(errors), errors.tell()
+    else:
+        errors.close()
+
+
+def collection_archive(repo, collection, prefetch_count=None, compress=None,
+                       page_size=None):
+    '''Generate a zip archive of all members of a collection, with the
+    master file of each member and a ``manifest.csv`` of member
+    metadata.  Members that are not accessible with the current
+    credentials are left out; other members that can't be read (e.g.,
+    because of a repository error) are left out and listed in
+    ``errors.txt``.
+
+    Members are listed (one page at a time) and their content retrieved
+    only as the archive is read.
+
+    :param repo: :class:`~genrepo.repository.Repository` used to read
+        member objects; shared by the prefetch threads, so it should not
+        keep an identity map
+    :param collection: :class:`~genrepo.collection.models.CollectionObject`
+    :param prefetch_count: number of members to load ahead; defaults to
+        the configured ``COLLECTION_DOWNLOAD_PREFETCH``
+    :param compress: whether to deflate member content; defaults to the
+        configured ``COLLECTION_DOWNLOAD_COMPRESS``
+    :param page_size: number of members listed per query; defaults to
+        :data:`PAGE_SIZE`
+    :returns: :class:`ZipStream`
+    '''
+    if prefetch_count is None:
+        prefetch_count = getattr(settings, 'COLLECTION_DOWNLOAD_PREFETCH', 3)
+    if compress is None:
+        compress = getattr(settings, 'COLLECTION_DOWNLOAD_COMPRESS', False)
+    members = collection.members.iterate(page_size or PAGE_SIZE)
+    return ZipStream(_archive_entries(repo, collection, members, max(prefetch_count, 1)),
+                     compress=compress)
@@ -0,0 +1,132 @@
+'''Streaming export of the Dublin Core metadata of every member of a
+collection, as CSV or JSON Lines; see :func:`metadata_export` and the
+``export_metadata`` management command.
+
+Members are listed one page at a time (see
+:meth:`~genrepo.collection.models.ObjectInfoList.iterate`), and their
+Dublin Core is retrieved by a bounded pool of worker threads (see
+:func:`~genrepo.file.bulk.pool_imap`).  Each row is generated as soon
+as it is available, in member order, so the memory used by an export
+does not depend on the size of the collection.
+
+CSV output has a ``pid`` column followed by a column for each Dublin
+Core field, with multiple values separated by ``|`` as in ingest
+manifests (see :mod:`genrepo.file.manifest`).  JSON Lines output has
+one JSON object per member, with a list of values for each field.
+Members whose metadata can't be retrieved are included with an
+``error`` message.
+'''
+
+from collections import namedtuple
+import csv
+import logging
+from StringIO import StringIO
+
+from django.conf import settings
+from django.utils import simplejson
+
+from genrepo.collection.models import DC_FIELDS, dc_values
+from genrepo.file.bulk import pool_imap
+from genrepo.file.manifest import MULTIVALUE_SEPARATOR
+from genrepo.file.models import FileObject
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+'supported export formats, with the mimetype of each'
+
+CSV_COLUMNS = ('pid',) + DC_FIELDS + ('error',)
+'columns of a CSV export'
+
+PAGE_SIZE = 1000
+'number of collection members listed per Resource Index query'
+
+
+class MemberMetadata(namedtuple('MemberMetadata', 'pid values error')):
+    '''Dublin Core of a single collection member: pid, field values
+    (as returned by :func:`~genrepo.collection.models.dc_values`; None
+    if the metadata could not be retrieved), and an error message (None
+    if successful).'''
+    __slots__ = ()
+
+
+def _member_metadata(repo, info):
+    # retrieve dc for a single member; errors are reported, not raised,
+    # so one inaccessible member doesn't end the export
+    try:
+        obj = repo.get_object(info.pid, type=FileObject)
+        return MemberMetadata(info.pid, dc_values(obj.dc.content), None)
+    except Exception as err:
+        logger.warning('Could not export metadata for %s: %s' % (info.pid, err))
+        return MemberMetadata(info.pid, None, unicode(err) or repr(err))
+
+
+def _csv_line(values):
+    buffer = StringIO()
+    csv.writer(buffer).writerow([unicode(value or '').encode('utf-8') for value in values])
+    return buffer.getvalue()
+
+def csv_rows(results):
+    '''Generate CSV lines (starting with a header) for a series of
+    :class:`MemberMetadata`.'''
+    yield _csv_line(CSV_COLUMNS)
+    for result in results:
+        values = dict(result.values or ())
+        yield _csv_line([result.pid] +
+                        [MULTIVALUE_SEPARATOR.join(values.get(field, ()))
+                         for field in DC_FIELDS] +
+                        [result.error])
+
+def jsonl_rows(results):
+    '''Generate JSON Lines for a series of :class:`MemberMetadata`.'''
+    for result in results:
+        data = {'pid': result.pid}
+        if result.error is not None:
+            data['error'] = result.error
+        else:
+            data.update((field, list(values)) for field, values in result.values)
+        yield simplejson.dumps(data) + '\n'
+
+
+def member_metadata(repo, collection, workers=None, page_size=None):
+    '''Retrieve the Dublin Core of all members of a collection.
+
+    The member list is queried when this function is called, with the
+    credentials of the :func:`~genrepo.repository.current_repository`;
+    pages of members and their metadata are only retrieved as the
+    results are read.
+
+    :param repo: :class:`~genrepo.repository.Repository` used to read
+        member objects; shared by the worker threads, so it should not
+        keep an identity map
+    :param collection: :class:`~genrepo.collection.models.CollectionObject`
+    :param workers: number of members retrieved at once; defaults to
+        the configured ``METADATA_EXPORT_WORKERS``
+    :param page_size: number of members listed per query; defaults to
+        :data:`PAGE_SIZE`
+    :returns: generator of :class:`MemberMetadata`, in member order
+    '''
+    if workers is None:
+        workers = getattr(settings, 'METADATA_EXPORT_WORKERS', 4)
+    members = collection.members.iterate(page_size or PAGE_SIZE)
+    return pool_imap(lambda info: _member_metadata(repo, info), members, max(workers, 1))
+
+
+def metadata_export(repo, collection, format='csv', workers=None, page_size=None):
+    '''Export the Dublin Core of all members of a collection (see
+    :func:`member_metadata`).
+
+    :param format: one of :data:`EXPORT_FORMATS`
+    :returns: generator of strings (lines of output), suitable for use
+        as the content of a streaming
+        :class:`~django.http.HttpResponse`
+    '''
+    if format not in EXPORT_FORMATS:
+        raise ValueError('Unsupported export format: %s' % format)
+    results = member_metadata(repo, collection, workers=workers, page_size=page_size)
+    if format == 'csv':
+        return csv_rows(results)
+    return jsonl_rows(results)
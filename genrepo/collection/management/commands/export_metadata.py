@@ -0,0 +1,63 @@
+from optparse import make_option
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from genrepo.collection.export import EXPORT_FORMATS, member_metadata, \
+     csv_rows, jsonl_rows
+from genrepo.collection.models import CollectionObject
+from genrepo.repository import Repository
+
+
+class Command(BaseCommand):
+    '''Export the Dublin Core metadata of every member of a collection
+    as CSV or JSON Lines (see :mod:`genrepo.collection.export`).  Rows
+    are written as they are retrieved, so collections of any size can
+    be exported in constant memory.'''
+    help = __doc__
+    args = '<collection pid>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='csv',
+            choices=sorted(EXPORT_FORMATS.keys()),
+            help='Output format: %s [%%default]' % ', '.join(sorted(EXPORT_FORMATS.keys()))),
+        make_option('--output', '-o', dest='output', default=None,
+            help='File to write to [standard output]'),
+        make_option('--workers', type='int', dest='workers', default=None,
+            help='Number of members to retrieve at once [METADATA_EXPORT_WORKERS]'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if len(args) != 1:
+            raise CommandError('Please specify a single collection pid')
+
+        repo = Repository()
+        collection = repo.get_object(args[0], type=CollectionObject)
+        if not collection.exists:
+            raise CommandError('Collection %s not found' % args[0])
+
+        counts = {'exported': 0, 'failed': 0}
+        def counted(results):
+            for result in results:
+                counts['failed' if result.error else 'exported'] += 1
+                yield result
+
+        results = counted(member_metadata(repo, collection, workers=options['workers']))
+        rows = csv_rows(results) if options['format'] == 'csv' else jsonl_rows(results)
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout
+        start = time.time()
+        try:
+            for row in rows:
+                output.write(row)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        # report to stderr, so as not to mix with exported data on stdout
+        if verbosity > 0:
+            sys.stderr.write('Exported metadata for %d member(s) in %.1f seconds\n' % \
+                             (counts['exported'], time.time() - start))
+            if counts['failed']:
+                sys.stderr.write('Could not retrieve metadata for %d member(s)\n' % counts['failed'])
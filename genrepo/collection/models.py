@@ -1,9 +1,58 @@
+from collections import namedtuple
+from datetime import datetime
+import logging
+import threading
+import time
+from urllib import urlencode
+
 from django.conf import settings
+from django.core.cache import cache
 from django.db.models import Model
+from django.dispatch import Signal
+
+from eulcore.fedora.models import DigitalObject, XmlDatastream, \
+     XmlDatastreamObject
+from eulcore.fedora.rdfns import relsext, model as modelns
+from eulcore.fedora.util import RequestFailed
+from eulcore.fedora.xml import ObjectProfile
+from eulcore.xmlmap import load_xmlobject_from_string
+from eulcore.xmlmap.dc import DublinCore
+
+from genrepo.repository import Repository, current_repository
+
+logger = logging.getLogger(__name__)
+
+# fedora system properties available in the Resource Index
+FEDORA_LABEL = 'info:fedora/fedora-system:def/model#label'
+FEDORA_LAST_MODIFIED = 'info:fedora/fedora-system:def/view#lastModifiedDate'
+
+
+DC_FIELDS = ('title', 'creator', 'subject', 'description', 'publisher',
+             'contributor', 'date', 'type', 'format', 'identifier', 'source',
+             'language', 'relation', 'coverage', 'rights')
+'Dublin Core elements'
+
+def dc_values(dc):
+    '''Summary of the content of a
+    :class:`~eulcore.xmlmap.dc.DublinCore` instance, for detecting
+    changes: the non-empty values of each field, in order.  Empty
+    elements (e.g., added when a form is saved with blank fields) and
+    differences in formatting are ignored.'''
+    return tuple((field, tuple(value.strip() for value in getattr(dc, '%s_list' % field)
+                               if value and value.strip()))
+                 for field in DC_FIELDS)
+
+
+collection_saved = Signal(providing_args=['pid'])
+'''Signal sent (with :class:`CollectionObject` as sender) after a
+collection is created or updated via genrepo.  Receivers should
+discard any cached collection information.'''
+
+object_saved = Signal(providing_args=['obj'])
+'''Signal sent (with the object class as sender) after changes to a
+:class:`CachedDigitalObject` have been saved to Fedora, e.g. to update
+a local index of object metadata.  Not sent when nothing was changed.'''
 
-from eulcore.django.fedora import Repository
-from eulcore.fedora.models import DigitalObject
-from eulcore.fedora.rdfns import relsext
 
 class AccessibleObject(DigitalObject):
     """A place-holder Fedora Object for auto-generating a PublicAccess
@@ -13,10 +62,388 @@ class AccessibleObject(DigitalObject):
     CONTENT_MODELS = [ PUBLIC_ACCESS_CMODEL ]
 
 
+class CachedXmlDatastreamObject(XmlDatastreamObject):
+    '''Extends :class:`~eulcore.fedora.models.XmlDatastreamObject` to
+    load and store datastream content in the object cache of a
+    :class:`CachedDigitalObject`.
+
+    Changes to be saved are detected by comparing the content with the
+    content as loaded, rather than the serialized xml; for Dublin Core,
+    only field values are compared (see :func:`dc_values`), so a form
+    submitted without changes does not cause a save.  Content that has
+    never been loaded is not modified, and is not retrieved to check.'''
+
+    _saved_values = None
+
+    def _get_content(self):
+        if self._content is None and not self.obj._create:
+            data = self.obj._cached_datastream(self.id)
+            if data is not None:
+                self._content = self._convert_content(data, None)
+                # digest is used to detect changes to be saved
+                self.digest = self._content_digest()
+            else:
+                super(CachedXmlDatastreamObject, self)._get_content()
+                self.obj._cache_datastream(self.id, self._raw_content())
+            self._saved_values = self._content_values()
+            return self._content
+        return super(CachedXmlDatastreamObject, self)._get_content()
+    content = property(_get_content, XmlDatastreamObject._set_content, None,
+        XmlDatastreamObject.content.__doc__)
+
+    def _content_values(self):
+        # comparable summary of the current content
+        if isinstance(self._content, DublinCore):
+            return dc_values(self._content)
+        return self._content_digest()
+
+    def isModified(self):
+        if self.info_modified:
+            return True
+        if self._content is None and not self.obj._create:
+            return False
+        if self._saved_values is None:
+            return super(CachedXmlDatastreamObject, self).isModified()
+        return self._content_values() != self._saved_values
+
+    def save(self, logmessage=None):
+        success = super(CachedXmlDatastreamObject, self).save(logmessage)
+        if success:
+            self._saved_values = self._content_values()
+        return success
+
+class CachedXmlDatastream(XmlDatastream):
+    ''':class:`~eulcore.fedora.models.XmlDatastream` descriptor for a
+    :class:`CachedXmlDatastreamObject`.'''
+    _datastreamClass = CachedXmlDatastreamObject
+
+
+class CachedDigitalObject(DigitalObject):
+    '''Extends :class:`~eulcore.fedora.models.DigitalObject` to store
+    the object profile (label, dates, etc.) and Dublin Core in the
+    configured Django cache, so that repeated views of an unchanged
+    object don't retrieve them from Fedora every time.
+
+    Cached information is used as is for ``OBJECT_CACHE_TIMEOUT``
+    seconds.  After that, only the object profile is retrieved, and
+    the cached Dublin Core is kept if the object's last modification
+    date has not changed.  Information is cached separately for each
+    Fedora user, since access to an object may depend on credentials.
+    Saving an object through :meth:`save` discards cached information
+    for all users.
+    '''
+
+    dc = CachedXmlDatastream("DC", "Dublin Core", DublinCore, defaults={
+            'control_group': 'X',
+            'format': 'http://www.openarchives.org/OAI/2.0/oai_dc/',
+        })
+
+    CACHE_KEY_PREFIX = 'genrepo-object'
+
+    def _cache_key(self):
+        # cache key for the current pid and fedora user; includes a version
+        # number that changes every time the object is saved
+        version = cache.get(self._cache_version_key(), 0)
+        username = getattr(getattr(self.api, 'opener', None), 'username', None)
+        return '%s-%s-%s-%s' % (self.CACHE_KEY_PREFIX, self.pid, version, username or '')
+
+    def _cache_version_key(self):
+        return '%s-version-%s' % (self.CACHE_KEY_PREFIX, self.pid)
+
+    def _cache_entry(self):
+        # cached information for this object (if any), as a dictionary with
+        # time last checked, modification date, profile, and datastreams
+        if not hasattr(self, '_cached'):
+            self._cached = cache.get(self._cache_key())
+        return self._cached
+
+    def _store_cache_entry(self, entry):
+        self._cached = entry
+        cache.set(self._cache_key(), entry,
+                  getattr(settings, 'OBJECT_CACHE_MAX_AGE', 86400))
+
+    def _cached_datastream(self, dsid):
+        # cached datastream content, if the object profile is current
+        try:
+            self.getProfile()
+        except RequestFailed:
+            return None
+        entry = self._cache_entry()
+        if entry is not None:
+            return entry['datastreams'].get(dsid, None)
+
+    def _cache_datastream(self, dsid, data):
+        entry = self._cache_entry()
+        if entry is not None and data is not None:
+            entry['datastreams'][dsid] = data
+            self._store_cache_entry(entry)
+
+    def invalidate_cache(self):
+        '''Discard cached information about this object for all users.'''
+        cache.set(self._cache_version_key(), '%f' % time.time(),
+                  getattr(settings, 'OBJECT_CACHE_MAX_AGE', 86400))
+        if hasattr(self, '_cached'):
+            del self._cached
+
+    def getProfile(self):
+        if self._create:
+            return super(CachedDigitalObject, self).getProfile()
+        # profile is only loaded or validated once per instance
+        if self._info is not None:
+            return self._info
+
+        entry = self._cache_entry()
+        if entry is not None and \
+               time.time() - entry['checked'] < getattr(settings, 'OBJECT_CACHE_TIMEOUT', 60):
+            self._info = load_xmlobject_from_string(entry['profile'], ObjectProfile)
+            return self._info
+
+        try:
+            self._info = super(CachedDigitalObject, self).getProfile()
+        except RequestFailed:
+            # object does not exist or is not accessible; don't keep anything
+            if entry is not None:
+                cache.delete(self._cache_key())
+                self._cached = None
+            raise
+
+        datastreams = {}
+        if entry is not None and entry['modified'] == self._info.modified:
+            datastreams = entry['datastreams']
+        self._store_cache_entry({'checked': time.time(), 'modified': self._info.modified,
+                                 'profile': self._info.serialize(), 'datastreams': datastreams})
+        return self._info
+
+    def _set_label(self, val):
+        # only an actual change to the label needs to be saved
+        if self._create or val[:255] != self.label:
+            super(CachedDigitalObject, self)._set_label(val)
+    label = property(DigitalObject._get_label, _set_label, None,
+                     DigitalObject.label.__doc__)
+
+    def is_modified(self):
+        '''Check whether :meth:`save` would write anything to Fedora:
+        True for a new object, or if the object profile or any
+        datastream has changed since it was loaded.'''
+        if self._create:
+            return True
+        return self.info_modified or \
+               any(dsobj.isModified() for dsobj in self.dscache.itervalues())
+
+    def save(self, logMessage=None):
+        '''Save any changes to Fedora (see
+        :meth:`~eulcore.fedora.models.DigitalObject.save`).  If nothing
+        has changed (see :meth:`is_modified`), nothing is sent to
+        Fedora, so no new audit trail entry or datastream version is
+        created, and cached information is kept.  Sends
+        :data:`object_saved` after a successful save.'''
+        if not self.is_modified():
+            return True
+        try:
+            result = super(CachedDigitalObject, self).save(logMessage)
+        finally:
+            # pid may not have been assigned if ingest failed
+            if isinstance(self.pid, basestring):
+                self.invalidate_cache()
+        object_saved.send(sender=self.__class__, obj=self)
+        return result
+
+
+class ObjectInfo(namedtuple('ObjectInfo', 'pid label content_models modified')):
+    '''Lightweight, read-only summary of a Fedora object (pid, label,
+    content models, and last modification date) as reported by the
+    Fedora Resource Index.  Holds no reference to a repository
+    connection, so it is cheap to build in bulk and safe to cache.
+    '''
+    __slots__ = ()
+
+    @property
+    def uri(self):
+        "Fedora URI for this object (info:fedora/foo:### form of object pid)"
+        return 'info:fedora/' + self.pid
+
+
+def _parse_fedora_date(value):
+    # convert a Resource Index date (e.g., 2011-05-03T10:20:47.123Z) to a
+    # naive (UTC) datetime; returns None if the value can't be parsed
+    if not value:
+        return None
+    value = value.rstrip('Z')
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return None
+
+def object_info_query(repo, where, order_by='?obj', limit=None, offset=None):
+    '''Run a single Resource Index query to retrieve
+    :class:`ObjectInfo` for all objects matched by a SPARQL graph
+    pattern.
+
+    :param repo: :class:`~eulcore.django.fedora.server.Repository` to query
+    :param where: SPARQL graph pattern used to select objects; should
+        constrain the variable ``?obj``
+    :param order_by: SPARQL ordering for the results
+    :param limit: optional maximum number of result rows
+    :param offset: optional number of result rows to skip
+    :returns: list of :class:`ObjectInfo`, in result order
+    '''
+    query = '''SELECT ?obj ?label ?cmodel ?modified
+    WHERE {
+        %(where)s
+        ?obj <%(modified)s> ?modified .
+        OPTIONAL { ?obj <%(label)s> ?label }
+        OPTIONAL {
+            ?obj <%(hasmodel)s> ?cmodel .
+            FILTER (?cmodel != <info:fedora/fedora-system:FedoraObject-3.0>)
+        }
+    }
+    ORDER BY %(order_by)s''' % {
+        'where': where, 'hasmodel': modelns.hasModel, 'modified': FEDORA_LAST_MODIFIED,
+        'label': FEDORA_LABEL, 'order_by': order_by
+    }
+    if limit is not None:
+        query += ' LIMIT %d' % limit
+    if offset:
+        query += ' OFFSET %d' % offset
+
+    # the result includes one row per object content model (or a single
+    # row with no content model, for objects with only the system
+    # content model, so they are listed and counted consistently); collapse
+    # them into a single ObjectInfo per object, keeping result order
+    pids = []
+    rows_by_pid = {}
+    for row in repo.risearch.sparql_query(query):
+        pid = row['obj']
+        if pid.startswith('info:fedora/'):
+            pid = pid[len('info:fedora/'):]
+        if pid not in rows_by_pid:
+            pids.append(pid)
+            rows_by_pid[pid] = {'label': row.get('label') or None, 'cmodels': [],
+                                'modified': _parse_fedora_date(row.get('modified'))}
+        if row.get('cmodel'):
+            rows_by_pid[pid]['cmodels'].append(row['cmodel'])
+
+    return [ObjectInfo(pid, rows_by_pid[pid]['label'],
+                       tuple(rows_by_pid[pid]['cmodels']),
+                       rows_by_pid[pid]['modified'])
+            for pid in pids]
+
+
+def count_statements(repo, query):
+    '''Count the triples matching an SPO query in the Resource
+    Index, without retrieving the triples themselves.
+
+    :param repo: :class:`~eulcore.django.fedora.server.Repository` to query
+    :param query: SPO query, e.g. ``* <predicate> <object>``
+    :rtype: int
+    '''
+    data, url = repo.risearch.read('risearch?' + urlencode({
+        'type': 'triples', 'lang': 'spo', 'format': 'count', 'query': query,
+    }))
+    return int(data.strip())
+
+
+class ObjectInfoList(object):
+    '''Lazy, sliceable list of :class:`ObjectInfo` for all objects
+    matched by a SPARQL graph pattern (see :func:`object_info_query`).
+
+    Nothing is retrieved until the list is used.  Slicing runs a single
+    query restricted to the requested range with LIMIT and OFFSET, and
+    the length is determined with a count query, so an instance can be
+    handed directly to :class:`~django.core.paginator.Paginator`.
+    Iterating retrieves and caches all results.
+
+    Limits apply to Resource Index result rows, which are returned one
+    per content model; objects with more than one content model (other
+    than the standard Fedora object model) will make a slice shorter
+    than requested.
+
+    :param repo: :class:`~eulcore.django.fedora.server.Repository` to query
+    :param where: SPARQL graph pattern used to select objects
+    :param order_by: SPARQL ordering for the results
+    :param count_query: SPO query matching one triple per object, used
+        to count results; if not specified, all results are retrieved
+        to determine the length
+    '''
+    def __init__(self, repo, where, order_by='?obj', count_query=None):
+        self.repo = repo
+        self.where = where
+        self.order_by = order_by
+        self.count_query = count_query
+        self._results = None
+        self._count = None
+
+    def _query(self, limit=None, offset=None):
+        return object_info_query(self.repo, self.where, order_by=self.order_by,
+                                 limit=limit, offset=offset)
+
+    def count(self):
+        if self._count is None:
+            if self._results is not None:
+                self._count = len(self._results)
+            elif self.count_query is not None:
+                self._count = count_statements(self.repo, self.count_query)
+            else:
+                self._count = len(list(self))
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        if self._results is None:
+            self._results = self._query()
+        return iter(self._results)
+
+    def iterate(self, page_size=1000):
+        '''Iterate over all results one page at a time, with a
+        separate query for each page, so that only a single page of
+        results is held in memory (unlike iterating over the list
+        itself, which retrieves and keeps all results).
+
+        :param page_size: number of results to retrieve per query
+        '''
+        if self._results is not None:
+            for info in self._results:
+                yield info
+            return
+        offset = 0
+        last = None
+        while True:
+            page = self._query(limit=page_size, offset=offset)
+            if not page:
+                break
+            for info in page:
+                # rows for an object with more than one content model
+                # may be split across two pages
+                if info.pid != last:
+                    yield info
+                last = info.pid
+            offset += page_size
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            if k.step is not None or (k.start or 0) < 0 or (k.stop or 0) < 0:
+                raise ValueError('Only non-negative slices without a step are supported')
+            start = k.start or 0
+            if self._results is not None:
+                return self._results[k]
+            if k.stop is None:
+                return self._query(offset=start)
+            return self._query(limit=max(k.stop - start, 0), offset=start)
+        if k < 0:
+            raise IndexError('Negative indexing is not supported')
+        results = self[k:k+1]
+        if not results:
+            raise IndexError('list index out of range')
+        return results[0]
+
 
 class Collection(Model):
     '''Collection place-holder object to define Django permissions on
-    :class:`CollectionObject` . 
+    :class:`CollectionObject` .
     '''
     class Meta:
         permissions = (
@@ -24,10 +451,11 @@ class Collection(Model):
         )
 
 
-class CollectionObject(DigitalObject):
+class CollectionObject(CachedDigitalObject):
     """A Fedora CollectionObject.  Inherits the standard Dublin Core
     and RELS-EXT datastreams from
-    :class:`~eulcore.fedora.models.DigitalObject`, and adds a content
+    :class:`~eulcore.fedora.models.DigitalObject` (with cached object
+    information from :class:`CachedDigitalObject`), and adds a content
     model to identify this item as a Collection object.
     """
     COLLECTION_CONTENT_MODEL = 'info:fedora/emory-control:Collection-1.0'
@@ -36,29 +464,143 @@ class CollectionObject(DigitalObject):
     # use configured fedora pidspace (if any) when minting pids
     default_pidspace = getattr(settings, 'FEDORA_PIDSPACE', None)
 
+    INDEX_CACHE_KEY = 'genrepo-collection-index'
+    # cache key used as a lock so only one process refreshes a stale index
+    INDEX_REFRESH_LOCK_KEY = 'genrepo-collection-index-refresh'
+
     @staticmethod
     def all():
         """
         Returns all collections in the repository as
-        :class:`~genrepo.collection.models.CollectionObject`
+        :class:`~genrepo.collection.models.CollectionObject`, retrieved
+        with the :func:`~genrepo.repository.current_repository`.
+        Collection pids are taken from the cached collection :meth:`index`.
         """
+        repo = current_repository()
+        return [repo.get_object(info.pid, type=CollectionObject)
+                for info in CollectionObject.index()]
+
+    @staticmethod
+    def index():
+        '''Returns a summary of all collections in the repository as a
+        list of :class:`ObjectInfo`.
+
+        The index is stored in the configured Django cache, so it is
+        shared by all processes using the same cache backend.  It is
+        considered fresh for ``COLLECTION_INDEX_TIMEOUT`` seconds; after
+        that, for up to ``COLLECTION_INDEX_STALE_TIMEOUT`` more seconds,
+        the stale index is returned immediately while a fresh copy is
+        loaded from the Resource Index in a background thread.  If no
+        usable index is cached, it is loaded before returning.
+        '''
+        timeout, stale_timeout = CollectionObject._index_timeouts()
+        cached = cache.get(CollectionObject.INDEX_CACHE_KEY)
+        if cached is not None:
+            timestamp, colls = cached
+            age = time.time() - timestamp
+            if age < timeout:
+                return colls
+            if age < timeout + stale_timeout:
+                CollectionObject._refresh_index_in_background()
+                return colls
+        return CollectionObject._refresh_index()
+
+    @staticmethod
+    def invalidate_index():
+        '''Remove the cached collection :meth:`index`, so that the next
+        request will load current collection information from Fedora.
+        Called whenever :data:`collection_saved` is sent.'''
+        cache.delete(CollectionObject.INDEX_CACHE_KEY)
+
+    @staticmethod
+    def _index_timeouts():
+        return (getattr(settings, 'COLLECTION_INDEX_TIMEOUT', 300),
+                getattr(settings, 'COLLECTION_INDEX_STALE_TIMEOUT', 3600))
+
+    @staticmethod
+    def _refresh_index():
+        # query the Resource Index for all collections and store the result;
+        # the index is shared by all users, so always query as guest
         repo = Repository()
-        colls = repo.get_objects_with_cmodel(CollectionObject.COLLECTION_CONTENT_MODEL,
-                                             type=CollectionObject)
+        colls = object_info_query(repo,
+            '?obj <%s> <%s> .' % (modelns.hasModel, CollectionObject.COLLECTION_CONTENT_MODEL))
+        timeout, stale_timeout = CollectionObject._index_timeouts()
+        cache.set(CollectionObject.INDEX_CACHE_KEY, (time.time(), colls),
+                  timeout + stale_timeout)
         return colls
 
+    @staticmethod
+    def _refresh_index_in_background():
+        # only start a refresh if no other process or thread is already
+        # refreshing; the lock expires on its own in case a refresh dies
+        timeout, stale_timeout = CollectionObject._index_timeouts()
+        if not cache.add(CollectionObject.INDEX_REFRESH_LOCK_KEY, True, max(timeout, 60)):
+            return
+
+        def refresh():
+            try:
+                CollectionObject._refresh_index()
+            except Exception:
+                logger.exception('Error refreshing collection index')
+            finally:
+                cache.delete(CollectionObject.INDEX_REFRESH_LOCK_KEY)
+
+        thread = threading.Thread(target=refresh, name='collection-index-refresh')
+        thread.setDaemon(True)
+        thread.start()
+
+    MEMBERS_MODIFIED_KEY = 'genrepo-collection-members-modified'
+
+    @staticmethod
+    def _members_max_age():
+        return getattr(settings, 'COLLECTION_MEMBERS_MAX_AGE', 300)
+
+    @staticmethod
+    def members_changed(pid):
+        '''Record that the members of a collection (or the information
+        about one of its members) have changed; see
+        :attr:`members_modified`.
+
+        :param pid: collection pid or URI
+        '''
+        if pid.startswith('info:fedora/'):
+            pid = pid[len('info:fedora/'):]
+        cache.set('%s-%s' % (CollectionObject.MEMBERS_MODIFIED_KEY, pid), time.time(),
+                  CollectionObject._members_max_age())
+
+    @property
+    def members_modified(self):
+        '''Date (UTC) the members of this collection were last changed
+        through genrepo (see :meth:`members_changed`).  If no change has
+        been recorded recently, the current time is recorded and
+        returned, since the members may have changed in the meantime.
+        A recorded date is only kept for ``COLLECTION_MEMBERS_MAX_AGE``
+        seconds, so that changes made directly in Fedora are noticed
+        within that time.'''
+        key = '%s-%s' % (self.MEMBERS_MODIFIED_KEY, self.pid)
+        now = time.time()
+        cache.add(key, now, self._members_max_age())
+        return datetime.utcfromtimestamp(cache.get(key, now))
+
     @property
     def members(self):
-        '''Return all Fedora objects in the repository that are related to the current
-        collection via isMemberOfCollection.'''
-        # FIXME: loses repo permissions/credentials here... 
-        repo = Repository()
-        members = repo.risearch.get_subjects(relsext.isMemberOfCollection, self.uri)
-        # for now, just returning as generic DigitalObject instances
-        for pid in members:
-            # TODO: should we restrict to accessible objects only?
-            # (requires passing correct credentials through...)
-            yield repo.get_object(pid)
+        '''Summary information for all Fedora objects in the repository
+        that are related to the current collection via
+        isMemberOfCollection, as an :class:`ObjectInfoList` of
+        :class:`ObjectInfo` sorted by label.  Slices of the list (e.g.,
+        a single page of members) are retrieved with a single Resource
+        Index query, with the credentials of the
+        :func:`~genrepo.repository.current_repository`; no member
+        objects are retrieved from Fedora.  The list may include objects
+        the current user can't access, so members should be checked
+        with :func:`~genrepo.util.accessible` before they are displayed.'''
+        repo = current_repository()
+        return ObjectInfoList(repo,
+            '?obj <%s> <%s> .' % (relsext.isMemberOfCollection, self.uri),
+            order_by='?label ?obj',
+            count_query='* <%s> <%s>' % (relsext.isMemberOfCollection, self.uri))
 
-    
 
+def _invalidate_collection_index(sender, **kwargs):
+    CollectionObject.invalidate_index()
+collection_saved.connect(_invalidate_collection_index, sender=CollectionObject)
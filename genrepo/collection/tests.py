@@ -1,20 +1,35 @@
+from datetime import datetime
 from mock import patch, Mock
 import re
+from StringIO import StringIO
+import struct
+import time
+import zipfile
 
 from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import AnonymousUser
 from django.core.urlresolvers import reverse
+from django.http import HttpRequest, HttpResponse
 from django.test import Client, TestCase
+from django.utils import simplejson
 
 from eulcore.django.fedora import Repository
 from eulcore.django.test import TestCase as EulcoreTestCase
 from eulcore.fedora.api import  ApiFacade
 from eulcore.fedora.models import DigitalObject
-from eulcore.fedora.rdfns import relsext
+from eulcore.fedora.rdfns import relsext, model as modelns
 from eulcore.fedora.util import RequestFailed, PermissionDenied
 from eulcore.xmlmap.dc import DublinCore
 
+from genrepo.collection.archive import ZipStream, prefetch
+from genrepo.collection.export import MemberMetadata
 from genrepo.collection.forms import CollectionDCEditForm
-from genrepo.collection.models import CollectionObject
+from genrepo.collection.models import CollectionObject, ObjectInfo, \
+     CachedDigitalObject, dc_values
+from genrepo.repository import PooledServerConnection, RepositoryMiddleware, \
+     current_repository
+from genrepo.util import accessible
 
 # users defined in users.json fixture
 ADMIN_CREDENTIALS = {'username': 'repoeditor', 'password': 'r3p03d'} 
@@ -240,6 +255,12 @@ class CollectionViewsTest(EulcoreTestCase):
                  "posted title should be set in object label; expected '%s', got '%s'" % \
                  (update_data['title'], updated_obj.label))
 
+        # posting the same data again should not save anything
+        response = self.client.post(self.edit_coll_url, update_data, follow=True)
+        messages = [ str(msg) for msg in response.context['messages'] ]
+        self.assert_('No changes to save' in messages[0],
+                     'no changes message displayed to user when nothing changed')
+
     def test_view(self):
         # test viewing an existing collection object
 
@@ -278,6 +299,26 @@ class CollectionViewsTest(EulcoreTestCase):
             msg_prefix='collection view should include edit link for repo editor')
 
 
+    def test_view_conditional_get(self):
+        response = self.client.get(self.view_coll_url)
+        etag = response['ETag']
+        self.assert_(response.has_header('Last-Modified'))
+        response = self.client.get(self.view_coll_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code,
+            'unchanged collection page should not be sent again')
+        self.assertEqual('', response.content)
+
+        # adding a member should change the page
+        CollectionObject.members_changed(self.obj.pid)
+        response = self.client.get(self.view_coll_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+
+        # pages differ for each user
+        etag = response['ETag']
+        self.client.post(settings.LOGIN_URL, ADMIN_CREDENTIALS)
+        response = self.client.get(self.view_coll_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+
     def test_view_nonexistent(self):
         # non-existent object should 404
         view_coll_url = reverse('collection:view', kwargs={'pid': 'bogus:nonexistent-pid'})
@@ -333,6 +374,161 @@ class CollectionViewsTest(EulcoreTestCase):
             self.assertContains(response, reverse('file:edit', kwargs={'pid': file2.pid}),
                 msg_prefix='collection view should include link to edit second member item (repo editor)')
 
+        # members the current user can't access should not be listed
+        with patch.object(Repository, 'get_object', new=Mock(return_value=testcoll)):
+            with patch('genrepo.collection.views.accessible') as mockaccessible:
+                mockaccessible.side_effect = lambda members: [m for m in members
+                                                              if m.pid != file2.pid]
+                response = self.client.get(self.view_coll_url)
+                self.assertContains(response, file1.label)
+                self.assertNotContains(response, file2.label,
+                    msg_prefix='inaccessible collection members should not be listed')
+
+
+    def test_download(self):
+        testcoll = Mock(name='MockCollectionObject')
+        testcoll.pid = 'coll:1'
+        testcoll.exists = True
+        testcoll.members.iterate.return_value = iter([
+            ObjectInfo('file:1', 'one.txt', (), None),
+            ObjectInfo('file:2', 'two.txt', (), None),
+            ObjectInfo('file:3', 'three.txt', (), None)])
+        member = Mock(name='MockDigitalObject')
+        member.pid = 'file:1'
+        member.label = 'one.txt'
+        profile = Mock(created=None, mimetype='text/plain', size=8)
+        dc = DublinCore()
+        dc.title = 'One Fish'
+        dc.subject_list.extend(['fish', 'counting'])
+
+        class Content(list):
+            def close(self):
+                pass
+        content = Content(['one ', 'fish'])
+        def load_member(repo, cache, info):
+            if info.pid == 'file:2':
+                raise PermissionDenied(Mock(status=401, reason='Unauthorized'))
+            if info.pid == 'file:3':
+                raise RequestFailed(Mock(status=500, reason='Internal Server Error'))
+            return (member, profile, dc), content
+
+        with patch.object(Repository, 'get_object', new=Mock(return_value=testcoll)):
+            with patch('genrepo.collection.archive._load_member', new=load_member):
+                response = self.client.get(reverse('collection:download', args=['coll:1']))
+                self.assertEqual(200, response.status_code)
+                self.assertEqual('application/zip', response['Content-Type'])
+                self.assertEqual('attachment; filename=coll_1.zip',
+                                 response['Content-Disposition'])
+                archive = zipfile.ZipFile(StringIO(response.content))
+        self.assertEqual(['file_1.txt', 'manifest.csv', 'errors.txt'], archive.namelist())
+        self.assertEqual('one fish', archive.read('file_1.txt'))
+        manifest = archive.read('manifest.csv').splitlines()
+        self.assert_(manifest[0].startswith('path,collection,title,creator,subject'))
+        self.assert_(manifest[1].startswith('file_1.txt,coll:1,One Fish,,fish|counting'))
+        errors = archive.read('errors.txt')
+        self.assert_(errors.startswith('file:3:'),
+            'members that could not be read should be listed in errors.txt')
+        self.assert_('file:2' not in errors,
+            'members the user may not read should not be listed in errors.txt')
+
+        testcoll.exists = False
+        with patch.object(Repository, 'get_object', new=Mock(return_value=testcoll)):
+            response = self.client.get(reverse('collection:download', args=['coll:1']))
+            self.assertEqual(404, response.status_code)
+
+    def test_export(self):
+        testcoll = Mock(name='MockCollectionObject')
+        testcoll.pid = 'coll:1'
+        testcoll.exists = True
+        testcoll.members.iterate.return_value = [ObjectInfo('file:1', 'one.txt', (), None),
+                                                 ObjectInfo('file:2', 'two.txt', (), None)]
+        dc = DublinCore()
+        dc.title = 'One Fish'
+        dc.subject_list.extend(['fish', 'counting'])
+        def member_metadata(repo, info):
+            if info.pid == 'file:2':
+                return MemberMetadata(info.pid, None, 'Unauthorized')
+            return MemberMetadata(info.pid, dc_values(dc), None)
+
+        export_url = reverse('collection:export', args=['coll:1'])
+        with patch.object(Repository, 'get_object', new=Mock(return_value=testcoll)):
+            with patch('genrepo.collection.export._member_metadata', new=member_metadata):
+                response = self.client.get(export_url)
+                self.assertEqual(200, response.status_code)
+                self.assertEqual('text/csv', response['Content-Type'])
+                self.assertEqual('attachment; filename=coll_1-metadata.csv',
+                                 response['Content-Disposition'])
+                rows = response.content.splitlines()
+                self.assert_(rows[0].startswith('pid,title,creator,subject'))
+                self.assert_(rows[0].endswith(',error'))
+                self.assert_(rows[1].startswith('file:1,One Fish,,fish|counting,'))
+                self.assert_(rows[2].startswith('file:2,,') and rows[2].endswith(',Unauthorized'),
+                    'members that could not be read should be included with an error')
+
+                response = self.client.get(export_url, {'format': 'jsonl'})
+                self.assertEqual(200, response.status_code)
+                rows = [simplejson.loads(row) for row in response.content.splitlines()]
+                self.assertEqual('file:1', rows[0]['pid'])
+                self.assertEqual(['One Fish'], rows[0]['title'])
+                self.assertEqual(['fish', 'counting'], rows[0]['subject'])
+                self.assertEqual({'pid': 'file:2', 'error': 'Unauthorized'}, rows[1])
+
+                response = self.client.get(export_url, {'format': 'xls'})
+                self.assertEqual(400, response.status_code)
+
+        testcoll.exists = False
+        with patch.object(Repository, 'get_object', new=Mock(return_value=testcoll)):
+            response = self.client.get(export_url)
+            self.assertEqual(404, response.status_code)
+
+    def test_view_members_paginated(self):
+        testcoll = Mock(name='MockCollectionObject')
+        testcoll.pid = 'coll:1'
+        members = []
+        for i in range(5):
+            item = Mock(name='MockDigitalObject')
+            item.pid = 'file:%d' % i
+            item.label = 'Fish number %d' % i
+            members.append(item)
+        testcoll.members = members
+
+        with patch.object(Repository, 'get_object', new=Mock(return_value=testcoll)):
+            response = self.client.get(self.view_coll_url, {'page': 2, 'per_page': 2})
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(members[2:4], list(response.context['members']),
+                'second page of collection members should be set in response context')
+            self.assertContains(response, members[2].label)
+            self.assertNotContains(response, members[0].label,
+                msg_prefix='members from other pages should not be listed')
+            self.assertContains(response, 'Page 2 of 3')
+            self.assertContains(response, '?page=3&amp;per_page=2',
+                msg_prefix='next page link should be included')
+
+            # out of range page should display last page
+            response = self.client.get(self.view_coll_url, {'page': 10, 'per_page': 2})
+            self.assertEqual(members[4:], list(response.context['members']))
+
+            # requested page size is limited by configured maximum
+            with patch.object(settings, 'COLLECTION_MEMBERS_MAX_PER_PAGE', new=3):
+                response = self.client.get(self.view_coll_url, {'per_page': 100})
+                self.assertEqual(3, response.context['per_page'])
+
+            # browse by cursor
+            response = self.client.get(self.view_coll_url, {'per_page': 2})
+            cursor = response.context['next_cursor']
+            response = self.client.get(self.view_coll_url, {'cursor': cursor})
+            self.assertEqual(members[2:4], list(response.context['members']),
+                'cursor should retrieve the next page of collection members')
+            response = self.client.get(self.view_coll_url,
+                                       {'cursor': response.context['next_cursor']})
+            self.assertEqual(members[4:], list(response.context['members']))
+            self.assert_('next_cursor' not in response.context,
+                'no cursor should be set for the last page of members')
+
+            # invalid cursor
+            response = self.client.get(self.view_coll_url, {'cursor': 'bogus'})
+            self.assertEqual(404, response.status_code)
+
 
         
 class CollectionObjectTest(TestCase):
@@ -342,20 +538,468 @@ class CollectionObjectTest(TestCase):
         # use an in-ingested collection object with a mock API for now (until we need more)
         self.coll = CollectionObject(Mock())
         
+    def test_members_modified(self):
+        self.coll.pid = 'coll:1'
+        cache.delete('%s-%s' % (CollectionObject.MEMBERS_MODIFIED_KEY, 'coll:1'))
+        modified = self.coll.members_modified
+        self.assertEqual(modified, self.coll.members_modified,
+            'members modified date should be recorded when first requested')
+        time.sleep(0.01)
+        CollectionObject.members_changed('info:fedora/coll:1')
+        self.assert_(self.coll.members_modified > modified)
+
+        # recorded dates expire, so that changes made outside genrepo are noticed
+        with patch('genrepo.collection.models.cache') as mockcache:
+            mockcache.get.return_value = time.time()
+            with patch.object(settings, 'COLLECTION_MEMBERS_MAX_AGE', new=120):
+                self.coll.members_modified
+                self.assertEqual(120, mockcache.add.call_args[0][2])
+                CollectionObject.members_changed('coll:1')
+                self.assertEqual(120, mockcache.set.call_args[0][2])
+
     def test_members(self):
-        # mock out risearch call
-        member_pids = ['pid:1', 'pid:2']
+        # mock out risearch call; one row per member content model
+        rows = [
+            {'obj': 'info:fedora/pid:1', 'label': 'One Fish',
+             'cmodel': 'info:fedora/emory-control:PublicAccess',
+             'modified': '2011-05-03T10:20:47.123Z'},
+            {'obj': 'info:fedora/pid:2', 'label': 'Two Fish',
+             'cmodel': 'info:fedora/emory-control:PublicAccess',
+             'modified': '2011-05-04T10:20:47.123Z'},
+            # object with only the system content model
+            {'obj': 'info:fedora/pid:3', 'label': 'Red Fish',
+             'modified': '2011-05-05T10:20:47.123Z'},
+        ]
         mockri = Mock(name='MockRIsearch')
-        mockri.get_subjects.return_value = member_pids
+        mockri.sparql_query.return_value = rows
         with patch.object(Repository, 'risearch', new=mockri):
             members = list(self.coll.members)
-            self.assertEqual(len(member_pids), len(members),
+            self.assertEqual(len(rows), len(members),
                 'collection members length should equal number of items returned by risearch call')
-            self.assert_(isinstance(members[0], DigitalObject),
-                'collection members should be instances of DigitalObject')
-            self.assert_(isinstance(members[1], DigitalObject),
-                'collection members should be instances of DigitalObject')
-            mockri.get_subjects.assert_called_once_with(relsext.isMemberOfCollection,
-                                                        self.coll.uri)
+            self.assert_(isinstance(members[0], ObjectInfo),
+                'collection members should be instances of ObjectInfo')
+            self.assertEqual('pid:1', members[0].pid)
+            self.assertEqual('One Fish', members[0].label)
+            self.assertEqual(('info:fedora/emory-control:PublicAccess',),
+                             members[1].content_models)
+            self.assertEqual(1, mockri.sparql_query.call_count,
+                'collection members should be retrieved with a single risearch query')
+            query = mockri.sparql_query.call_args[0][0]
+            self.assert_('<%s> <%s>' % (relsext.isMemberOfCollection, self.coll.uri) in query,
+                'risearch query should find objects that are members of the collection')
+            self.assertEqual((), members[2].content_models,
+                'members without a content model should be listed')
+            self.assert_(re.search(r'OPTIONAL \{\s*\?obj <%s> \?cmodel' % re.escape(modelns.hasModel),
+                                   query),
+                'content models should be optional, so that all counted members are listed')
+
+    def test_members_slice(self):
+        mockri = Mock(name='MockRIsearch')
+        mockri.sparql_query.return_value = [
+            {'obj': 'info:fedora/pid:3', 'label': 'Three Fish',
+             'cmodel': 'info:fedora/emory-control:PublicAccess',
+             'modified': '2011-05-03T10:20:47.123Z'},
+        ]
+        mockri.read.return_value = ('42\n', 'http://fedora/risearch')
+        with patch.object(Repository, 'risearch', new=mockri):
+            members = self.coll.members
+            self.assertEqual(0, mockri.sparql_query.call_count,
+                'collection members should not be retrieved until used')
+            page = members[20:30]
+            self.assertEqual('pid:3', page[0].pid)
+            query = mockri.sparql_query.call_args[0][0]
+            self.assert_('LIMIT 10' in query and 'OFFSET 20' in query,
+                'collection member slice should be pushed into the risearch query')
+            self.assertEqual(42, len(members),
+                'collection member count should be retrieved from risearch')
+            args = mockri.read.call_args[0][0]
+            self.assert_('format=count' in args)
+
+    def test_members_iterate(self):
+        # rows for pid:2 (two content models) are split across pages
+        row = lambda pid, cmodel: {'obj': 'info:fedora/%s' % pid, 'label': pid,
+                                   'cmodel': cmodel, 'modified': '2011-05-03T10:20:47.123Z'}
+        mockri = Mock(name='MockRIsearch')
+        mockri.sparql_query.side_effect = [
+            [row('pid:1', 'info:fedora/cmodel:a'), row('pid:2', 'info:fedora/cmodel:a')],
+            [row('pid:2', 'info:fedora/cmodel:b'), row('pid:3', 'info:fedora/cmodel:a')],
+            [],
+        ]
+        with patch.object(Repository, 'risearch', new=mockri):
+            pids = [info.pid for info in self.coll.members.iterate(page_size=2)]
+            self.assertEqual(['pid:1', 'pid:2', 'pid:3'], pids,
+                'each member should be returned once, even when split across pages')
+            self.assertEqual(3, mockri.sparql_query.call_count)
+            query = mockri.sparql_query.call_args[0][0]
+            self.assert_('LIMIT 2' in query and 'OFFSET 4' in query,
+                'each page of members should be retrieved with a separate query')
+
+    def test_index(self):
+        # mock out risearch call; one row per object content model
+        rows = [
+            {'obj': 'info:fedora/coll:1', 'label': 'Collection One',
+             'cmodel': CollectionObject.COLLECTION_CONTENT_MODEL,
+             'modified': '2011-05-03T10:20:47.123Z'},
+            {'obj': 'info:fedora/coll:1', 'label': 'Collection One',
+             'cmodel': 'info:fedora/emory-control:PublicAccess',
+             'modified': '2011-05-03T10:20:47.123Z'},
+            {'obj': 'info:fedora/coll:2', 'label': '',
+             'cmodel': CollectionObject.COLLECTION_CONTENT_MODEL,
+             'modified': '2011-05-04T08:00:00.000Z'},
+        ]
+        mockri = Mock(name='MockRIsearch')
+        mockri.sparql_query.return_value = rows
+        CollectionObject.invalidate_index()
+        with patch.object(Repository, 'risearch', new=mockri):
+            index = CollectionObject.index()
+            self.assertEqual(1, mockri.sparql_query.call_count,
+                'collection index should be loaded with a single risearch query')
+            self.assertEqual(2, len(index),
+                'collection index should include one item per collection object')
+            self.assert_(isinstance(index[0], ObjectInfo))
+            self.assertEqual('coll:1', index[0].pid)
+            self.assertEqual('Collection One', index[0].label)
+            self.assertEqual(2, len(index[0].content_models))
+            self.assertEqual(2011, index[0].modified.year)
+            self.assertEqual(None, index[1].label,
+                'empty label should be returned as None')
+
+            # second request should be served from the cache
+            CollectionObject.index()
+            self.assertEqual(1, mockri.sparql_query.call_count,
+                'collection index should be cached between calls')
+
+            # all() should use the cached index
+            colls = CollectionObject.all()
+            self.assertEqual(1, mockri.sparql_query.call_count,
+                'all should use the cached collection index')
+            self.assert_(isinstance(colls[0], CollectionObject))
+            self.assertEqual('coll:2', colls[1].pid)
+
+            # invalidating the index should force a new query
+            CollectionObject.invalidate_index()
+            CollectionObject.index()
+            self.assertEqual(2, mockri.sparql_query.call_count,
+                'collection index should be reloaded after invalidation')
+        CollectionObject.invalidate_index()
+
+    def test_index_stale(self):
+        stale_index = [ObjectInfo('coll:1', 'old label', (), None)]
+        mockri = Mock(name='MockRIsearch')
+        mockri.sparql_query.return_value = []
+        # cache an index that is past its timeout but within the stale window
+        timeout, stale_timeout = CollectionObject._index_timeouts()
+        cache.set(CollectionObject.INDEX_CACHE_KEY,
+                  (time.time() - timeout - 1, stale_index), timeout + stale_timeout)
+        with patch.object(Repository, 'risearch', new=mockri):
+            with patch.object(CollectionObject, '_refresh_index_in_background') as mockrefresh:
+                index = CollectionObject.index()
+                self.assertEqual(stale_index, index,
+                    'stale collection index should be returned without waiting for Fedora')
+                self.assertEqual(0, mockri.sparql_query.call_count)
+                mockrefresh.assert_called_once_with()
+        CollectionObject.invalidate_index()
+
+
+class CollectionArchiveTest(TestCase):
+    'Tests for :mod:`genrepo.collection.archive`'
+
+    def test_zip_stream(self):
+        for compress in (False, True):
+            data = ''.join(ZipStream([(u'caf\xe9.txt', datetime(2011, 5, 3, 10, 20),
+                                       ['abc'] * 1000, 3000),
+                                      ('empty', None, [], 0),
+                                      ('unknown', None, ['abc'], None)], compress=compress))
+            archive = zipfile.ZipFile(StringIO(data))
+            self.assertEqual(None, archive.testzip())
+            self.assertEqual([u'caf\xe9.txt', 'empty', 'unknown'], archive.namelist())
+            self.assertEqual('abc' * 1000, archive.read(u'caf\xe9.txt'))
+            self.assertEqual((2011, 5, 3, 10, 20, 0),
+                             archive.getinfo(u'caf\xe9.txt').date_time)
+            self.assertEqual('', archive.read('empty'))
+            self.assertEqual('abc', archive.read('unknown'))
+        self.assert_(len(data) < 3000, 'content should be compressed')
+
+    def test_zip64_local_header(self):
+        def local_header(data, offset):
+            # version, compressed and uncompressed sizes, and extra field
+            version, = struct.unpack('<H', data[offset + 4:offset + 6])
+            compressed, size, name_length, extra_length = \
+                struct.unpack('<LLHH', data[offset + 18:offset + 30])
+            extra_start = offset + 30 + name_length
+            return version, compressed, size, data[extra_start:extra_start + extra_length]
+
+        with patch('genrepo.collection.archive.ZIP64_LIMIT', new=100):
+            data = ''.join(ZipStream([('small', None, ['a' * 10], 10),
+                                      ('large', None, ['a' * 200], 200)]))
+        self.assertEqual((20, 0, 0, ''), local_header(data, 0),
+            'small entry should have a standard local header')
+        # small entry: header + name, content, 16-byte data descriptor
+        offset = 30 + len('small') + 10 + 16
+        self.assertEqual((45, 0xffffffff, 0xffffffff, struct.pack('<HHQQ', 1, 16, 0, 0)),
+                         local_header(data, offset),
+            'entry that may reach the zip64 limit should have a zip64 extra field')
+        descriptor = data[offset + 30 + len('large') + 20 + 200:][:24]
+        self.assertEqual((200, 200), struct.unpack('<QQ', descriptor[8:24]),
+            'zip64 entry should have zip64 sizes in its data descriptor')
+
+    def test_prefetch(self):
+        closed = []
+        class Content(list):
+            def close(self):
+                closed.append(self)
+
+        def load(item):
+            if item == 2:
+                raise ValueError('cannot load')
+            return item * 10, Content(['%d' % item] * 3)
+
+        results = [(item, result, error, content and ''.join(content))
+                   for item, result, error, content in prefetch(range(4), load, count=2)]
+        self.assertEqual([0, 1, 2, 3], [r[0] for r in results], 'items should be in order')
+        self.assertEqual((0, 0, None, '000'), results[0])
+        self.assertEqual((3, 30, None, '333'), results[3])
+        self.assertEqual(None, results[2][1])
+        self.assert_(isinstance(results[2][2], ValueError))
+        self.assertEqual(3, len(closed), 'all content should be closed')
+
+
+class AccessibleTest(TestCase):
+    'Tests for :meth:`genrepo.util.accessible`'
+
+    def test_accessible(self):
+        public = Mock(name='MockDigitalObject')
+        public.pid = 'pid:public'
+        restricted = Mock(name='MockDigitalObject')
+        restricted.pid = 'pid:restricted'
+        restricted.exists = True
+        missing = Mock(name='MockDigitalObject')
+        missing.pid = 'pid:missing'
+        missing.exists = False
 
-        
+        mockri = Mock(name='MockRIsearch')
+        mockri.sparql_query.return_value = [{'obj': 'info:fedora/pid:public'}]
+        with patch.object(Repository, 'risearch', new=mockri):
+            objs = list(accessible([public, restricted, missing]))
+            self.assertEqual([public, restricted], objs,
+                'accessible should return public and existing objects, in order')
+            self.assertEqual(1, mockri.sparql_query.call_count,
+                'public objects should be resolved with a single risearch query')
+            query = mockri.sparql_query.call_args[0][0]
+            self.assert_('info:fedora/pid:public' in query)
+            self.assert_('info:fedora/pid:missing' in query)
+
+        # objects are checked in batches
+        objs = []
+        for i in range(5):
+            obj = Mock(name='MockDigitalObject')
+            obj.pid = 'pid:%d' % i
+            obj.exists = False
+            objs.append(obj)
+        mockri.reset_mock()
+        mockri.sparql_query.return_value = []
+        with patch.object(Repository, 'risearch', new=mockri):
+            with patch.object(settings, 'ACCESSIBLE_BATCH_SIZE', new=2):
+                self.assertEqual([], list(accessible(objs)))
+                self.assertEqual(3, mockri.sparql_query.call_count,
+                    'risearch should be queried once per batch of objects')
+
+        # risearch errors should fall back to individual checks
+        err_resp = Mock()
+        err_resp.status = 500
+        err_resp.read.return_value = 'error message'
+        mockri.reset_mock()
+        mockri.sparql_query.side_effect = RequestFailed(err_resp)
+        with patch.object(Repository, 'risearch', new=mockri):
+            self.assertEqual([restricted], list(accessible([restricted, missing])))
+
+        # objects without an exists check are fetched, but returned as passed in
+        info = ObjectInfo('pid:restricted', 'Restricted', (), None)
+        mockri.reset_mock()
+        mockri.sparql_query.side_effect = None
+        mockri.sparql_query.return_value = []
+        with patch.object(Repository, 'risearch', new=mockri):
+            with patch.object(Repository, 'get_object', new=Mock(return_value=restricted)):
+                self.assertEqual([info], list(accessible([info])))
+
+
+class PooledServerConnectionTest(TestCase):
+    'Tests for :class:`genrepo.repository.PooledServerConnection`'
+
+    def test_pool(self):
+        pool = PooledServerConnection('http://localhost:8080/fedora/', maxsize=1)
+        pool._get_connection()
+        conn = pool.thread_local.connection
+        self.assertEqual(1, pool.get_stats()['created'])
+
+        # released connection should be reused
+        pool.release()
+        self.assertEqual(None, pool.thread_local.connection,
+            'released connection should no longer be held by the current thread')
+        self.assertEqual(1, pool.get_stats()['idle'])
+        pool._get_connection()
+        self.assertEqual(conn, pool.thread_local.connection,
+            'idle connection should be reused')
+        stats = pool.get_stats()
+        self.assertEqual(1, stats['created'])
+        self.assertEqual(1, stats['reused'])
+        self.assertEqual(0, stats['idle'])
+
+        # connections beyond the maximum pool size are closed
+        pool.release()
+        pool._get_connection()
+        pool._get_connection()
+        self.assertEqual(2, pool.get_stats()['created'])
+        pool._idle.append(conn)
+        pool.release()
+        self.assertEqual(1, pool.get_stats()['discarded'])
+        self.assertEqual(1, pool.get_stats()['idle'])
+
+
+class CurrentRepositoryTest(TestCase):
+
+    def setUp(self):
+        self.request = HttpRequest()
+        self.request.user = AnonymousUser()
+        self.request.session = {}
+
+    def test_request_scope(self):
+        repo = current_repository(self.request)
+        self.assert_(repo is current_repository(self.request),
+            'the same repository should be returned for the same request')
+        self.assertNotEqual(repo, current_repository(),
+            'a new repository should be returned outside of a request')
+
+        middleware = RepositoryMiddleware()
+        middleware.process_request(self.request)
+        self.assert_(repo is current_repository(),
+            'repository for the current request should be returned when no request is specified')
+        middleware.process_response(self.request, HttpResponse())
+        self.assertNotEqual(repo, current_repository(),
+            'request should no longer be current after the response is processed')
+
+    @patch.object(Repository, 'get_object')
+    def test_identity_map(self, mockget):
+        mockget.side_effect = lambda *args, **kwargs: Mock()
+        repo = current_repository(self.request)
+        obj = repo.get_object('coll:1', type=CollectionObject)
+        self.assert_(obj is repo.get_object('coll:1', type=CollectionObject),
+            'the same object should be returned when requested again')
+        self.assert_(obj is repo.get_object('info:fedora/coll:1', type=CollectionObject),
+            'the same object should be returned when requested by uri')
+        self.assertEqual(1, mockget.call_count,
+            'object should only be initialized once per request')
+        self.assert_(obj is not repo.get_object('coll:1'),
+            'objects requested with a different type should not be shared')
+        self.assert_(repo.get_object(type=CollectionObject) is not \
+                     repo.get_object(type=CollectionObject),
+            'new objects should never be shared')
+
+
+class CachedDigitalObjectTest(TestCase):
+    'Tests for :class:`genrepo.collection.models.CachedDigitalObject`'
+
+    profile = '''<objectProfile xmlns="http://www.fedora.info/definitions/1/0/access/" pid="cached:1">
+    <objLabel>Cached Collection</objLabel>
+    <objOwnerId>fedoraAdmin</objOwnerId>
+    <objCreateDate>2011-05-01T10:20:47.123Z</objCreateDate>
+    <objLastModDate>%s</objLastModDate>
+    <objState>A</objState>
+</objectProfile>'''
+    dc = '''<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"
+    xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>Cached Collection</dc:title>
+</oai_dc:dc>'''
+
+    def setUp(self):
+        self.api = Mock(ApiFacade)
+        self.api.opener = Mock()
+        self.api.opener.username = None
+        self.set_modified('2011-05-03T10:20:47.123Z')
+        self.api.getDatastreamDissemination.return_value = (self.dc, 'http://fedora/DC')
+        # datastream list is not relevant here
+        self.ds_list_patch = patch.object(CollectionObject, 'ds_list', new={'DC': Mock()})
+        self.ds_list_patch.start()
+        CollectionObject(self.api, 'cached:1').invalidate_cache()
+
+    def tearDown(self):
+        self.ds_list_patch.stop()
+        CollectionObject(self.api, 'cached:1').invalidate_cache()
+
+    def set_modified(self, date):
+        self.api.getObjectProfile.return_value = (self.profile % date, 'http://fedora/profile')
+
+    def test_cached_profile_and_dc(self):
+        obj = CollectionObject(self.api, 'cached:1')
+        self.assertTrue(obj.exists)
+        self.assertEqual('Cached Collection', obj.label)
+        self.assertEqual('Cached Collection', obj.dc.content.title)
+        self.assertEqual(1, self.api.getObjectProfile.call_count,
+            'object profile should be retrieved once for exists and label')
+        self.assertEqual(1, self.api.getDatastreamDissemination.call_count)
+
+        # a new instance should use cached profile and dc without validating
+        obj = CollectionObject(self.api, 'cached:1')
+        self.assertTrue(obj.exists)
+        self.assertEqual('Cached Collection', obj.label)
+        self.assertEqual('Cached Collection', obj.dc.content.title)
+        self.assertEqual(1, self.api.getObjectProfile.call_count,
+            'cached object profile should be used within the cache timeout')
+        self.assertEqual(1, self.api.getDatastreamDissemination.call_count,
+            'cached dc should be used within the cache timeout')
+        self.assertFalse(obj.dc.isModified(),
+            'cached dc should not be considered modified')
+
+        with patch.object(settings, 'OBJECT_CACHE_TIMEOUT', new=0):
+            # after the timeout, profile is checked; unchanged dc is reused
+            obj = CollectionObject(self.api, 'cached:1')
+            self.assertEqual('Cached Collection', obj.dc.content.title)
+            self.assertEqual(2, self.api.getObjectProfile.call_count,
+                'object profile should be validated after the cache timeout')
+            self.assertEqual(1, self.api.getDatastreamDissemination.call_count,
+                'cached dc should be used when object has not been modified')
+
+            # when the object has been modified, dc is retrieved again
+            self.set_modified('2011-05-04T10:20:47.123Z')
+            obj = CollectionObject(self.api, 'cached:1')
+            self.assertEqual('Cached Collection', obj.dc.content.title)
+            self.assertEqual(2, self.api.getDatastreamDissemination.call_count,
+                'dc should be retrieved when object has been modified')
+
+    def test_invalidate(self):
+        CollectionObject(self.api, 'cached:1').label
+        obj = CollectionObject(self.api, 'cached:1')
+        obj.invalidate_cache()
+        obj.label
+        self.assertEqual(2, self.api.getObjectProfile.call_count,
+            'object profile should be retrieved after the cache is invalidated')
+
+    def test_not_found(self):
+        err_resp = Mock()
+        err_resp.status = 404
+        err_resp.read.return_value = 'not found'
+        self.api.getObjectProfile.side_effect = RequestFailed(err_resp)
+        obj = CollectionObject(self.api, 'cached:1')
+        self.assertFalse(obj.exists)
+        self.assertEqual(None, cache.get(obj._cache_key()),
+            'nothing should be cached for an inaccessible object')
+
+    def test_save_unchanged(self):
+        obj = CollectionObject(self.api, 'cached:1')
+        obj.dc.content.title = 'Cached Collection'
+        obj.label = 'Cached Collection'
+        # empty elements added by a form are not a change
+        obj.dc.content.description_list.append('')
+        self.assertFalse(obj.is_modified())
+        self.assertTrue(obj.save('no changes'))
+        self.assertEqual(0, self.api.modifyDatastream.call_count,
+            'unchanged dc should not be saved')
+        self.assertEqual(0, self.api.modifyObject.call_count,
+            'unchanged label should not be saved')
+
+        # an actual change is detected
+        obj.dc.content.title = 'Renamed Collection'
+        self.assertTrue(obj.is_modified())
+        self.assertTrue(obj.dc.isModified())
+        obj.label = 'Renamed Collection'
+        self.assertTrue(obj.info_modified)
@@ -5,6 +5,8 @@ urlpatterns = patterns('genrepo.collection.views',
     url(r'^$', 'list_collections', name='list'),
     url(r'^new/$', 'create_collection', name='new'),
     url(r'^(?P<pid>[^/]+)/edit/$', 'edit_collection', name='edit'),
+    url(r'^(?P<pid>[^/]+)/download/$', 'download_collection', name='download'),
+    url(r'^(?P<pid>[^/]+)/export/$', 'export_metadata', name='export'),
     url(r'^(?P<pid>[^/]+)/$', 'view_collection', name='view'),
 )
 
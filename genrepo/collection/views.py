@@ -1,18 +1,26 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import permission_required
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse
-from django.http import Http404
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
 from django.template import RequestContext
+from django.views.decorators.http import condition
 
-from eulcore.django.fedora.server import Repository
 from eulcore.fedora.models import DigitalObjectSaveFailure
 from eulcore.django.auth.decorators import permission_required_with_403
 from eulcore.django.http import HttpResponseSeeOtherRedirect
 from eulcore.fedora.util import RequestFailed, PermissionDenied
 
+from genrepo.collection.archive import collection_archive
+from genrepo.collection.export import EXPORT_FORMATS, metadata_export
 from genrepo.collection.forms import CollectionDCEditForm
-from genrepo.collection.models import CollectionObject
-from genrepo.util import render_to_response, accessible
+from genrepo.collection.models import CollectionObject, collection_saved
+from genrepo.repository import Repository, current_repository
+from genrepo.util import render_to_response, accessible, page_etag, \
+     page_last_modified
 
 @permission_required_with_403('collection.add_collection')
 def create_collection(request):
@@ -44,7 +52,7 @@ def _create_or_edit_collection(request, pid=None):
     collection.
     """
     status_code = None
-    repo = Repository(request=request)
+    repo = current_repository(request)
     # get the object (if pid is not None), or create a new instance
     obj = repo.get_object(pid, type=CollectionObject)
    
@@ -60,6 +68,11 @@ def _create_or_edit_collection(request, pid=None):
             form.update_instance()
             # also use dc:title as object label
             obj.label = obj.dc.content.title
+            if not obj.is_modified():
+                # nothing to save; don't create a new version in Fedora
+                messages.info(request, 'No changes to save for collection <a href="%s"><b>%s</b></a>' % \
+                              (reverse('collection:edit', args=[obj.pid]), obj.pid))
+                return HttpResponseSeeOtherRedirect(reverse('site-index'))
             try:
                 if obj.exists:
                     action = 'updated'
@@ -71,6 +84,8 @@ def _create_or_edit_collection(request, pid=None):
                 # save message must be specified in order for Fedora
                 # to generate & store an ingest audit trail event
                 result = obj.save(save_msg)
+                # let anything caching collection information know about the change
+                collection_saved.send(sender=CollectionObject, pid=obj.pid)
                 messages.success(request,
             		'Successfully %s collection <a href="%s"><b>%s</b></a>' % \
                          (action, reverse('collection:edit', args=[obj.pid]), obj.pid))
@@ -98,27 +113,161 @@ def _create_or_edit_collection(request, pid=None):
         response.status_code = status_code
     return response
 
+def _collection_modified(request, pid):
+    # modification dates of a collection and its members, for conditional
+    # GET; None if the collection is not accessible
+    obj = current_repository(request).get_object(pid, type=CollectionObject)
+    try:
+        return obj.modified, obj.members_modified
+    except RequestFailed:
+        return None
+
+def _collection_etag(request, pid):
+    modified = _collection_modified(request, pid)
+    if modified is not None:
+        return page_etag(request, *modified)
+
+def _collection_last_modified(request, pid):
+    modified = _collection_modified(request, pid)
+    if modified is not None:
+        return page_last_modified(request, *modified)
+
+@condition(etag_func=_collection_etag, last_modified_func=_collection_last_modified)
 def view_collection(request, pid):
     '''view an existing
     :class:`~genrepo.collection.models.CollectionObject` identified by
-    pid.
+    pid, with a paginated listing of collection members as
+    :class:`~genrepo.collection.models.ObjectInfo`.
+
+    Members are paginated by page number (``page`` url parameter) or
+    by an opaque cursor (``cursor`` url parameter); browsing by cursor
+    avoids counting the collection members.  The number of members
+    per page may be specified with the ``per_page`` url parameter, up
+    to the configured ``COLLECTION_MEMBERS_MAX_PER_PAGE``.
+
+    Supports conditional GET: the ETag and Last-Modified date are based
+    on the modification dates of the collection and its members (see
+    :attr:`~genrepo.collection.models.CollectionObject.members_modified`),
+    so an unchanged page is answered with 304 Not Modified after only
+    an object profile lookup.  Member changes made through genrepo are
+    shown immediately; changes made directly in Fedora are shown within
+    ``COLLECTION_MEMBERS_MAX_AGE`` seconds.
     '''
-    repo = Repository(request=request)
+    repo = current_repository(request)
     obj = repo.get_object(pid, type=CollectionObject)
     # if the object does not exist or the current user doesn't have
     # permission to see that it exists, 404
     if not obj.exists:
         raise Http404
-    return render_to_response('collection/view.html',
-            {'obj': obj}, request=request)
+
+    per_page = _members_per_page(request.GET.get('per_page'))
+    members = obj.members
+    page = None
+    if 'cursor' in request.GET:
+        try:
+            offset, per_page = _decode_cursor(request.GET['cursor'])
+        except ValueError:
+            raise Http404
+        member_list = list(members[offset:offset + per_page])
+        next_offset = offset + per_page if len(member_list) == per_page else None
+    else:
+        paginator = Paginator(members, per_page)
+        try:
+            page = paginator.page(request.GET.get('page', 1))
+        except PageNotAnInteger:
+            page = paginator.page(1)
+        except EmptyPage:
+            page = paginator.page(paginator.num_pages)
+        member_list = page.object_list
+        next_offset = page.end_index() if page.has_next() else None
+    # the member list comes from the Resource Index, which may include
+    # objects the current user is not allowed to see
+    member_list = list(accessible(member_list))
+
+    context = {'obj': obj, 'members': member_list, 'page': page,
+               'per_page': per_page}
+    if next_offset is not None:
+        context['next_cursor'] = _encode_cursor(next_offset, per_page)
+    return render_to_response('collection/view.html', context, request=request)
+
+def download_collection(request, pid):
+    '''Download the master files of all members of a
+    :class:`~genrepo.collection.models.CollectionObject` as a single zip
+    file, with a ``manifest.csv`` of member metadata (see
+    :mod:`genrepo.collection.archive`).  The archive is generated as it
+    is sent, so the download starts immediately and the size of the
+    collection does not affect memory use.
+    '''
+    obj = current_repository(request).get_object(pid, type=CollectionObject)
+    if not obj.exists:
+        raise Http404
+    # members are read in background threads, with a repository that
+    # doesn't keep every member object for the rest of the request
+    repo = Repository(request=request)
+    response = HttpResponse(collection_archive(repo, obj), mimetype='application/zip')
+    response['Content-Disposition'] = 'attachment; filename=%s.zip' % \
+                                      obj.pid.replace(':', '_')
+    return response
+
+def export_metadata(request, pid):
+    '''Export the Dublin Core metadata of all members of a
+    :class:`~genrepo.collection.models.CollectionObject` as CSV or JSON
+    Lines, as specified by the ``format`` request parameter (default
+    CSV); see :mod:`genrepo.collection.export`.  Rows are sent as they
+    are retrieved, so the size of the collection does not affect memory
+    use.
+    '''
+    format = request.GET.get('format', 'csv')
+    if format not in EXPORT_FORMATS:
+        return HttpResponseBadRequest('Unsupported format: %s' % format,
+                                      mimetype='text/plain')
+    obj = current_repository(request).get_object(pid, type=CollectionObject)
+    if not obj.exists:
+        raise Http404
+    # member metadata is read in background threads, with a repository
+    # that doesn't keep every member object for the rest of the request
+    repo = Repository(request=request)
+    response = HttpResponse(metadata_export(repo, obj, format),
+                            mimetype=EXPORT_FORMATS[format])
+    response['Content-Disposition'] = 'attachment; filename=%s-metadata.%s' % \
+                                      (obj.pid.replace(':', '_'), format)
+    return response
+
+def _members_per_page(value=None):
+    # number of collection members to display per page, as requested
+    # (if valid), limited by configured maximum
+    per_page = getattr(settings, 'COLLECTION_MEMBERS_PER_PAGE', 50)
+    max_per_page = getattr(settings, 'COLLECTION_MEMBERS_MAX_PER_PAGE', 500)
+    try:
+        if value is not None and int(value) > 0:
+            per_page = int(value)
+    except ValueError:
+        pass
+    return min(per_page, max_per_page)
+
+def _encode_cursor(offset, per_page):
+    # opaque cursor identifying a page of collection members
+    return urlsafe_b64encode('%d:%d' % (offset, per_page))
+
+def _decode_cursor(cursor):
+    # returns offset and number per page; raises ValueError if invalid
+    try:
+        offset, per_page = urlsafe_b64decode(str(cursor)).split(':')
+        offset, per_page = int(offset), int(per_page)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor %r' % cursor)
+    if offset < 0 or per_page < 1:
+        raise ValueError('Invalid cursor %r' % cursor)
+    return offset, _members_per_page(per_page)
 
 def list_collections(request):
     '''list all collections in repository returns list of
-    :class:`~genrepo.collection.models.CollectionObject`
+    :class:`~genrepo.collection.models.ObjectInfo` for accessible
+    :class:`~genrepo.collection.models.CollectionObject` instances
     '''
-    colls = CollectionObject.all()
+    colls = CollectionObject.index()
     colls = list(accessible(colls))
-    colls.sort(key=lambda coll: coll.label.upper()) # sort based on label
+    colls.sort(key=lambda coll: (coll.label or '').upper()) # sort based on label
 
     return render_to_response('collection/list.html',
             {'colls': colls}, request=request)
@@ -0,0 +1,331 @@
+'''Batch editing of Dublin Core metadata for many
+:class:`~genrepo.file.models.FileObject` instances at once.
+
+A :class:`~genrepo.file.forms.MetadataPatch` describes changes to one
+or more Dublin Core fields: each field may be set (replacing any
+current values), have values appended, or have values removed.  A
+:class:`BatchEdit` applies a patch to a list of objects, saving them
+through a bounded pool of worker threads, and reports the result for
+each object.
+
+A :class:`MetadataImport` instead sets the fields of each object to
+the values listed for it in a CSV file (see :func:`read_metadata_csv`
+and the ``import_metadata`` management command), e.g. to load
+corrections made to a spreadsheet produced by a collection metadata
+export (see :mod:`genrepo.collection.export`).
+'''
+
+from collections import namedtuple
+import csv
+import hashlib
+import logging
+
+from django import forms
+from django.conf import settings
+from django.utils import simplejson
+
+from eulcore.fedora.models import DigitalObjectSaveFailure
+from eulcore.fedora.util import RequestFailed, PermissionDenied
+
+from genrepo.collection.models import DC_FIELDS
+from genrepo.file.bulk import pool_map
+from genrepo.file.forms import DublinCoreEditForm, EDITABLE_FIELDS, MetadataPatch
+from genrepo.file.manifest import MULTIVALUE_SEPARATOR, Checkpoint, read_csv
+from genrepo.file.models import FileObject
+
+logger = logging.getLogger(__name__)
+
+
+class BatchEditResult(namedtuple('BatchEditResult', 'pid changed error')):
+    '''Result of applying a :class:`~genrepo.file.forms.MetadataPatch`
+    to a single object: pid, whether the object was changed (unchanged
+    objects are not saved), and an error message (None if the edit
+    succeeded).'''
+    __slots__ = ()
+
+    @property
+    def success(self):
+        return self.error is None
+
+
+class BatchEdit(object):
+    '''Apply a :class:`~genrepo.file.forms.MetadataPatch` to many
+    :class:`~genrepo.file.models.FileObject` instances, saving them with
+    a bounded pool of worker threads.  An object whose title would be
+    removed is not changed.  Failures are recorded in the results and
+    do not stop the rest of the edit.
+
+    :param repo: :class:`~genrepo.repository.Repository`; shared by the
+        worker threads, so it should not keep an identity map
+    :param patch: :class:`~genrepo.file.forms.MetadataPatch`
+    :param workers: number of worker threads; defaults to the
+        configured ``BATCH_EDIT_WORKERS``
+    '''
+
+    log_message = 'updated metadata (batch edit)'
+
+    def __init__(self, repo, patch, workers=None):
+        self.repo = repo
+        self.patch = patch
+        if workers is None:
+            workers = getattr(settings, 'BATCH_EDIT_WORKERS', 4)
+        self.workers = max(1, workers)
+        self.results = []
+
+    def run(self, pids):
+        '''Edit all objects.
+
+        :param pids: iterable of object pids
+        :returns: list of :class:`BatchEditResult`, in the same order
+            as the pids
+        '''
+        self.results = pool_map(self.edit, pids, self.workers)
+        return self.results
+
+    def edit(self, pid):
+        '''Apply the patch to a single object and save it, if changed.
+
+        :returns: :class:`BatchEditResult`
+        '''
+        try:
+            obj = self.repo.get_object(pid, type=FileObject)
+            dc = obj.dc.content
+            if not self.patch.apply(dc):
+                return BatchEditResult(pid, False, None)
+            if not dc.title:
+                return BatchEditResult(pid, False, 'Title is required')
+            # also use dc:title as object label
+            obj.label = dc.title
+            obj.save(self.log_message)
+        except Exception as err:
+            return self._error_result(pid, err)
+        return BatchEditResult(pid, True, None)
+
+    def _error_result(self, pid, err):
+        # result for an object that could not be edited
+        if isinstance(err, (DigitalObjectSaveFailure, RequestFailed)):
+            if isinstance(err, PermissionDenied):
+                msg = 'You don\'t have permission to modify this object in the repository.'
+            elif getattr(err, 'code', None) == 404:
+                msg = 'Object not found.'
+            else:
+                msg = 'There was an error communicating with the repository: %s' % err
+            return BatchEditResult(pid, False, msg)
+        # one bad object should not stop the rest of the edit
+        logger.exception('Error editing metadata for %s' % pid)
+        return BatchEditResult(pid, False, unicode(err) or repr(err))
+
+    @property
+    def changed(self):
+        'number of objects changed'
+        return len([r for r in self.results if r.changed])
+
+    @property
+    def unchanged(self):
+        'number of objects that did not need to be changed'
+        return len([r for r in self.results if r.success and not r.changed])
+
+    @property
+    def failed(self):
+        'number of objects that could not be changed'
+        return len([r for r in self.results if not r.success])
+
+
+class MetadataImportError(Exception):
+    'Raised when a metadata CSV file can not be read.'
+    pass
+
+
+IGNORED_COLUMNS = tuple(field for field in DC_FIELDS if field not in EDITABLE_FIELDS) + \
+                  ('error',)
+'''columns allowed in a metadata CSV file but not imported: fields that
+are read-only on the edit form, and the error column of a metadata
+export'''
+
+
+class MetadataRow(namedtuple('MetadataRow', 'pid values')):
+    '''Dublin Core values for a single object from a metadata CSV file:
+    pid, and a dictionary of the values for each field listed in the
+    file, as a list (empty to remove all values).'''
+    __slots__ = ()
+
+    @property
+    def digest(self):
+        '''Checksum of the values, to identify this version of the row
+        (e.g., in a :class:`MetadataCheckpoint`).'''
+        return hashlib.sha1(simplejson.dumps(sorted(self.values.items()))).hexdigest()
+
+    def form_data(self, dc):
+        '''Data for a :class:`~genrepo.file.forms.DublinCoreEditForm`:
+        the values in this row, and the current values in the
+        specified Dublin Core for any fields not in the row.'''
+        data = {}
+        for name in DublinCoreEditForm.Meta.fields:
+            if name.endswith('_list'):
+                field = name[:-len('_list')]
+                values = self.values.get(field, None)
+                if values is None:
+                    values = list(getattr(dc, name))
+                data.update({'%s-TOTAL_FORMS' % name: len(values),
+                             '%s-INITIAL_FORMS' % name: 0,
+                             '%s-MAX_NUM_FORMS' % name: ''})
+                for i, value in enumerate(values):
+                    data['%s-%d-val' % (name, i)] = value
+            elif name in self.values:
+                data[name] = self.values[name][0] if self.values[name] else ''
+            else:
+                data[name] = getattr(dc, name) or ''
+        return data
+
+
+def read_metadata_csv(path):
+    '''Read a metadata CSV file: one row per object, with a ``pid``
+    column and a column for each Dublin Core field to be set, as
+    produced by a collection metadata export.  Multiple values for a
+    repeatable field are separated by ``|``; an empty value removes
+    all values for the field.  Columns for read-only fields (see
+    :data:`IGNORED_COLUMNS`) are ignored.
+
+    :returns: list of :class:`MetadataRow`
+    :raises: :class:`MetadataImportError` if the file is not valid
+    '''
+    try:
+        rows = read_csv(path)
+    except (IOError, ValueError, csv.Error) as err:
+        raise MetadataImportError('Could not read %s: %s' % (path, err))
+    if not rows:
+        raise MetadataImportError('%s contains no rows' % path)
+    columns = rows[0].keys()
+    if 'pid' not in columns:
+        raise MetadataImportError('%s has no pid column' % path)
+    unknown = [c for c in columns if c != 'pid' and c not in EDITABLE_FIELDS
+               and c not in IGNORED_COLUMNS]
+    if unknown:
+        raise MetadataImportError('%s has unknown column(s): %s' % \
+                                  (path, ', '.join(sorted(unknown))))
+    fields = [c for c in columns if c in EDITABLE_FIELDS]
+    if not fields:
+        raise MetadataImportError('%s has no Dublin Core fields to import' % path)
+
+    entries = []
+    seen = set()
+    for number, row in enumerate(rows):
+        pid = row['pid'].strip()
+        if not pid:
+            raise MetadataImportError('Row %d has no pid' % (number + 1))
+        if pid in seen:
+            raise MetadataImportError('Row %d: %s is listed more than once' % (number + 1, pid))
+        seen.add(pid)
+        values = {}
+        for field in fields:
+            value = row[field]
+            # only repeatable fields can have multiple values
+            if EDITABLE_FIELDS[field]:
+                value = value.split(MULTIVALUE_SEPARATOR)
+            else:
+                value = [value]
+            values[field] = [v.strip() for v in value if v.strip()]
+        entries.append(MetadataRow(pid, values))
+    return entries
+
+
+class MetadataCheckpoint(Checkpoint):
+    '''Record of the rows already imported from a metadata CSV file,
+    so that an interrupted or repeated import only updates the rest.
+    Rows are recorded by pid and :attr:`MetadataRow.digest`, so a row
+    that has been changed since it was imported is imported again.'''
+
+    def entry_record(self, entry, pid):
+        return {'pid': entry.pid, 'digest': entry.digest}
+
+    def record_key(self, record):
+        return (record['pid'], record['digest'])
+
+
+class MetadataImport(BatchEdit):
+    '''Set the Dublin Core of many
+    :class:`~genrepo.file.models.FileObject` instances to the values in
+    a metadata CSV file (see :func:`read_metadata_csv`).  Extends
+    :class:`BatchEdit`.
+
+    Each row is validated with
+    :class:`~genrepo.file.forms.DublinCoreEditForm`, as if the values
+    were entered on the edit form.  Objects whose metadata already
+    matches the row are not saved.  Each row imported (whether or not
+    the object needed to be changed) is recorded in an optional
+    checkpoint, and rows already recorded are skipped.
+
+    :param repo: :class:`~genrepo.repository.Repository`; shared by the
+        worker threads, so it should not keep an identity map
+    :param workers: number of worker threads; defaults to the
+        configured ``BATCH_EDIT_WORKERS``
+    :param checkpoint: optional :class:`MetadataCheckpoint`
+    '''
+
+    log_message = 'updated metadata (metadata import)'
+
+    def __init__(self, repo, workers=None, checkpoint=None):
+        super(MetadataImport, self).__init__(repo, None, workers)
+        self.checkpoint = checkpoint
+        self.skipped = 0
+
+    def run(self, rows):
+        '''Import all rows that are not already recorded in the
+        checkpoint.
+
+        :param rows: list of :class:`MetadataRow`
+        :returns: list of :class:`BatchEditResult`, in the same order
+            as the rows imported
+        '''
+        if self.checkpoint is not None:
+            remaining = [row for row in rows if row not in self.checkpoint]
+            self.skipped = len(rows) - len(remaining)
+            rows = remaining
+        return super(MetadataImport, self).run(rows)
+
+    def edit(self, row):
+        '''Import a single :class:`MetadataRow`, saving the object if
+        anything has changed.
+
+        :returns: :class:`BatchEditResult`
+        '''
+        try:
+            obj = self.repo.get_object(row.pid, type=FileObject)
+            dc = obj.dc.content
+            form = DublinCoreEditForm(row.form_data(dc))
+            if not form.is_valid():
+                return BatchEditResult(row.pid, False, _form_errors(form))
+            # set the fields in the row to the cleaned values from the form
+            cleaned = form.update_instance()
+            changes = {}
+            for field in row.values:
+                if EDITABLE_FIELDS[field]:
+                    values = list(getattr(cleaned, '%s_list' % field))
+                else:
+                    values = [getattr(cleaned, field)] if getattr(cleaned, field) else []
+                changes[field] = {'set': values}
+            MetadataPatch(changes).apply(dc)
+            # also use dc:title as object label
+            obj.label = dc.title
+            changed = obj.is_modified()
+            if changed:
+                obj.save(self.log_message)
+        except forms.ValidationError as err:
+            return BatchEditResult(row.pid, False, '; '.join(err.messages))
+        except Exception as err:
+            return self._error_result(row.pid, err)
+
+        if self.checkpoint is not None:
+            self.checkpoint.record(row, row.pid)
+        return BatchEditResult(row.pid, changed, None)
+
+
+def _form_errors(form):
+    # summary of the errors on a DublinCoreEditForm and its formsets
+    errors = ['%s: %s' % (field, ' '.join(messages))
+              for field, messages in form.errors.iteritems()]
+    for name, formset in form.formsets.iteritems():
+        for subform_errors in formset.errors:
+            errors.extend('%s: %s' % (name[:-len('_list')], ' '.join(messages))
+                          for messages in subform_errors.itervalues())
+    return '; '.join(errors) or 'Invalid metadata'
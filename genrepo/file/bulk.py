@@ -0,0 +1,295 @@
+'''Bulk ingest of many files into a single collection.
+
+Files are read from a zip or tar archive, or from a directory on the
+server, one entry at a time (archives are never extracted as a whole),
+and ingested as new :class:`~genrepo.file.models.FileObject` instances
+by a bounded pool of worker threads; see :class:`BulkIngest`.
+'''
+
+from collections import deque, namedtuple
+import logging
+import mimetypes
+import os
+import Queue
+import shutil
+import sys
+import tarfile
+from tempfile import SpooledTemporaryFile
+import threading
+import time
+import zipfile
+
+from django.conf import settings
+
+from genrepo.file.models import ingest_local_file
+from genrepo.repository import release_connections
+
+logger = logging.getLogger(__name__)
+
+# tar entries are read in sequence and held for the worker threads in
+# temporary files; entries up to this size are kept in memory
+SPOOL_MAX_SIZE = 10 * 1024 * 1024
+
+
+class ArchiveEntry(namedtuple('ArchiveEntry', 'name size open')):
+    '''A single file to be ingested from an archive or directory:
+    name (path within the archive or directory), size in bytes, and a
+    function that opens the file content for reading.'''
+    __slots__ = ()
+
+
+def archive_entries(path):
+    '''Generate :class:`ArchiveEntry` for each file in a zip archive,
+    tar archive (optionally compressed), or directory.
+
+    Zip archive and directory entries are opened as they are needed.
+    Tar archives can only be read in sequence, so each tar entry is
+    copied to a temporary file when it is reached.
+
+    :param path: path to an archive file or directory
+    :raises: :class:`ValueError` if the path is not a directory or a
+        zip or tar archive
+    '''
+    if os.path.isdir(path):
+        return _directory_entries(path)
+    elif zipfile.is_zipfile(path):
+        return _zip_entries(path)
+    elif tarfile.is_tarfile(path):
+        return _tar_entries(path)
+    raise ValueError('%s is not a directory or a zip or tar archive' % path)
+
+def _directory_entries(path):
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            full_path = os.path.join(dirpath, filename)
+            yield ArchiveEntry(os.path.relpath(full_path, path),
+                               os.path.getsize(full_path),
+                               lambda full_path=full_path: open(full_path, 'rb'))
+
+def _zip_entries(path):
+    # each entry is opened through a separate ZipFile, so that entries
+    # can be read by several threads at once
+    archive = zipfile.ZipFile(path)
+    try:
+        members = archive.infolist()
+    finally:
+        archive.close()
+    for info in members:
+        if info.filename.endswith('/'):   # directory
+            continue
+        yield ArchiveEntry(info.filename, info.file_size,
+                           lambda name=info.filename: _open_zip_member(path, name))
+
+def _open_zip_member(path, name):
+    return zipfile.ZipFile(path).open(name)
+
+def _tar_entries(path):
+    archive = tarfile.open(path, 'r|*')
+    try:
+        for member in archive:
+            if not member.isfile():
+                continue
+            spool = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            shutil.copyfileobj(archive.extractfile(member), spool)
+            spool.seek(0)
+            yield ArchiveEntry(member.name, member.size, lambda spool=spool: spool)
+    finally:
+        archive.close()
+
+
+class _PoolTask(object):
+    # a single item handed to a pool worker thread, and its result
+    def __init__(self, item):
+        self.item = item
+        self.result = self.error = None
+        self.done = threading.Event()
+
+    def get(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+
+def pool_imap(func, items, workers):
+    '''Call a function for each of a series of items using a bounded
+    pool of worker threads, and generate the results in the same order
+    as the items, as soon as each is available.  At most ``workers * 2``
+    items are taken from ``items`` ahead of the result being consumed,
+    so a long series of items can be processed in constant memory.  An
+    exception raised by the function is raised when its result is
+    reached.  Closing the generator discards any items not yet started;
+    each worker returns its Fedora connections to the pool when it
+    finishes.
+
+    :param func: callable that takes a single item
+    :param items: iterable of items
+    :param workers: number of worker threads
+    :returns: generator of results
+    '''
+    tasks = Queue.Queue()
+    pending = deque()
+    stopped = threading.Event()
+
+    def work():
+        try:
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+                if not stopped.isSet():
+                    try:
+                        task.result = func(task.item)
+                    except Exception:
+                        task.error = sys.exc_info()
+                task.done.set()
+        finally:
+            # worker threads don't finish a request, so return their
+            # Fedora connections explicitly
+            release_connections()
+
+    threads = [threading.Thread(target=work, name='worker-%d' % i)
+               for i in range(workers)]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    try:
+        for item in items:
+            task = _PoolTask(item)
+            pending.append(task)
+            tasks.put(task)
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        stopped.set()
+        for thread in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+def pool_map(func, items, workers):
+    '''Call a function for each of a series of items using a bounded
+    pool of worker threads (see :func:`pool_imap`), and return the
+    results in the same order as the items.  The function should handle
+    its own errors.
+
+    :param func: callable that takes a single item
+    :param items: iterable of items
+    :param workers: number of worker threads
+    :returns: list of results
+    '''
+    return list(pool_imap(func, items, workers))
+
+
+class BulkIngestResult(namedtuple('BulkIngestResult', 'name size pid error warning')):
+    '''Result of ingesting a single :class:`ArchiveEntry`: entry name
+    and size, pid of the new object (None if ingest failed), an error
+    message (None if ingest succeeded), and an optional warning about
+    a successful ingest (e.g., the file was a duplicate).'''
+    __slots__ = ()
+
+    def __new__(cls, name, size, pid, error, warning=None):
+        return super(BulkIngestResult, cls).__new__(cls, name, size, pid, error, warning)
+
+    @property
+    def success(self):
+        return self.error is None
+
+
+class BulkIngest(object):
+    '''Ingest files into a collection using a bounded pool of worker
+    threads.  Each file is uploaded to Fedora (see
+    :func:`~genrepo.file.upload.upload_file`) and ingested as a new
+    :class:`~genrepo.file.models.FileObject` that is a member of the
+    collection (see :func:`~genrepo.file.models.ingest_local_file`).
+    Failures are recorded in the results and do not stop the rest of
+    the ingest.
+
+    :param repo: :class:`~genrepo.repository.Repository` to ingest
+        into; shared by the worker threads
+    :param collection_uri: URI of the collection the new objects
+        should belong to
+    :param workers: number of worker threads; defaults to the
+        configured ``BULK_INGEST_WORKERS``
+    '''
+
+    log_message = 'ingesting user content (bulk ingest)'
+
+    def __init__(self, repo, collection_uri, workers=None):
+        self.repo = repo
+        self.collection_uri = collection_uri
+        if workers is None:
+            workers = getattr(settings, 'BULK_INGEST_WORKERS', 4)
+        self.workers = max(1, workers)
+        self.results = []
+        self.elapsed = None
+
+    def run(self, entries):
+        '''Ingest all entries.  Entries are handed to the worker threads
+        as they become available, and at most a few more entries than
+        there are workers are open at any time.
+
+        :param entries: iterable of :class:`ArchiveEntry`, e.g. from
+            :func:`archive_entries`
+        :returns: list of :class:`BulkIngestResult`, in the same order
+            as the entries
+        '''
+        start = time.time()
+        try:
+            self.results = pool_map(self.ingest_entry, entries, self.workers)
+        finally:
+            self.elapsed = time.time() - start
+        return self.results
+
+    def ingest_entry(self, entry):
+        '''Ingest a single :class:`ArchiveEntry` as a new
+        :class:`~genrepo.file.models.FileObject`.
+
+        :returns: :class:`BulkIngestResult`
+        '''
+        filename = os.path.basename(entry.name)
+        try:
+            content = entry.open()
+            try:
+                obj = ingest_local_file(self.repo, content, filename, self.collection_uri,
+                                        self.log_message, mimetypes.guess_type(filename)[0])
+            finally:
+                content.close()
+        except Exception as err:
+            # one bad file should not stop the rest of the ingest
+            logger.exception('Error ingesting %s' % entry.name)
+            return BulkIngestResult(entry.name, entry.size, None, unicode(err) or repr(err))
+        warning = None
+        if obj.duplicate:
+            warning = 'duplicate of %s' % obj.pid
+        return BulkIngestResult(entry.name, entry.size, obj.pid, None, warning)
+
+    @property
+    def succeeded(self):
+        'number of files ingested successfully'
+        return len([r for r in self.results if r.success])
+
+    @property
+    def failed(self):
+        'number of files that could not be ingested'
+        return len(self.results) - self.succeeded
+
+    @property
+    def total_size(self):
+        'total size in bytes of the files ingested successfully'
+        return sum(r.size for r in self.results if r.success)
+
+    @property
+    def files_per_second(self):
+        if not self.elapsed:
+            return None
+        return self.succeeded / self.elapsed
+
+    @property
+    def bytes_per_second(self):
+        if not self.elapsed:
+            return None
+        return self.total_size / self.elapsed
@@ -0,0 +1,430 @@
+'''Streaming download of file content, with support for HTTP range
+requests.
+
+Datastream content is read from Fedora and passed on to the client
+one fixed-size chunk at a time (see :class:`DatastreamStream`), so the
+memory used by a download does not depend on the size of the file.
+When a client requests part of a file (e.g., to seek within audio or
+video, or to resume an interrupted download), only the requested byte
+range is read from Fedora; see :func:`parse_range`.
+
+If ``MASTER_CACHE_DIR`` is configured, downloaded content is also kept
+in a size-limited local disk cache (see :class:`DatastreamCache`), so
+that each version of a file is only read from Fedora once.  Cached
+files can be sent by the web server itself (e.g., with Apache
+mod_xsendfile) instead of passing through Python; see ``XSENDFILE``.
+'''
+
+from collections import namedtuple
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from urllib import quote
+
+from django.conf import settings
+
+from eulcore.fedora.util import RequestFailed
+
+from genrepo.repository import direct_connection
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 65536
+'number of bytes read from Fedora and sent to the client at a time'
+
+MAX_RANGES = 10
+'''maximum number of ranges honored in a single request; requests for
+more ranges are answered with the full content'''
+
+
+class ByteRange(namedtuple('ByteRange', 'start end')):
+    '''A range of bytes within a file: offset of the first and last
+    byte (inclusive), as in an HTTP Range header.'''
+    __slots__ = ()
+
+    @property
+    def length(self):
+        return self.end - self.start + 1
+
+    def content_range(self, size):
+        'Value for a Content-Range header for this range of a file'
+        return 'bytes %d-%d/%d' % (self.start, self.end, size)
+
+
+_range_spec = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+def parse_range(header, size):
+    '''Parse the value of an HTTP Range header for a file of the
+    specified size.  Ranges that extend past the end of the file are
+    shortened, and ranges that overlap or are adjacent are combined.
+
+    :param header: Range header value, e.g. ``bytes=0-499``
+    :param size: size of the file in bytes
+    :returns: list of :class:`ByteRange`, in order; an empty list if
+        none of the ranges can be satisfied; or None if the header is
+        not valid (in which case it should be ignored)
+    '''
+    if not header.startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header[len('bytes='):].split(','):
+        match = _range_spec.match(spec)
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if first == '':
+            # suffix range: last N bytes of the file
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            end = min(int(last), size - 1) if last else size - 1
+        # ranges that start past the end of the file can not be
+        # satisfied, but do not invalidate the rest of the header
+        if start < size and end >= start:
+            ranges.append(ByteRange(start, end))
+
+    ranges.sort()
+    combined = []
+    for byte_range in ranges:
+        if combined and byte_range.start <= combined[-1].end + 1:
+            last = combined.pop()
+            byte_range = ByteRange(last.start, max(last.end, byte_range.end))
+        combined.append(byte_range)
+    return combined
+
+
+class DatastreamStream(object):
+    '''Iterable content of a datastream, read from Fedora in chunks
+    of :data:`CHUNK_SIZE` bytes, for use as the content of a streaming
+    :class:`~django.http.HttpResponse`.  The request to Fedora is sent
+    when the stream is created, so that errors are raised before a
+    response is started.  The connection is closed when all content
+    has been read or when :meth:`close` is called (Django closes the
+    response content when the response is finished).
+
+    If only part of the datastream is requested, Fedora is asked for
+    just that byte range; if Fedora returns the full content instead,
+    content before the range is read and discarded.
+
+    :param repo: :class:`~genrepo.repository.Repository`, for the
+        Fedora url and credentials
+    :param pid: object pid
+    :param dsid: datastream id
+    :param byte_range: optional :class:`ByteRange`
+    :raises: :class:`~eulcore.fedora.util.RequestFailed` if the
+        content can not be retrieved
+    '''
+    def __init__(self, repo, pid, dsid, byte_range=None):
+        self.byte_range = byte_range
+        self.connection, path, headers = direct_connection(repo)
+        if byte_range is not None:
+            headers['Range'] = 'bytes=%d-%d' % (byte_range.start, byte_range.end)
+        try:
+            self.connection.request('GET', '%sobjects/%s/datastreams/%s/content' % \
+                                    (path, quote(pid), quote(dsid)), headers=headers)
+            self.response = self.connection.getresponse()
+            if self.response.status >= 400:
+                raise RequestFailed(self.response)
+        except:
+            self.close()
+            raise
+
+    def __iter__(self):
+        try:
+            remaining = None
+            if self.byte_range is not None:
+                remaining = self.byte_range.length
+                if self.response.status != 206:
+                    self._skip(self.byte_range.start)
+            while remaining is None or remaining > 0:
+                size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+                data = self.response.read(size)
+                if not data:
+                    break
+                if remaining is not None:
+                    remaining -= len(data)
+                yield data
+        finally:
+            self.close()
+
+    def _skip(self, count):
+        # discard content that precedes the requested range
+        while count > 0:
+            data = self.response.read(min(CHUNK_SIZE, count))
+            if not data:
+                break
+            count -= len(data)
+
+    def close(self):
+        self.connection.close()
+
+
+class LocalFileStream(object):
+    '''Iterable content of a local file (e.g., a file in the
+    :class:`DatastreamCache`), read in chunks of :data:`CHUNK_SIZE`
+    bytes; the equivalent of :class:`DatastreamStream` for content that
+    is already on disk.
+
+    :param path: path to the file
+    :param byte_range: optional :class:`ByteRange`
+    '''
+    def __init__(self, path, byte_range=None):
+        self.file = open(path, 'rb')
+        self.byte_range = byte_range
+
+    def __iter__(self):
+        try:
+            remaining = None
+            if self.byte_range is not None:
+                self.file.seek(self.byte_range.start)
+                remaining = self.byte_range.length
+            while remaining is None or remaining > 0:
+                size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+                data = self.file.read(size)
+                if not data:
+                    break
+                if remaining is not None:
+                    remaining -= len(data)
+                yield data
+        finally:
+            self.close()
+
+    def close(self):
+        self.file.close()
+
+
+class MultipartRangeStream(object):
+    '''Iterable ``multipart/byteranges`` content for a request for
+    several ranges of a datastream; each range is opened as a separate
+    stream (e.g., a :class:`DatastreamStream` or
+    :class:`LocalFileStream`) as it is reached.
+
+    :param open_range: callable that takes a :class:`ByteRange` and
+        returns an iterable stream of the content in that range
+    :param ranges: list of :class:`ByteRange`
+    :param size: size of the datastream in bytes
+    :param mimetype: mimetype of the datastream
+    :param boundary: multipart boundary string
+    '''
+    def __init__(self, open_range, ranges, size, mimetype, boundary):
+        self.open_range = open_range
+        self.ranges = ranges
+        self.size = size
+        self.mimetype = mimetype
+        self.boundary = boundary
+        self.current = None
+
+    def __iter__(self):
+        try:
+            for byte_range in self.ranges:
+                yield '\r\n--%s\r\nContent-Type: %s\r\nContent-Range: %s\r\n\r\n' % \
+                      (self.boundary, self.mimetype, byte_range.content_range(self.size))
+                self.current = self.open_range(byte_range)
+                for data in self.current:
+                    yield data
+            yield '\r\n--%s--\r\n' % self.boundary
+        finally:
+            self.close()
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+
+
+class DatastreamCache(object):
+    '''Size-limited cache of datastream content on local disk, keyed
+    on pid, datastream id, and datastream version, so a cached file
+    never needs to be checked against Fedora for changes.  When the
+    cache grows larger than its maximum size, the least recently used
+    files are removed until it is back under :attr:`EVICT_TO` of the
+    maximum; the modification time of a cached file is updated each
+    time it is used.  The total size of the cache is recorded in a file
+    in the cache directory (updated under a lock), so the cache
+    directory is only scanned when files need to be removed.
+
+    Files are added to the cache as they are downloaded (see
+    :meth:`caching_stream`); a file only becomes available once it has
+    been downloaded completely.
+
+    :param directory: cache directory; defaults to the configured
+        ``MASTER_CACHE_DIR`` (if not set, the cache is disabled)
+    :param max_size: maximum total size of cached files in bytes;
+        defaults to the configured ``MASTER_CACHE_MAX_SIZE``
+    '''
+
+    TEMP_PREFIX = 'tmp-'
+    SIZE_FILE = 'cache-size'
+    EVICT_TO = 0.9
+    'fraction of the maximum size the cache is reduced to when it is full'
+
+    def __init__(self, directory=None, max_size=None):
+        if directory is None:
+            directory = getattr(settings, 'MASTER_CACHE_DIR', None)
+        if max_size is None:
+            max_size = getattr(settings, 'MASTER_CACHE_MAX_SIZE', 10 * 1024 ** 3)
+        self.directory = directory
+        self.max_size = max_size
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def path(self, pid, dsid, version):
+        '''Path where a datastream version is (or would be) cached.'''
+        key = hashlib.sha1('%s/%s/%s' % (pid, dsid, version)).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, pid, dsid, version, size=None):
+        '''Get the path to a cached datastream version, and mark it as
+        recently used.
+
+        :param size: expected size of the content; if specified, a
+            cached file of any other size is ignored
+        :returns: path, or None if the content is not cached
+        '''
+        if not self.enabled or not version:
+            return None
+        path = self.path(pid, dsid, version)
+        try:
+            if size and os.path.getsize(path) != size:
+                return None
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def caching_stream(self, stream, pid, dsid, version, size):
+        '''Wrap a stream of datastream content (e.g., a
+        :class:`DatastreamStream` for the full content) so that the
+        content is added to the cache as it is read.  Content is only
+        cached if the cache is enabled, the size is known and within the
+        maximum cache size, and the stream is read to the end.
+
+        :returns: iterable stream
+        '''
+        if not self.enabled or not version or not size or size > self.max_size:
+            return stream
+        return _CachingStream(self, stream, self.path(pid, dsid, version), size)
+
+    def added(self, size):
+        '''Record that a file of the specified size has been added to the
+        cache, and remove the least recently used files if the cache is
+        now larger than its maximum size.'''
+        self._update_size(size)
+
+    def evict(self):
+        '''Remove the least recently used files until the total size of
+        the cache is within :attr:`EVICT_TO` of the maximum size, and
+        record the new total size.'''
+        self._update_size(None)
+
+    def _update_size(self, added):
+        # update the recorded total size under an exclusive lock, so that
+        # concurrent downloads (in any process) don't lose updates; the
+        # cache is scanned if it needs eviction or the total is unknown
+        fd = os.open(os.path.join(self.directory, self.SIZE_FILE), os.O_RDWR | os.O_CREAT)
+        with os.fdopen(fd, 'r+') as sizefile:
+            fcntl.flock(sizefile.fileno(), fcntl.LOCK_EX)
+            try:
+                total = int(sizefile.read())
+            except ValueError:
+                total = None
+            if total is not None and added is not None:
+                total += added
+            if total is None or added is None or total > self.max_size:
+                total = self._evict_files()
+            sizefile.seek(0)
+            sizefile.truncate()
+            sizefile.write('%d' % total)
+
+    def _evict_files(self):
+        # scan the cache and remove least recently used files if it is
+        # over the maximum size; returns the remaining total size
+        files = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.startswith(self.TEMP_PREFIX) or \
+                       (filename == self.SIZE_FILE and dirpath == self.directory):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                files.append((info.st_mtime, info.st_size, path))
+                total += info.st_size
+        if total <= self.max_size:
+            return total
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.max_size * self.EVICT_TO:
+                break
+            try:
+                os.remove(path)
+                logger.debug('Removed %s from datastream cache' % path)
+            except OSError:
+                continue
+            total -= size
+        return total
+
+
+class _CachingStream(object):
+    # stream wrapper that writes content to a temporary file in the cache
+    # directory as it is read, and moves it into place once complete
+    def __init__(self, cache, stream, path, size):
+        self.cache = cache
+        self.stream = stream
+        self.path = path
+        self.size = size
+        self.tmpfile = None
+        try:
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, self.tmppath = tempfile.mkstemp(prefix=cache.TEMP_PREFIX, dir=directory)
+            self.tmpfile = os.fdopen(fd, 'wb')
+        except (OSError, IOError) as err:
+            logger.warning('Could not cache %s: %s' % (path, err))
+
+    def __iter__(self):
+        written = 0
+        try:
+            for data in self.stream:
+                if self.tmpfile is not None:
+                    self._write(data)
+                    written += len(data)
+                yield data
+            if self.tmpfile is not None and written == self.size:
+                self.tmpfile.close()
+                self.tmpfile = None
+                os.rename(self.tmppath, self.path)
+                self.cache.added(self.size)
+        finally:
+            self.close()
+
+    def _write(self, data):
+        try:
+            self.tmpfile.write(data)
+        except IOError as err:
+            # e.g., disk full; the download itself should continue
+            logger.warning('Could not cache %s: %s' % (self.path, err))
+            self._discard()
+
+    def _discard(self):
+        if self.tmpfile is not None:
+            self.tmpfile.close()
+            self.tmpfile = None
+            try:
+                os.remove(self.tmppath)
+            except OSError:
+                pass
+
+    def close(self):
+        self._discard()
+        self.stream.close()
@@ -1,25 +1,138 @@
+import os
+import tarfile
+import time
+import zipfile
+
 from django import forms #import FileField, Form, TextInput, Textarea, ChoiceField
+from django.conf import settings
+from django.core.cache import cache
 
 from eulcore.django.forms.fields import DynamicChoiceField
 from eulcore.django.forms import XmlObjectForm
 from eulcore.xmlmap.dc import DublinCore
 
-from genrepo.collection.models import CollectionObject
+from genrepo.collection.models import CollectionObject, collection_saved
+from genrepo.repository import current_repository
 from genrepo.util import accessible
 
+COLLECTION_OPTIONS_CACHE_KEY = 'genrepo-collection-options'
+# changed whenever cached collection options should be discarded
+COLLECTION_OPTIONS_GENERATION_KEY = 'genrepo-collection-options-generation'
+
+def _collection_options_cache_key():
+    # accessible collections depend on the fedora credentials in use,
+    # so collection options are cached separately for each user
+    generation = cache.get(COLLECTION_OPTIONS_GENERATION_KEY, 0)
+    return '%s-%s-%s' % (COLLECTION_OPTIONS_CACHE_KEY, generation,
+                         current_repository().fedora_user or '')
+
 def _collection_options():
-    collections = list(accessible(CollectionObject.all()))
-    options = [('', '')] + \
-        [ ('info:fedora/' + c.pid, c.label or c.pid)
-          for c in collections ]
+    # collection choices are cached briefly, since they are needed to
+    # display the ingest form and again to validate it
+    cache_key = _collection_options_cache_key()
+    options = cache.get(cache_key)
+    if options is None:
+        collections = list(accessible(CollectionObject.index()))
+        options = [('', '')] + \
+            [ ('info:fedora/' + c.pid, c.label or c.pid)
+              for c in collections ]
+        cache.set(cache_key, options,
+                  getattr(settings, 'COLLECTION_OPTIONS_TIMEOUT', 60))
     return options
 
+def _invalidate_collection_options(sender, **kwargs):
+    # options for all users are discarded by starting a new generation
+    cache.set(COLLECTION_OPTIONS_GENERATION_KEY, '%f' % time.time())
+collection_saved.connect(_invalidate_collection_options, sender=CollectionObject)
+
+
+class CollectionChoiceField(DynamicChoiceField):
+    '''Customized version of
+    :class:`~eulcore.django.forms.fields.DynamicChoiceField` for
+    selecting a collection by URI.  When the collection choices are
+    not cached, a submitted value is validated by checking only the
+    selected collection, rather than generating all choices.'''
+
+    def valid_value(self, value):
+        options = cache.get(_collection_options_cache_key())
+        if options is not None:
+            return value in dict(options)
+
+        if not value.startswith('info:fedora/'):
+            return False
+        pid = value[len('info:fedora/'):]
+        collections = [c for c in CollectionObject.index() if c.pid == pid]
+        return len(list(accessible(collections))) == 1
+
+
 class IngestForm(forms.Form):
     """Form to ingest new files into the repository."""
-    collection = DynamicChoiceField(choices=_collection_options, required=True,
+    collection = CollectionChoiceField(choices=_collection_options, required=True,
         help_text="Add the new item to this collection.")
     file = forms.FileField()
 
+    def clean_file(self):
+        file = self.cleaned_data.get('file')
+        # files streamed to Fedora as they are received (see
+        # genrepo.file.upload.FedoraUploadHandler) may have failed partway
+        error = getattr(file, 'error', None)
+        if error:
+            raise forms.ValidationError('Could not upload %s to the repository: %s' % \
+                                        (file.name, error))
+        return file
+
+class BulkIngestForm(forms.Form):
+    """Form to ingest all the files in an archive, or in a directory on
+    the server, into a collection."""
+    collection = CollectionChoiceField(choices=_collection_options, required=True,
+        help_text="Add the new items to this collection.")
+    archive = forms.FileField(required=False,
+        help_text="zip or tar archive of files to ingest")
+    directory = forms.CharField(required=False,
+        help_text="or, a directory of files on the server to ingest")
+
+    def clean_directory(self):
+        directory = self.cleaned_data.get('directory')
+        if not directory:
+            return directory
+        root = getattr(settings, 'BULK_INGEST_ROOT', None)
+        if not root:
+            raise forms.ValidationError('Ingesting from a server directory is not enabled.')
+        # only allow directories within the configured root
+        root = os.path.realpath(root)
+        path = os.path.realpath(os.path.join(root, directory))
+        if not path.startswith(root + os.sep) or not os.path.isdir(path):
+            raise forms.ValidationError('%s is not a directory available for ingest.' % directory)
+        return path
+
+    def clean(self):
+        archive = self.cleaned_data.get('archive')
+        directory = self.cleaned_data.get('directory')
+        if archive and directory:
+            raise forms.ValidationError('Please specify either an archive or a directory, not both.')
+        if archive:
+            path = archive.temporary_file_path()
+            if not (zipfile.is_zipfile(path) or tarfile.is_tarfile(path)):
+                raise forms.ValidationError('%s is not a zip or tar archive.' % archive.name)
+            self.cleaned_data['path'] = path
+        elif directory:
+            self.cleaned_data['path'] = directory
+        elif not self._errors:
+            raise forms.ValidationError('Please specify an archive or a directory to ingest.')
+        return self.cleaned_data
+
+
+class UploadSessionForm(forms.Form):
+    """Form to start a resumable upload; see
+    :class:`~genrepo.file.models.UploadSession`."""
+    filename = forms.CharField(max_length=255)
+    size = forms.IntegerField(min_value=0)
+
+class UploadCompleteForm(forms.Form):
+    """Form to ingest the file from a completed resumable upload."""
+    collection = CollectionChoiceField(choices=_collection_options, required=True)
+
+
 class ReadOnlyInput(forms.TextInput):
     '''Customized version of :class:`~django.forms.TextInput` to act as
     a read-only form field.'''
@@ -59,3 +172,168 @@ class DublinCoreEditForm(XmlObjectForm):
             'format':  ReadOnlyInput,
             'identifier': ReadOnlyInput,
         }
+
+
+OPERATIONS = ('set', 'append', 'remove')
+'changes that may be made to a Dublin Core field by a :class:`MetadataPatch`'
+
+
+def _editable_fields():
+    # Dublin Core fields editable on the single-object edit form (other than
+    # read-only fields), as a dictionary of field name and whether the field
+    # is repeatable
+    fields = {}
+    for name in DublinCoreEditForm.Meta.fields:
+        if DublinCoreEditForm.Meta.widgets.get(name) is ReadOnlyInput:
+            continue
+        if name.endswith('_list'):
+            fields[name[:-len('_list')]] = True
+        else:
+            fields[name] = False
+    return fields
+
+EDITABLE_FIELDS = _editable_fields()
+'''Dublin Core fields that may be changed by a :class:`MetadataPatch`,
+mapped to True for repeatable fields'''
+
+def _value_form_field(field):
+    # form field used to validate a single value of a Dublin Core field on
+    # DublinCoreEditForm; repeatable fields are edited there with a formset
+    # of single-value forms, under the field name with a _list suffix
+    if EDITABLE_FIELDS.get(field):
+        formset = DublinCoreEditForm.formsets.get('%s_list' % field)
+        if formset is None:
+            return None
+        return formset.form.base_fields.get('val', None)
+    return DublinCoreEditForm.base_fields.get(field, None)
+
+
+class MetadataPatch(object):
+    '''A set of changes to Dublin Core fields, to be applied to many
+    objects (see :class:`~genrepo.file.batch.BatchEdit`).  Values are
+    validated with the fields of :class:`DublinCoreEditForm`.
+
+    :param changes: dictionary keyed on Dublin Core field name (see
+        :data:`EDITABLE_FIELDS`); each value is a dictionary of
+        operation (see :data:`OPERATIONS`) and a value or list of
+        values, e.g. ``{'creator': {'set': ['Smith, J.']}, 'subject':
+        {'append': ['maps'], 'remove': ['charts']}}``.  Values are
+        removed before they are appended.  Only repeatable fields may
+        be set to more than one value or have values appended.
+    :raises: :class:`~django.forms.ValidationError` if the changes are
+        not valid
+    '''
+    def __init__(self, changes):
+        if not isinstance(changes, dict):
+            raise forms.ValidationError('Changes must be specified by field name')
+        errors = []
+        self.changes = {}
+        for field, operations in changes.iteritems():
+            if field not in EDITABLE_FIELDS:
+                errors.append('%s can not be edited' % field)
+                continue
+            if not isinstance(operations, dict) or not operations:
+                errors.append('%s: no changes specified' % field)
+                continue
+            repeatable = EDITABLE_FIELDS[field]
+            cleaned = {}
+            for operation, values in operations.iteritems():
+                if operation not in OPERATIONS:
+                    errors.append('%s: unknown operation %s' % (field, operation))
+                    continue
+                if isinstance(values, basestring):
+                    values = [values]
+                values = [v.strip() for v in values if v and v.strip()]
+                if operation == 'append' and not repeatable:
+                    errors.append('%s: values can only be set or removed' % field)
+                    continue
+                if operation == 'set' and not repeatable and len(values) > 1:
+                    errors.append('%s: only one value is allowed' % field)
+                    continue
+                if operation != 'set' and not values:
+                    errors.append('%s: no values to %s' % (field, operation))
+                    continue
+                # validate as on the single-object edit form (an empty value
+                # is checked when setting a field, e.g. for required fields)
+                form_field = _value_form_field(field)
+                if form_field is not None and operation != 'remove':
+                    try:
+                        values = [form_field.clean(v) for v in (values or [''])]
+                        values = [v for v in values if v]
+                    except forms.ValidationError as err:
+                        errors.append('%s: %s' % (field, '; '.join(err.messages)))
+                        continue
+                cleaned[operation] = values
+            self.changes[field] = cleaned
+        if not self.changes and not errors:
+            errors.append('No changes specified')
+        if errors:
+            raise forms.ValidationError(errors)
+
+    def apply(self, dc):
+        '''Apply the changes to a Dublin Core instance.
+
+        :param dc: :class:`~eulcore.xmlmap.dc.DublinCore`
+        :returns: True if anything was changed
+        '''
+        changed = False
+        for field, operations in self.changes.iteritems():
+            if EDITABLE_FIELDS[field]:
+                current = list(getattr(dc, '%s_list' % field))
+            else:
+                value = getattr(dc, field)
+                current = [value] if value else []
+
+            values = list(current)
+            if 'set' in operations:
+                values = list(operations['set'])
+            values = [v for v in values if v not in operations.get('remove', [])]
+            values.extend(v for v in operations.get('append', []) if v not in values)
+            if values == current:
+                continue
+
+            changed = True
+            if EDITABLE_FIELDS[field]:
+                field_list = getattr(dc, '%s_list' % field)
+                while len(field_list):
+                    del field_list[0]
+                field_list.extend(values)
+            elif values:
+                setattr(dc, field, values[0])
+            else:
+                delattr(dc, field)
+        return changed
+
+
+class BatchEditForm(forms.Form):
+    """Form to change a Dublin Core field for many
+    :class:`~genrepo.file.models.FileObject` instances at once, selected
+    by pid or by collection; see :class:`~genrepo.file.batch.BatchEdit`.
+    The :class:`MetadataPatch` is available as ``patch`` in
+    ``cleaned_data``."""
+    pids = forms.CharField(required=False, widget=forms.Textarea,
+        help_text="pids of the items to edit, one per line")
+    collection = CollectionChoiceField(choices=_collection_options, required=False,
+        help_text="or, edit all items in this collection")
+    field = forms.ChoiceField(choices=[(f, f) for f in sorted(EDITABLE_FIELDS.keys())])
+    operation = forms.ChoiceField(choices=[(op, op) for op in OPERATIONS])
+    values = forms.CharField(required=False, widget=forms.Textarea,
+        help_text="one value per line")
+
+    def clean_pids(self):
+        return [pid.strip() for pid in self.cleaned_data.get('pids', '').splitlines()
+                if pid.strip()]
+
+    def clean(self):
+        pids = self.cleaned_data.get('pids')
+        collection = self.cleaned_data.get('collection')
+        if pids and collection:
+            raise forms.ValidationError('Please specify either pids or a collection, not both.')
+        if not pids and not collection and not self._errors:
+            raise forms.ValidationError('Please specify pids or a collection to edit.')
+        if 'field' in self.cleaned_data and 'operation' in self.cleaned_data:
+            values = self.cleaned_data.get('values', '').splitlines()
+            self.cleaned_data['patch'] = MetadataPatch({
+                self.cleaned_data['field']: {self.cleaned_data['operation']: values}
+            })
+        return self.cleaned_data
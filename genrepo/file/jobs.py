@@ -0,0 +1,188 @@
+'''Background ingest jobs.
+
+When ``INGEST_IN_BACKGROUND`` is enabled, files submitted through the
+ingest form are not sent to Fedora while the request is being
+processed.  Instead, the uploaded file is moved to the configured
+``INGEST_JOB_DIR`` and an :class:`~genrepo.file.models.IngestJob` is
+queued in the database.  Jobs are processed by one or more separate
+worker processes, started with::
+
+    $ python manage.py process_ingest_jobs
+
+Each job is ingested with the Fedora credentials of the login session
+that submitted it, so the session must still be available (i.e., not
+expired or logged out) when the job runs.
+'''
+
+import logging
+import mimetypes
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.move import file_move_safe
+from django.http import HttpRequest
+from django.utils.importlib import import_module
+
+from genrepo.file.models import IngestJob, ingest_local_file
+from genrepo.repository import Repository, release_connections
+
+logger = logging.getLogger(__name__)
+
+# minimum number of seconds between job progress updates in the database
+PROGRESS_INTERVAL = 1
+
+
+class JobFailed(Exception):
+    'Raised when an ingest job can not be processed.'
+    pass
+
+
+def staging_path(prefix='ingest-'):
+    '''Create a new, empty file in ``INGEST_JOB_DIR`` for content
+    waiting to be ingested, and return its path.'''
+    job_dir = getattr(settings, 'INGEST_JOB_DIR', None) or tempfile.gettempdir()
+    if not os.path.isdir(job_dir):
+        os.makedirs(job_dir)
+    fd, path = tempfile.mkstemp(prefix=prefix, dir=job_dir)
+    os.close(fd)
+    return path
+
+def queue_ingest(request, uploaded_file, collection_uri):
+    '''Queue an uploaded file to be ingested into a collection by a
+    background worker.
+
+    :param request: current :class:`~django.http.HttpRequest`; the
+        user and session are stored with the job
+    :param uploaded_file: uploaded file; must be stored in a temporary
+        file (see ``FILE_UPLOAD_HANDLERS``), which is moved to
+        ``INGEST_JOB_DIR``
+    :param collection_uri: URI of the collection the new object should
+        belong to
+    :returns: the new :class:`~genrepo.file.models.IngestJob`
+    '''
+    path = staging_path()
+    file_move_safe(uploaded_file.temporary_file_path(), path, allow_overwrite=True)
+    return queue_file(request, path, uploaded_file.name, uploaded_file.size,
+                      collection_uri)
+
+def queue_file(request, path, filename, size, collection_uri, batch=''):
+    '''Queue a file that is already in ``INGEST_JOB_DIR`` (see
+    :func:`staging_path`) to be ingested by a background worker.  See
+    :func:`queue_ingest` for parameters; ``batch`` optionally groups
+    jobs queued together.'''
+    # make sure the session is saved, so a worker can load it
+    request.session.save()
+    return IngestJob.objects.create(username=request.user.username,
+                                    session_key=request.session.session_key,
+                                    collection=collection_uri,
+                                    filename=filename, path=path, size=size,
+                                    batch=batch)
+
+def queue_entries(request, entries, collection_uri):
+    '''Queue every file in an archive or directory to be ingested by
+    background workers, as a batch of jobs.  Each entry is copied to
+    ``INGEST_JOB_DIR``; nothing is sent to Fedora.
+
+    :param request: current :class:`~django.http.HttpRequest`
+    :param entries: iterable of :class:`~genrepo.file.bulk.ArchiveEntry`
+    :param collection_uri: URI of the collection the new objects should
+        belong to
+    :returns: batch identifier of the queued jobs
+    '''
+    batch = uuid.uuid4().hex
+    for entry in entries:
+        path = staging_path()
+        content = entry.open()
+        try:
+            with open(path, 'wb') as staged:
+                shutil.copyfileobj(content, staged)
+        finally:
+            content.close()
+        queue_file(request, path, os.path.basename(entry.name), entry.size,
+                   collection_uri, batch=batch)
+    return batch
+
+def job_repository(job):
+    '''Get a :class:`~genrepo.repository.Repository` with the Fedora
+    credentials of the login session that submitted a job.
+
+    :raises: :class:`JobFailed` if the session or user no longer exists
+    '''
+    engine = import_module(settings.SESSION_ENGINE)
+    session = engine.SessionStore(job.session_key)
+    if not session.exists(job.session_key):
+        raise JobFailed('Login session for %s has expired' % job.username)
+    request = HttpRequest()
+    request.session = session
+    try:
+        request.user = User.objects.get(username=job.username)
+    except User.DoesNotExist:
+        raise JobFailed('User %s does not exist' % job.username)
+    return Repository(request=request)
+
+def run_job(job):
+    '''Ingest the file for a claimed :class:`~genrepo.file.models.IngestJob`
+    and record the result on the job.  The staged file is removed
+    once the job is finished.'''
+    last_update = [0]
+    def update_progress(bytes_uploaded):
+        now = time.time()
+        if now - last_update[0] >= PROGRESS_INTERVAL:
+            IngestJob.objects.filter(pk=job.pk).update(bytes_uploaded=bytes_uploaded)
+            last_update[0] = now
+
+    try:
+        repo = job_repository(job)
+        with open(job.path, 'rb') as content:
+            obj = ingest_local_file(repo, content, job.filename, job.collection,
+                                    content_type=mimetypes.guess_type(job.filename)[0],
+                                    progress=update_progress)
+        job.pid = obj.pid
+        job.duplicate = obj.duplicate
+        job.bytes_uploaded = job.size
+        job.status = IngestJob.COMPLETE
+        if obj.duplicate:
+            logger.info('%s for %s is a duplicate of %s' % (job.filename, job.username, job.pid))
+        else:
+            logger.info('Ingested %s as %s for %s' % (job.filename, job.pid, job.username))
+    except Exception as err:
+        # any error should fail the job rather than stopping the worker
+        logger.exception('Error processing ingest job %s' % job.pk)
+        job.status = IngestJob.FAILED
+        job.error = unicode(err) or repr(err)
+    finally:
+        release_connections()
+
+    job.finished = datetime.now()
+    job.save()
+    try:
+        os.remove(job.path)
+    except OSError:
+        logger.warning('Could not remove %s for ingest job %s' % (job.path, job.pk))
+    return job
+
+def process_jobs(once=False, poll_interval=5):
+    '''Process queued ingest jobs, oldest first.
+
+    :param once: if True, return as soon as there are no queued jobs;
+        otherwise, wait for new jobs indefinitely
+    :param poll_interval: seconds to wait before checking for new jobs
+        when the queue is empty
+    :returns: number of jobs processed
+    '''
+    processed = 0
+    while True:
+        job = IngestJob.claim_next()
+        if job is None:
+            if once:
+                return processed
+            time.sleep(poll_interval)
+            continue
+        run_job(job)
+        processed += 1
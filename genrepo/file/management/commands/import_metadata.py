@@ -0,0 +1,67 @@
+from getpass import getpass
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from genrepo.file.batch import MetadataCheckpoint, MetadataImport, \
+     MetadataImportError, read_metadata_csv
+from genrepo.repository import Repository
+
+
+class Command(BaseCommand):
+    '''Update the Dublin Core metadata of the objects listed in a CSV
+    file, keyed by pid (e.g., a corrected collection metadata export;
+    see :func:`genrepo.file.batch.read_metadata_csv`).  Each row is
+    validated as on the metadata edit form; objects that already match
+    their row are not saved.'''
+    help = __doc__
+    args = '<csv file>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+            help='Number of objects to update at once [BATCH_EDIT_WORKERS]'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+            help='File to record imported rows in; rows already recorded (and not ' +
+                 'changed since) are skipped, so an interrupted import can be restarted'),
+        make_option('--username', dest='username', default=None,
+            help='Fedora username to update objects as (prompts for password) [FEDORA_USER]'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if len(args) != 1:
+            raise CommandError('Please specify a single CSV file')
+
+        try:
+            rows = read_metadata_csv(args[0])
+        except MetadataImportError as err:
+            raise CommandError(err)
+
+        if options['username']:
+            password = getpass('Fedora password for %s: ' % options['username'])
+            repo = Repository(username=options['username'], password=password)
+        else:
+            repo = Repository()
+
+        checkpoint = None
+        if options['checkpoint']:
+            checkpoint = MetadataCheckpoint(options['checkpoint'])
+        metadata_import = MetadataImport(repo, workers=options['workers'],
+                                         checkpoint=checkpoint)
+        try:
+            results = metadata_import.run(rows)
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+
+        for result in results:
+            if not result.success:
+                print 'Error: %s: %s' % (result.pid, result.error)
+            elif verbosity > 1:
+                print '%s: %s' % (result.pid, 'updated' if result.changed else 'unchanged')
+
+        if verbosity > 0:
+            if metadata_import.skipped:
+                print 'Skipped %d row(s) already imported' % metadata_import.skipped
+            print 'Updated %d object(s); %d already up to date; %d failed' % \
+                  (metadata_import.changed, metadata_import.unchanged, metadata_import.failed)
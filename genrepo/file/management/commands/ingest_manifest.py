@@ -0,0 +1,83 @@
+from getpass import getpass
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from genrepo.file.manifest import Checkpoint, ManifestError, ManifestIngest, \
+     read_manifest
+from genrepo.repository import Repository
+
+
+class Command(BaseCommand):
+    '''Ingest the files listed in one or more CSV or JSON manifests,
+    each into the listed collection and with the listed Dublin Core
+    metadata (see :mod:`genrepo.file.manifest`).  Reports the files and
+    megabytes ingested per second, for sizing migrations.'''
+    help = __doc__
+    args = '<manifest> [<manifest> ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+            help='Number of files to ingest at once [BULK_INGEST_WORKERS]'),
+        make_option('--retries', type='int', dest='retries', default=3,
+            help='Times to retry a file after a transient repository error [%default]'),
+        make_option('--backoff', type='float', dest='backoff', default=1.0,
+            help='Seconds to wait before the first retry; doubled for each retry [%default]'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+            help='File to record ingested files in; files already recorded are skipped, ' +
+                 'so an interrupted ingest can be restarted'),
+        make_option('--username', dest='username', default=None,
+            help='Fedora username to ingest as (prompts for password) [FEDORA_USER]'),
+        make_option('--deduplicate', action='store_true', dest='deduplicate',
+            default=False,
+            help='Add an existing object with the same content to the collection ' +
+                 'instead of ingesting a file; manifest metadata is not applied to it'),
+    )
+
+    def handle(self, *manifests, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if not manifests:
+            raise CommandError('Please specify at least one manifest')
+
+        entries = []
+        for manifest in manifests:
+            try:
+                entries.extend(read_manifest(manifest))
+            except ManifestError as err:
+                raise CommandError(err)
+
+        if options['username']:
+            password = getpass('Fedora password for %s: ' % options['username'])
+            repo = Repository(username=options['username'], password=password)
+        else:
+            repo = Repository()
+
+        checkpoint = None
+        if options['checkpoint']:
+            checkpoint = Checkpoint(options['checkpoint'])
+        ingest = ManifestIngest(repo, workers=options['workers'],
+                                retries=options['retries'], backoff=options['backoff'],
+                                checkpoint=checkpoint, deduplicate=options['deduplicate'])
+        try:
+            results = ingest.run(entries)
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+
+        for result in results:
+            if not result.success:
+                print 'Error: %s: %s' % (result.name, result.error)
+            elif result.warning:
+                print 'Warning: %s: %s' % (result.name, result.warning)
+            elif verbosity > 1:
+                print '%s: %s' % (result.name, result.pid)
+
+        if verbosity > 0:
+            if ingest.skipped:
+                print 'Skipped %d file(s) already ingested' % ingest.skipped
+            print 'Ingested %d of %d file(s) (%.1f MB) in %.1f seconds with %d worker(s)' % \
+                  (ingest.succeeded, len(results), ingest.total_size / 1048576.0,
+                   ingest.elapsed or 0, ingest.workers)
+            if ingest.elapsed:
+                print '%.2f files/sec, %.2f MB/sec' % \
+                      (ingest.files_per_second, ingest.bytes_per_second / 1048576.0)
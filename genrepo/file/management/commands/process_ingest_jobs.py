@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from genrepo.file.jobs import process_jobs
+
+
+class Command(BaseCommand):
+    '''Process queued background ingest jobs (see
+    :mod:`genrepo.file.jobs`).  Several instances may be run at once
+    to ingest files in parallel.'''
+    help = __doc__
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', default=False,
+            help='Exit when there are no more queued jobs, instead of waiting for new ones'),
+        make_option('--poll-interval', type='int', dest='poll_interval', default=5,
+            help='Seconds to wait before checking for new jobs when the queue is empty [%default]'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        processed = process_jobs(once=options['once'],
+                                 poll_interval=options['poll_interval'])
+        if verbosity > 0:
+            print 'Processed %d ingest job(s)' % processed
@@ -0,0 +1,292 @@
+'''Manifest-driven bulk ingest, for migrating existing files into the
+repository; see the ``ingest_manifest`` management command.
+
+A manifest lists the files to ingest, one per row: the ``path`` to the
+file, the ``collection`` (pid or URI) the new object should belong
+to, and optionally any Dublin Core fields (e.g., ``title``,
+``creator``, ``subject``) for the new object.  Manifests may be CSV
+files with a header row naming the columns (multiple values for a
+field are separated by ``|``), or JSON files containing a list of
+objects with the same keys (multiple values as a list).  Relative
+paths are resolved from the directory containing the manifest.
+
+Files are ingested by a pool of worker threads (see
+:class:`~genrepo.file.bulk.BulkIngest`); transient repository errors
+are retried with exponential backoff, and each file ingested is
+recorded in an optional checkpoint file, so that an interrupted
+ingest can be restarted without ingesting anything twice.
+'''
+
+import codecs
+import csv
+import httplib
+import logging
+import mimetypes
+import os
+import socket
+import threading
+import time
+
+from django.utils import simplejson
+
+from eulcore.fedora.util import RequestFailed, PermissionDenied
+
+from genrepo.collection.models import DC_FIELDS
+from genrepo.file.bulk import BulkIngest, BulkIngestResult
+from genrepo.file.models import ingest_local_file
+
+logger = logging.getLogger(__name__)
+
+MULTIVALUE_SEPARATOR = '|'
+'separator for multiple values of a field in a CSV manifest'
+
+
+class ManifestError(Exception):
+    'Raised when a manifest can not be read.'
+    pass
+
+
+class ManifestEntry(object):
+    '''A single file to be ingested from a manifest, with the URI of the
+    collection it should be added to and any Dublin Core metadata.
+    Used as a :class:`~genrepo.file.bulk.ArchiveEntry` by
+    :class:`ManifestIngest`.'''
+
+    def __init__(self, path, collection, metadata=None):
+        self.path = path
+        if not collection.startswith('info:fedora/'):
+            collection = 'info:fedora/' + collection
+        self.collection = collection
+        self.metadata = metadata or {}
+
+    @property
+    def name(self):
+        return self.path
+
+    @property
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.path)
+
+
+def read_manifest(path):
+    '''Read a CSV or JSON manifest (JSON if the file name ends in
+    ``.json``).
+
+    :param path: path to the manifest file
+    :returns: list of :class:`ManifestEntry`
+    :raises: :class:`ManifestError` if the manifest is not valid
+    '''
+    try:
+        if path.lower().endswith('.json'):
+            with open(path) as manifest:
+                rows = simplejson.load(manifest)
+            if not isinstance(rows, list):
+                raise ManifestError('JSON manifest must contain a list of objects')
+        else:
+            rows = read_csv(path)
+    except (IOError, ValueError, csv.Error) as err:
+        raise ManifestError('Could not read manifest %s: %s' % (path, err))
+
+    basedir = os.path.dirname(os.path.abspath(path))
+    entries = []
+    for number, row in enumerate(rows):
+        if not isinstance(row, dict):
+            raise ManifestError('Entry %d is not an object' % (number + 1))
+        row = row.copy()
+        file_path = row.pop('path', None)
+        collection = row.pop('collection', None)
+        if not file_path or not collection:
+            raise ManifestError('Entry %d must have a path and a collection' % (number + 1))
+        unknown = [field for field in row.keys() if field not in DC_FIELDS]
+        if unknown:
+            raise ManifestError('Entry %d has unknown field(s): %s' % \
+                                (number + 1, ', '.join(sorted(unknown))))
+        metadata = {}
+        for field, value in row.iteritems():
+            if isinstance(value, basestring):
+                value = [v.strip() for v in value.split(MULTIVALUE_SEPARATOR)]
+            value = [v for v in value if v]
+            if value:
+                metadata[field] = value
+        entries.append(ManifestEntry(os.path.join(basedir, file_path),
+                                     collection, metadata))
+    return entries
+
+def read_csv(path):
+    '''Read a CSV file with a header row naming the columns, as used
+    for manifests (column names are lower-cased; values are decoded as
+    utf-8, with or without a byte order mark).
+
+    :returns: list of dictionaries keyed on column name
+    '''
+    # csv module in python 2 works with bytes
+    with open(path, 'rb') as manifest:
+        data = manifest.read()
+    if data.startswith(codecs.BOM_UTF8):
+        data = data[len(codecs.BOM_UTF8):]
+    reader = csv.DictReader(data.splitlines())
+    return [dict((key.strip().lower(), (value or '').decode('utf-8'))
+                 for key, value in row.iteritems() if key)
+            for row in reader]
+
+
+class Checkpoint(object):
+    '''Record of the files already ingested from a manifest, stored in
+    a file with one JSON object per line, so that a restarted ingest
+    can skip them.  Safe to use from several threads.
+
+    Subclasses may record other kinds of entries by overriding
+    :meth:`entry_record` and :meth:`record_key`.
+
+    :param path: path to the checkpoint file; created if it does not
+        exist, otherwise the entries already recorded are loaded
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as checkpoint:
+                for line in checkpoint:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = simplejson.loads(line)
+                    except ValueError:
+                        # last line may be incomplete if the ingest was killed
+                        continue
+                    self.done[self.record_key(record)] = record.get('pid')
+        self._file = open(path, 'a')
+
+    def entry_record(self, entry, pid):
+        '''Information recorded in the checkpoint file for an entry.
+
+        :returns: dictionary, including everything used by
+            :meth:`record_key`
+        '''
+        return {'path': entry.path, 'collection': entry.collection, 'pid': pid}
+
+    def record_key(self, record):
+        '''Key identifying an entry, from the information recorded
+        for it (see :meth:`entry_record`).'''
+        return (record['path'], record['collection'])
+
+    def __contains__(self, entry):
+        return self.record_key(self.entry_record(entry, None)) in self.done
+
+    def record(self, entry, pid):
+        'Record a file from the manifest as ingested.'
+        record = self.entry_record(entry, pid)
+        line = simplejson.dumps(record)
+        with self._lock:
+            self.done[self.record_key(record)] = pid
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def is_transient(err):
+    '''Check whether an error is likely to be temporary, so that the
+    operation is worth retrying: connection errors and repository
+    server errors, but not permission errors or errors in the request.'''
+    if isinstance(err, (socket.error, httplib.HTTPException)):
+        return True
+    if isinstance(err, RequestFailed) and not isinstance(err, PermissionDenied):
+        code = getattr(err, 'code', None)
+        return code is None or code >= 500
+    return False
+
+
+class ManifestIngest(BulkIngest):
+    '''Ingest the files listed in a manifest, each into its own
+    collection and with its own metadata.  Extends
+    :class:`~genrepo.file.bulk.BulkIngest` with retries and
+    checkpointing.
+
+    :param repo: :class:`~genrepo.repository.Repository` to ingest into
+    :param workers: number of worker threads; defaults to the
+        configured ``BULK_INGEST_WORKERS``
+    :param retries: number of times to retry a file after a transient
+        error (see :func:`is_transient`)
+    :param backoff: seconds to wait before the first retry; doubled for
+        each retry after that
+    :param checkpoint: optional :class:`Checkpoint`; files already
+        recorded are skipped, and files ingested are recorded
+    :param deduplicate: whether to add existing objects with the same
+        content to the collection instead of ingesting new objects; off
+        by default, since the metadata in the manifest is not applied to
+        existing objects
+    '''
+
+    log_message = 'ingesting content (manifest ingest)'
+
+    def __init__(self, repo, workers=None, retries=3, backoff=1.0, checkpoint=None,
+                 deduplicate=False):
+        super(ManifestIngest, self).__init__(repo, None, workers)
+        self.retries = retries
+        self.backoff = backoff
+        self.checkpoint = checkpoint
+        self.deduplicate = deduplicate
+        self.skipped = 0
+
+    def run(self, entries):
+        '''Ingest all entries that are not already recorded in the
+        checkpoint.  See :meth:`BulkIngest.run`.'''
+        if self.checkpoint is not None:
+            remaining = [entry for entry in entries if entry not in self.checkpoint]
+            self.skipped = len(entries) - len(remaining)
+            entries = remaining
+        return super(ManifestIngest, self).run(entries)
+
+    def ingest_entry(self, entry):
+        '''Ingest a single :class:`ManifestEntry`, retrying after
+        transient errors.
+
+        :returns: :class:`~genrepo.file.bulk.BulkIngestResult`
+        '''
+        attempt = 0
+        while True:
+            try:
+                obj = self._ingest(entry)
+                break
+            except Exception as err:
+                if attempt < self.retries and is_transient(err):
+                    delay = self.backoff * (2 ** attempt)
+                    attempt += 1
+                    logger.warning('Error ingesting %s (%s); retrying in %.1f seconds' \
+                                   % (entry.path, err, delay))
+                    time.sleep(delay)
+                    continue
+                logger.exception('Error ingesting %s' % entry.path)
+                return BulkIngestResult(entry.name, entry.size, None, unicode(err) or repr(err))
+
+        if self.checkpoint is not None:
+            self.checkpoint.record(entry, obj.pid)
+        warning = None
+        if obj.duplicate:
+            warning = 'duplicate of %s' % obj.pid
+            if entry.metadata:
+                warning += ', metadata not applied'
+        return BulkIngestResult(entry.name, entry.size, obj.pid, None, warning)
+
+    def _ingest(self, entry):
+        filename = os.path.basename(entry.path)
+        content = entry.open()
+        try:
+            return ingest_local_file(self.repo, content, filename, entry.collection,
+                                     self.log_message, mimetypes.guess_type(filename)[0],
+                                     metadata=entry.metadata, deduplicate=self.deduplicate)
+        finally:
+            content.close()
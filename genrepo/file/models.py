@@ -1,8 +1,21 @@
+from datetime import datetime, timedelta
+import logging
+import os
+
 from django.conf import settings
-from django.db.models import Model
-from eulcore.fedora import DigitalObject
-from eulcore.fedora.models import FileDatastream
-from genrepo.collection.models import AccessibleObject
+from django.db.models import Model, BigIntegerField, BooleanField, CharField, \
+     DateTimeField, TextField
+from rdflib import URIRef
+
+from eulcore.fedora.rdfns import relsext
+from eulcore.fedora.models import FileDatastream, DigitalObjectSaveFailure
+from eulcore.fedora.util import RequestFailed
+from genrepo.collection.models import AccessibleObject, CachedDigitalObject, \
+     CollectionObject
+from genrepo.file.upload import SNIFF_SIZE, detect_mimetype, file_checksum, \
+     upload_file
+
+logger = logging.getLogger(__name__)
 
 
 class File(Model):
@@ -15,10 +28,215 @@ class File(Model):
         )
 
 
-class FileObject(DigitalObject):
+class IngestJob(Model):
+    '''A file waiting to be ingested (or being ingested) by a
+    background worker process; see :mod:`genrepo.file.jobs`.'''
+    QUEUED, RUNNING, COMPLETE, FAILED = 'queued', 'running', 'complete', 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (COMPLETE, 'Complete'),
+        (FAILED, 'Failed'),
+    )
+
+    username = CharField(max_length=255)
+    "user who submitted the file"
+    session_key = CharField(max_length=40)
+    "login session of the submitting user, for Fedora credentials"
+    collection = CharField(max_length=255)
+    "URI of the collection the new object should belong to"
+    filename = CharField(max_length=255)
+    "original name of the uploaded file"
+    path = CharField(max_length=1024)
+    "path to the uploaded file, while waiting to be ingested"
+    size = BigIntegerField()
+    bytes_uploaded = BigIntegerField(default=0)
+    "number of bytes sent to Fedora so far"
+    status = CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED,
+                       db_index=True)
+    pid = CharField(max_length=255, blank=True)
+    "pid of the ingested object"
+    duplicate = BooleanField(default=False)
+    "whether an existing object with the same content was used instead"
+    error = TextField(blank=True)
+    batch = CharField(max_length=32, blank=True, db_index=True)
+    "identifier shared by jobs queued together (e.g., from one bulk ingest)"
+    created = DateTimeField(auto_now_add=True)
+    started = DateTimeField(null=True, blank=True)
+    finished = DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created']
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.filename, self.status)
+
+    @staticmethod
+    def claim_next():
+        '''Claim the oldest queued job for processing by marking it as
+        running.  Safe to use from several worker processes at once,
+        since a job is only claimed if its status is still queued when
+        it is updated.  Stale running jobs are failed first (see
+        :meth:`fail_stale`).
+
+        :returns: the claimed :class:`IngestJob`, or None if no jobs
+            are queued
+        '''
+        IngestJob.fail_stale()
+        queued = IngestJob.objects.filter(status=IngestJob.QUEUED)
+        for pk in queued.values_list('pk', flat=True)[:10]:
+            claimed = IngestJob.objects.filter(pk=pk, status=IngestJob.QUEUED) \
+                      .update(status=IngestJob.RUNNING, started=datetime.now())
+            if claimed:
+                return IngestJob.objects.get(pk=pk)
+        return None
+
+    @staticmethod
+    def fail_stale():
+        '''Mark jobs that have been running for more than
+        ``INGEST_JOB_TIMEOUT`` seconds as failed, e.g. because the worker
+        processing them was stopped, and remove their staged files.
+        Jobs are not requeued, since the worker may still be ingesting
+        them; if it does finish, the job is updated with the result.
+
+        :returns: number of jobs failed
+        '''
+        cutoff = datetime.now() - \
+                 timedelta(seconds=getattr(settings, 'INGEST_JOB_TIMEOUT', 21600))
+        failed = 0
+        stale = IngestJob.objects.filter(status=IngestJob.RUNNING, started__lt=cutoff)
+        for job in stale:
+            # only fail the job if no other worker has done so in the meantime
+            if not IngestJob.objects.filter(pk=job.pk, status=IngestJob.RUNNING) \
+                   .update(status=IngestJob.FAILED, finished=datetime.now(),
+                           error='Ingest did not finish within the job time limit'):
+                continue
+            logger.warning('Ingest job %s has been running since %s; marked it as failed' \
+                           % (job.pk, job.started))
+            failed += 1
+            try:
+                os.remove(job.path)
+            except OSError:
+                pass
+        return failed
+
+    def progress(self):
+        'Status and progress information, as a dictionary (e.g. for JSON)'
+        info = {
+            'id': self.id,
+            'status': self.status,
+            'filename': self.filename,
+            'size': self.size,
+            'bytes_uploaded': self.bytes_uploaded,
+            'pid': self.pid or None,
+            'duplicate': self.duplicate,
+            'error': self.error or None,
+        }
+        for field in ('created', 'started', 'finished'):
+            value = getattr(self, field)
+            info[field] = value.isoformat() if value else None
+        return info
+
+
+class ContentChecksum(Model):
+    '''Index of the content of ingested ``master`` datastreams, by
+    SHA-256 checksum, used to find an existing object with the same
+    content as a new file; see :func:`find_duplicate`.'''
+    CHECKSUM_TYPE = 'SHA-256'
+    checksum = CharField(max_length=64, db_index=True)
+    "hex digest of the master datastream content"
+    pid = CharField(max_length=255)
+    "pid of the :class:`FileObject`"
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.pid, self.checksum)
+
+
+class UploadSession(Model):
+    '''A resumable upload of a single file, sent in chunks that are
+    appended in order to a file in ``INGEST_JOB_DIR``.  If a chunk is
+    lost, the client can check the current :attr:`offset` and resend
+    from there, instead of starting over.'''
+    username = CharField(max_length=255)
+    "user who started the upload"
+    filename = CharField(max_length=255)
+    "original name of the file being uploaded"
+    size = BigIntegerField()
+    "expected size of the complete file, in bytes"
+    offset = BigIntegerField(default=0)
+    "number of bytes received so far"
+    path = CharField(max_length=1024)
+    "path to the partially uploaded file"
+    created = DateTimeField(auto_now_add=True)
+    updated = DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u'%s (%d of %d bytes)' % (self.filename, self.offset, self.size)
+
+    @property
+    def complete(self):
+        return self.offset == self.size
+
+    def append_chunk(self, data, offset):
+        '''Write a chunk of the file at the specified offset, which must
+        be the current :attr:`offset`.  The offset is advanced before
+        the chunk is written, so only one request can write each chunk.
+
+        :returns: True if the chunk was written; False if the offset
+            does not match (e.g., the chunk was already received)
+        '''
+        if offset != self.offset or offset + len(data) > self.size:
+            return False
+        end = offset + len(data)
+        # claim the chunk before writing it, so a resent or stale chunk
+        # can never overwrite data that another request has written
+        claimed = UploadSession.objects.filter(pk=self.pk, offset=offset) \
+                  .update(offset=end, updated=datetime.now())
+        if not claimed:
+            return False
+        try:
+            # no truncate: anything past the end of this chunk belongs
+            # to the next one, and the file never grows past size
+            with open(self.path, 'r+b') as staged:
+                staged.seek(offset)
+                staged.write(data)
+        except:
+            # release the claim so the chunk can be resent
+            UploadSession.objects.filter(pk=self.pk, offset=end) \
+                .update(offset=offset, updated=datetime.now())
+            raise
+        self.offset = end
+        return True
+
+    def discard(self):
+        'Remove the partially uploaded file and delete this upload session.'
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.delete()
+
+    @staticmethod
+    def remove_expired():
+        '''Discard upload sessions that have not received any data for
+        ``UPLOAD_SESSION_TIMEOUT`` seconds.'''
+        cutoff = datetime.now() - \
+                 timedelta(seconds=getattr(settings, 'UPLOAD_SESSION_TIMEOUT', 604800))
+        for upload in UploadSession.objects.filter(updated__lt=cutoff):
+            upload.discard()
+
+    def progress(self):
+        'Upload status, as a dictionary (e.g. for JSON)'
+        return {'id': self.id, 'filename': self.filename, 'size': self.size,
+                'offset': self.offset, 'complete': self.complete}
+
+
+class FileObject(CachedDigitalObject):
     '''An opaque file for repositing on behalf of a user. Inherits the
     standard Dublin Core and RELS-EXT datastreams from
-    :class:`~eulcore.fedora.models.DigitalObject`, and adds both a
+    :class:`~eulcore.fedora.models.DigitalObject` (with cached object
+    information from
+    :class:`~genrepo.collection.models.CachedDigitalObject`), and adds both a
     ``master`` datastream to contain the user's file as well as a content
     model for identifying these objects.
     '''
@@ -30,3 +248,216 @@ class FileObject(DigitalObject):
             'versionable': True,
         })
     "reposited master :class:`~eulcore.fedora.models.FileDatastream`"
+
+    duplicate = False
+    '''True if this is an existing object returned by :func:`ingest_file`
+    in place of a new object with the same content'''
+
+    def record_checksums(self, checksums):
+        '''Record checksums calculated for new ``master`` content.  The
+        checksum of the configured ``FILE_CHECKSUM_TYPE`` is passed to
+        Fedora, which verifies it when the content is saved instead of
+        calculating its own, and all checksums are added to the Dublin
+        Core as ``urn:<type>:<digest>`` identifiers (e.g.,
+        ``urn:sha1:...``).
+
+        :param checksums: dictionary of hex digests keyed on Fedora
+            checksum type (MD5, SHA-1, SHA-256), as calculated by
+            :class:`~genrepo.file.upload.FedoraUploadHandler`
+        '''
+        checksum_type = getattr(settings, 'FILE_CHECKSUM_TYPE', 'MD5')
+        if checksum_type in checksums:
+            self.master.checksum_type = checksum_type
+            self.master.checksum = checksums[checksum_type]
+
+        if self._create and callable(self.pid):
+            # Fedora adds the pid to dc:identifier on ingest if it is
+            # missing; assign it now so it is listed before the checksums
+            self.pid = self.pid()
+            self.dc.content.identifier_list.append(self.pid)
+        for checksum_type in sorted(checksums.keys()):
+            self.dc.content.identifier_list.append('urn:%s:%s' % \
+                (checksum_type.replace('-', '').lower(), checksums[checksum_type]))
+
+    def save(self, logMessage=None):
+        # collection pages list the labels of their members, so a change
+        # to the label (or to collection membership) changes the pages of
+        # the collections a file belongs to.  RELS-EXT is only retrieved
+        # to find those collections if the label changed; other changes
+        # don't affect collection pages
+        rels_ext = self.dscache.get('RELS-EXT')
+        rels_ext_loaded = rels_ext is not None and rels_ext._content is not None
+        notify = self.is_modified() and (rels_ext_loaded or self.info_modified)
+        result = super(FileObject, self).save(logMessage)
+        if not notify:
+            return result
+        try:
+            for collection in self.rels_ext.content.objects(self.uriref,
+                                                            relsext.isMemberOfCollection):
+                CollectionObject.members_changed(unicode(collection))
+        except RequestFailed:
+            pass
+        return result
+
+    def _build_foxml_managed_content(self, E, dsobj):
+        # content already sent to the Fedora upload endpoint (e.g., by
+        # genrepo.file.upload.FedoraUploadHandler) is referenced by its
+        # upload id instead of being uploaded again
+        upload_id = getattr(dsobj.content, 'upload_id', None)
+        if upload_id is None:
+            return super(FileObject, self)._build_foxml_managed_content(E, dsobj)
+        content_location = E('contentLocation')
+        content_location.set('REF', upload_id)
+        content_location.set('TYPE', 'INTERNAL_ID')
+        return content_location
+
+
+def ingest_file(repo, content, collection_uri, log_message='ingesting user content',
+                metadata=None, deduplicate=None):
+    '''Ingest a file as a new :class:`FileObject` that is a member of
+    a collection.  The object label and dc:title are set to the file
+    name, the ``master`` mimetype and dc:format are set to the mimetype
+    of the file, and checksums calculated while the file was uploaded
+    (if any) are recorded with :meth:`FileObject.record_checksums`.
+
+    Files uploaded with :mod:`genrepo.file.upload` already have the
+    mimetype detected from their content; for any other file, it is
+    detected from the first few bytes of the file.
+
+    If ``DEDUPLICATE_INGEST`` is enabled and an existing object has the
+    same content (see :func:`find_duplicate`), that object is added to
+    the collection and returned instead, with :attr:`FileObject.duplicate`
+    set, and the uploaded content is left for Fedora to discard.  If the
+    existing object can't be updated, a new object is ingested as usual.
+
+    :param repo: :class:`~genrepo.repository.Repository` to ingest into
+    :param content: uploaded file, e.g. a
+        :class:`~genrepo.file.upload.FedoraUploadedFile`
+    :param collection_uri: URI of the collection
+    :param log_message: Fedora audit trail message for the ingest
+    :param metadata: optional Dublin Core values for the new object, as
+        a dictionary keyed on field name (e.g., ``title``, ``creator``);
+        each value may be a string or a list.  Values replace those set
+        from the file, except for ``identifier``, which is added to.
+    :param deduplicate: whether to check for an existing object with
+        the same content; defaults to ``DEDUPLICATE_INGEST``.  Metadata
+        is not applied to an existing object.
+    :returns: the new :class:`FileObject`
+    '''
+    checksums = getattr(content, 'checksums', None) or {}
+    if deduplicate is None:
+        deduplicate = getattr(settings, 'DEDUPLICATE_INGEST', False)
+    if deduplicate:
+        duplicate = _ingest_duplicate(repo, checksums.get(ContentChecksum.CHECKSUM_TYPE),
+                                      collection_uri, log_message, metadata)
+        if duplicate is not None:
+            return duplicate
+
+    fobj = repo.get_object(type=FileObject)
+    fobj.rels_ext.content.add((fobj.uriref, relsext.isMemberOfCollection,
+                               URIRef(collection_uri)))
+    fobj.master.content = content
+    mimetype = getattr(content, 'content_type', None)
+    if getattr(content, 'upload_id', None) is None:
+        head = content.read(SNIFF_SIZE)
+        content.seek(0)
+        mimetype = detect_mimetype(head, content.name, mimetype)
+    if mimetype:
+        fobj.master.mimetype = fobj.dc.content.format = mimetype
+    if checksums:
+        fobj.record_checksums(checksums)
+    # pre-populate the object label and dc:title with the uploaded filename
+    fobj.label = fobj.dc.content.title = content.name
+    for field, values in (metadata or {}).iteritems():
+        if isinstance(values, basestring):
+            values = [values]
+        field_list = getattr(fobj.dc.content, '%s_list' % field)
+        if field != 'identifier':
+            while len(field_list):
+                del field_list[0]
+        field_list.extend(values)
+    if metadata and metadata.get('title'):
+        fobj.label = fobj.dc.content.title
+    fobj.save(log_message)
+    if ContentChecksum.CHECKSUM_TYPE in checksums:
+        ContentChecksum.objects.create(checksum=checksums[ContentChecksum.CHECKSUM_TYPE],
+                                       pid=fobj.pid)
+    return fobj
+
+def ingest_local_file(repo, fileobj, name, collection_uri,
+                      log_message='ingesting user content', content_type=None,
+                      progress=None, metadata=None, deduplicate=None):
+    '''Upload a local file (or other file-like object) to Fedora with
+    :func:`~genrepo.file.upload.upload_file` and ingest it with
+    :func:`ingest_file`.  If the file can be read twice (i.e., it is
+    seekable), it is checked for a duplicate (see :func:`find_duplicate`)
+    before anything is sent to Fedora.
+
+    :param fileobj: file-like object to read content from
+    :param name: file name
+    :param content_type: expected mimetype of the file, if known
+    :param progress: optional callable, passed to
+        :func:`~genrepo.file.upload.upload_file`
+
+    See :func:`ingest_file` for the other parameters.
+    '''
+    if deduplicate is None:
+        deduplicate = getattr(settings, 'DEDUPLICATE_INGEST', False)
+    if deduplicate:
+        checksum = file_checksum(fileobj)
+        if checksum is not None:
+            duplicate = _ingest_duplicate(repo, checksum, collection_uri, log_message,
+                                          metadata)
+            if duplicate is not None:
+                return duplicate
+    uploaded = upload_file(repo, fileobj, name, content_type, progress=progress)
+    return ingest_file(repo, uploaded, collection_uri, log_message, metadata,
+                       deduplicate)
+
+def find_duplicate(repo, checksum):
+    '''Find an existing :class:`FileObject` with ``master`` content
+    matching a checksum, using the :class:`ContentChecksum` index.
+    Indexed objects are only returned if they are accessible with the
+    current credentials and still have the checksum recorded in their
+    Dublin Core (see :meth:`FileObject.record_checksums`).
+
+    :param repo: :class:`~genrepo.repository.Repository`
+    :param checksum: SHA-256 hex digest of the file content
+    :returns: :class:`FileObject`, or None if there is no match
+    '''
+    identifier = 'urn:%s:%s' % (ContentChecksum.CHECKSUM_TYPE.replace('-', '').lower(),
+                                checksum)
+    for pid in ContentChecksum.objects.filter(checksum=checksum) \
+                                      .values_list('pid', flat=True):
+        obj = repo.get_object(pid, type=FileObject)
+        try:
+            if obj.exists and identifier in obj.dc.content.identifier_list:
+                return obj
+        except RequestFailed:
+            pass
+    return None
+
+def _ingest_duplicate(repo, checksum, collection_uri, log_message, metadata=None):
+    # if there is an existing object with the same content, add it to
+    # the collection and return it instead of ingesting a new object;
+    # returns None if a new object is needed.  metadata for the new
+    # object is not applied to the existing one
+    if checksum is None:
+        return None
+    fobj = find_duplicate(repo, checksum)
+    if fobj is None:
+        return None
+    statement = (fobj.uriref, relsext.isMemberOfCollection, URIRef(collection_uri))
+    if statement not in fobj.rels_ext.content:
+        fobj.rels_ext.content.add(statement)
+        try:
+            fobj.save('%s (duplicate of existing content)' % log_message)
+        except (DigitalObjectSaveFailure, RequestFailed) as err:
+            logger.warning('Could not add %s with duplicate content to %s (%s); ingesting a new copy' \
+                           % (fobj.pid, collection_uri, err))
+            return None
+    logger.info('Content is a duplicate of %s; added it to %s' % (fobj.pid, collection_uri))
+    if metadata:
+        logger.warning('Metadata not applied to %s (duplicate content)' % fobj.pid)
+    fobj.duplicate = True
+    return fobj
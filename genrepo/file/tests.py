@@ -1,11 +1,25 @@
+from base64 import b64encode
+from datetime import datetime, timedelta
+import hashlib
 import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
 from mock import Mock, patch
 import re
+import socket
+from StringIO import StringIO
 
+from django import forms
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import MemoryFileUploadHandler
 from django.core.urlresolvers import reverse
-from django.test import Client
-from rdflib import URIRef
+from django.test import Client, TestCase
+from django.utils import simplejson
+from rdflib import Graph, URIRef
 
 from eulcore.django.test import TestCase as EulcoreTestCase
 from eulcore.django.fedora import Repository
@@ -13,8 +27,22 @@ from eulcore.fedora.rdfns import relsext
 from eulcore.fedora.util import RequestFailed, PermissionDenied
 from eulcore.xmlmap.dc import DublinCore
 
-from genrepo.file.forms import IngestForm, DublinCoreEditForm
-from genrepo.file.models import FileObject
+from genrepo.file.batch import BatchEdit, MetadataCheckpoint, MetadataImport, \
+     MetadataImportError, MetadataRow, read_metadata_csv
+from genrepo.file.bulk import ArchiveEntry, BulkIngest, BulkIngestResult, \
+     archive_entries, pool_imap
+from genrepo.file.download import ByteRange, DatastreamCache, parse_range
+from genrepo.file.forms import IngestForm, DublinCoreEditForm, CollectionChoiceField, \
+     MetadataPatch, BatchEditForm, _collection_options, _invalidate_collection_options
+from genrepo.file.jobs import run_job
+from genrepo.file.manifest import Checkpoint, ManifestEntry, ManifestError, \
+     ManifestIngest, is_transient, read_manifest
+from genrepo.file.models import FileObject, IngestJob, UploadSession, ContentChecksum, \
+     find_duplicate, ingest_local_file
+from genrepo.file.upload import FedoraUploadHandler, FedoraUploadedFile, \
+     SNIFF_SIZE, detect_mimetype
+from genrepo.collection.models import CachedDigitalObject, CollectionObject, ObjectInfo, \
+     collection_saved
 from genrepo.collection.tests import ADMIN_CREDENTIALS, NONADMIN_CREDENTIALS
 
 class FileViewsTest(EulcoreTestCase):
@@ -132,6 +160,9 @@ class FileViewsTest(EulcoreTestCase):
 
         # log in
         self.client.post(settings.LOGIN_URL, ADMIN_CREDENTIALS)
+        # display the form first, for the CSRF cookie; without it, the
+        # file would not be streamed to Fedora
+        self.client.get(self.ingest_url)
 
         # on POST, ingest object
         with open(self.ingest_fname) as ingest_f:
@@ -159,6 +190,16 @@ class FileViewsTest(EulcoreTestCase):
                          msg='filename should be set as preliminary dc:title')
         with open(self.ingest_fname) as ingest_f:
             self.assertEqual(new_obj.master.content.read(), ingest_f.read())
+        self.assertEqual('text/plain', new_obj.master.mimetype,
+                         msg='mimetype detected on upload should be set on master datastream')
+        self.assertEqual('text/plain', new_obj.dc.content.format,
+                         msg='mimetype detected on upload should be set as dc:format')
+        self.assertEqual(self.ingest_md5sum, new_obj.master.checksum,
+                         msg='checksum calculated on upload should be passed to Fedora')
+        self.assert_('urn:md5:%s' % self.ingest_md5sum in new_obj.dc.content.identifier_list,
+                     msg='checksum should be recorded as dc:identifier')
+        self.assertEqual(pid, new_obj.dc.content.identifier,
+                         msg='pid should be the first dc:identifier')
         # confirm that current site user appears in fedora audit trail
         xml, uri = new_obj.api.getObjectXML(pid)
         self.assert_('<audit:responsibility>%s</audit:responsibility>' % \
@@ -320,7 +361,152 @@ class FileViewsTest(EulcoreTestCase):
             self.assertEqual(ingest_f.read(), response.content,
                 'download response content should be equivalent to file ingested as master datastream')
             
-        # errors not tested here because they should be handled by eulcore view
+        self.assertEqual('bytes', response['Accept-Ranges'])
+
+    def test_download_errors(self):
+        with patch.object(FileObject, 'has_requisite_content_models', new=False):
+            response = self.client.get(self.download_url)
+            self.assertEqual(404, response.status_code,
+                'master datastream should only be downloaded from file objects')
+
+        # fedora errors should be passed back in the response
+        response = Mock(status=503, reason='Service Unavailable')
+        with patch('genrepo.file.views._master_info',
+                   new=Mock(return_value=(None, RequestFailed(response)))):
+            self.assertEqual(503, self.client.get(self.download_url).status_code)
+        response = Mock(status=401, reason='Unauthorized')
+        with patch('genrepo.file.views._master_info',
+                   new=Mock(return_value=(None, PermissionDenied(response)))):
+            self.assertEqual(403, self.client.get(self.download_url).status_code)
+
+    def test_conditional_get(self):
+        response = self.client.get(self.download_url)
+        self.assertEqual('"%s"' % self.obj.master.checksum, response['ETag'])
+        self.assert_(response.has_header('Last-Modified'))
+        response = self.client.get(self.download_url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code,
+            'unchanged file should not be downloaded again')
+        self.assertEqual('', response.content)
+
+        response = self.client.get(self.view_url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        response = self.client.get(self.view_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        response = self.client.get(self.view_url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(304, response.status_code)
+
+        # page should be sent again when the object is modified
+        obj = self.repo_admin.get_object(self.obj.pid, type=FileObject)
+        obj.dc.content.description = 'changed'
+        obj.save()
+        response = self.client.get(self.view_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+
+    def test_batch_edit(self):
+        batch_url = reverse('file:batch-edit')
+        self.client.login(**NONADMIN_CREDENTIALS)
+        response = self.client.get(batch_url)
+        self.assertEqual(403, response.status_code)
+
+        self.client.post(settings.LOGIN_URL, ADMIN_CREDENTIALS)
+        response = self.client.get(batch_url)
+        self.assert_(isinstance(response.context['form'], BatchEditForm))
+
+        data = {'pids': '%s\ngenrepo-test:bogus' % self.obj.pid, 'field': 'creator',
+                'operation': 'set', 'values': 'Smith, J.\nJones, K.'}
+        response = self.client.post(batch_url, data)
+        edit = response.context['edit']
+        self.assertEqual([self.obj.pid, 'genrepo-test:bogus'], [r.pid for r in edit.results])
+        self.assertEqual(1, edit.changed)
+        self.assertEqual(1, edit.failed)
+        updated = self.repo_admin.get_object(self.obj.pid, type=FileObject)
+        self.assertEqual(['Smith, J.', 'Jones, K.'], list(updated.dc.content.creator_list))
+
+        # json request may change several fields
+        changes = {'pids': [self.obj.pid],
+                   'changes': {'creator': {'remove': ['Jones, K.']},
+                               'subject': {'append': ['maps']},
+                               'title': {'set': 'batch title'}}}
+        response = self.client.post(batch_url, simplejson.dumps(changes),
+                                    content_type='application/json')
+        self.assertEqual(200, response.status_code)
+        data = simplejson.loads(response.content)
+        self.assertEqual(1, data['changed'])
+        self.assertEqual({'pid': self.obj.pid, 'changed': True, 'error': None},
+                         data['results'][0])
+        updated = self.repo_admin.get_object(self.obj.pid, type=FileObject)
+        self.assertEqual(['Smith, J.'], list(updated.dc.content.creator_list))
+        self.assertEqual(['maps'], list(updated.dc.content.subject_list))
+        self.assertEqual('batch title', updated.label)
+
+        # repeating the same changes should not save anything
+        response = self.client.post(batch_url, simplejson.dumps(changes),
+                                    content_type='application/json')
+        self.assertEqual(1, simplejson.loads(response.content)['unchanged'])
+
+        changes['changes'] = {'format': {'set': 'text/html'}}
+        response = self.client.post(batch_url, simplejson.dumps(changes),
+                                    content_type='application/json')
+        self.assertEqual(400, response.status_code)
+
+    def test_download_range(self):
+        response = self.client.get(self.download_url, HTTP_RANGE='bytes=0-4')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual('Hello', response.content)
+        self.assertEqual('bytes 0-4/14', response['Content-Range'])
+        self.assertEqual('5', response['Content-Length'])
+
+        response = self.client.get(self.download_url, HTTP_RANGE='bytes=-7')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual('world!', response.content.strip())
+
+        response = self.client.get(self.download_url, HTTP_RANGE='bytes=0-4,7-11')
+        self.assertEqual(206, response.status_code)
+        self.assert_(response['Content-Type'].startswith('multipart/byteranges'))
+        self.assert_('Content-Range: bytes 7-11/14' in response.content)
+
+        response = self.client.get(self.download_url, HTTP_RANGE='bytes=100-200')
+        self.assertEqual(416, response.status_code)
+        self.assertEqual('bytes */14', response['Content-Range'])
+
+        # range should be ignored if the file has changed since If-Range
+        response = self.client.get(self.download_url, HTTP_RANGE='bytes=0-4',
+                                   HTTP_IF_RANGE='"not-the-current-etag"')
+        self.assertEqual(200, response.status_code)
+        etag = response['ETag']
+        response = self.client.get(self.download_url, HTTP_RANGE='bytes=0-4',
+                                   HTTP_IF_RANGE=etag)
+        self.assertEqual(206, response.status_code)
+
+        response = self.client.get(reverse('file:download', args=['genrepo-test:bogus']))
+        self.assertEqual(404, response.status_code)
+
+    def test_download_cached(self):
+        cache_dir = tempfile.mkdtemp(prefix='genrepo-test-cache-')
+        try:
+            with patch.object(settings, 'MASTER_CACHE_DIR', new=cache_dir):
+                response = self.client.get(self.download_url)
+                expected = response.content
+                cached = [files for dirpath, dirnames, files in os.walk(cache_dir) if files]
+                self.assertEqual(1, len(cached), 'full download should be cached')
+
+                # served from the cache, including ranges
+                with patch('genrepo.file.views.DatastreamStream') as mockstream:
+                    response = self.client.get(self.download_url)
+                    self.assertEqual(expected, response.content)
+                    response = self.client.get(self.download_url, HTTP_RANGE='bytes=0-4')
+                    self.assertEqual('Hello', response.content)
+                    self.assertEqual(0, mockstream.call_count,
+                        'cached file should not be read from Fedora')
+
+                    with patch.object(settings, 'XSENDFILE', new=True):
+                        response = self.client.get(self.download_url)
+                        self.assertEqual('', response.content)
+                        self.assert_(response['X-Sendfile'].startswith(cache_dir))
+                        self.assertEqual('attachment; filename=%s' % self.obj.pid,
+                                         response['Content-Disposition'])
+        finally:
+            shutil.rmtree(cache_dir)
 
     def test_view_metadata_min(self):
         # view metadata - minimal fields present
@@ -408,7 +594,950 @@ class FileViewsTest(EulcoreTestCase):
         self.assertEqual(code, expected,
                          'Expected %s but returned %s for GET %s (invalid pid) as AnonymousUser'
                          % (expected, code, view_url))
-        
-        
 
 
+class IngestFormTest(TestCase):
+    'Tests for :class:`genrepo.file.forms.IngestForm`'
+
+    index = [ObjectInfo('coll:1', 'Collection One', (), None),
+             ObjectInfo('coll:2', None, (), None)]
+
+    def setUp(self):
+        _invalidate_collection_options(sender=CollectionObject)
+
+    def tearDown(self):
+        _invalidate_collection_options(sender=CollectionObject)
+
+    def test_collection_options(self):
+        mockaccessible = Mock(side_effect=lambda objs: iter(objs))
+        with patch.object(CollectionObject, 'index', new=Mock(return_value=self.index)):
+            with patch('genrepo.file.forms.accessible', new=mockaccessible):
+                options = _collection_options()
+                self.assertEqual([('', ''), ('info:fedora/coll:1', 'Collection One'),
+                                  ('info:fedora/coll:2', 'coll:2')], options,
+                    'collection options should include blank option and accessible collections')
+                _collection_options()
+                self.assertEqual(1, mockaccessible.call_count,
+                    'collection options should be cached')
+
+                # saving a collection should invalidate the cached options
+                collection_saved.send(sender=CollectionObject, pid='coll:1')
+                _collection_options()
+                self.assertEqual(2, mockaccessible.call_count,
+                    'collection options should be regenerated after a collection is saved')
+
+    def test_collection_validation(self):
+        upload = {'file': SimpleUploadedFile('hello.txt', 'hello world')}
+        mockaccessible = Mock(side_effect=lambda objs: iter(objs))
+        with patch.object(CollectionObject, 'index', new=Mock(return_value=self.index)):
+            with patch('genrepo.file.forms.accessible', new=mockaccessible):
+                form = IngestForm({'collection': 'info:fedora/coll:2'}, upload)
+                self.assertTrue(form.is_valid(),
+                    'form should be valid when an accessible collection is selected')
+                form = IngestForm({'collection': 'info:fedora/coll:3'}, upload)
+                self.assertFalse(form.is_valid(),
+                    'form should not be valid when an unknown collection is selected')
+
+                # when options are cached, they should be used for validation
+                _collection_options()
+                mockaccessible.reset_mock()
+                form = IngestForm({'collection': 'info:fedora/coll:1'}, upload)
+                self.assertTrue(form.is_valid())
+                self.assertEqual(0, mockaccessible.call_count,
+                    'cached collection options should be used to validate collection')
+
+
+class FedoraUploadHandlerTest(TestCase):
+    'Tests for :class:`genrepo.file.upload.FedoraUploadHandler`'
+    fixtures = ['users']
+
+    def setUp(self):
+        self.handler = FedoraUploadHandler(Mock())
+
+    @patch('genrepo.file.upload.current_repository')
+    @patch('genrepo.file.upload.FedoraUpload')
+    def test_stream_to_fedora(self, mockupload, mockrepo):
+        mockupload.return_value.finish.return_value = 'uploaded://42'
+        self.handler.new_file('file', 'hello.txt', 'text/plain', None)
+        self.assertEqual(None, self.handler.receive_data_chunk('hello ', 0),
+            'data sent to Fedora should not be passed to other upload handlers')
+        self.assertEqual(None, self.handler.receive_data_chunk('world', 6))
+        self.assertEqual([(('hello ',), {}), (('world',), {})],
+                         mockupload.return_value.write.call_args_list)
+
+        uploaded = self.handler.file_complete(11)
+        self.assert_(isinstance(uploaded, FedoraUploadedFile))
+        self.assertEqual('uploaded://42', uploaded.upload_id)
+        self.assertEqual('hello.txt', uploaded.name)
+        self.assertEqual(11, uploaded.size)
+        self.assertEqual('text/plain', uploaded.content_type)
+        self.assertEqual({'MD5': '5eb63bbbe01eeed093cb22bb8f5acdc3',
+                          'SHA-1': '2aae6c35c94fcfb415dbe95f408b9ce91ee846ed',
+                          'SHA-256': 'b94d27b9934d3e08a52e52d7da7dabfac484efe37a5380ee9088f7ace2efcde9'},
+                         uploaded.checksums,
+                         'checksums should be calculated from uploaded chunks')
+
+    @patch('genrepo.file.upload.current_repository')
+    @patch('genrepo.file.upload.FedoraUpload')
+    def test_detect_mimetype_in_stream(self, mockupload, mockrepo):
+        mockupload.return_value.finish.return_value = 'uploaded://42'
+        self.handler.new_file('file', 'scan', 'application/octet-stream', None)
+        self.handler.receive_data_chunk('%PDF-1.4\n', 0)
+        self.handler.receive_data_chunk('x' * SNIFF_SIZE, 9)
+        self.assertEqual('application/pdf', self.handler.mimetype,
+            'mimetype should be detected once enough data is received')
+        uploaded = self.handler.file_complete(SNIFF_SIZE + 9)
+        self.assertEqual('application/pdf', uploaded.content_type)
+
+    def test_detect_mimetype(self):
+        self.assertEqual('application/pdf',
+            detect_mimetype('%PDF-1.4\n', 'document.txt', 'text/plain'),
+            'mimetype detected from content should be preferred')
+        self.assertEqual('text/html', detect_mimetype('hello world', 'hello.html'),
+            'mimetype for the file name should be used when content is generic')
+        self.assertEqual('text/plain', detect_mimetype('hello world', 'hello'))
+        self.assertEqual('application/octet-stream', detect_mimetype('', 'empty'))
+
+    @patch('genrepo.file.upload.current_repository')
+    @patch('genrepo.file.upload.FedoraUpload')
+    def test_fallback(self, mockupload, mockrepo):
+        # if the upload can't be started, data goes to the next handler
+        mockupload.side_effect = socket.error('connection refused')
+        self.handler.new_file('file', 'hello.txt', 'text/plain', None)
+        self.assertEqual('hello', self.handler.receive_data_chunk('hello', 0))
+        self.assertEqual(None, self.handler.file_complete(5))
+
+    @patch('genrepo.file.upload.current_repository')
+    @patch('genrepo.file.upload.FedoraUpload')
+    def test_upload_error(self, mockupload, mockrepo):
+        mockupload.return_value.write.side_effect = socket.error('connection reset')
+        self.handler.new_file('file', 'hello.txt', 'text/plain', None)
+        self.assertEqual(None, self.handler.receive_data_chunk('hello', 0))
+        self.assertEqual(None, self.handler.receive_data_chunk('world', 5))
+        self.assertEqual(1, mockupload.return_value.write.call_count,
+            'no more data should be sent after an upload error')
+        uploaded = self.handler.file_complete(10)
+        self.assert_(isinstance(uploaded, FedoraUploadedFile),
+            'failed upload should be returned, so it is not handled as an empty file')
+        self.assertEqual(None, uploaded.upload_id)
+        self.assertEqual('connection reset', uploaded.error)
+        self.assertFalse(mockupload.return_value.finish.called)
+
+        form = IngestForm({}, {'file': uploaded})
+        self.assertFalse(form.is_valid())
+        self.assert_('connection reset' in form.errors['file'][0],
+            'upload error should be reported by the ingest form')
+
+        # error completing the upload
+        mockupload.return_value.write.side_effect = None
+        mockupload.return_value.finish.side_effect = socket.error('timed out')
+        self.handler.new_file('file', 'hello.txt', 'text/plain', None)
+        self.handler.receive_data_chunk('hello', 0)
+        uploaded = self.handler.file_complete(5)
+        self.assertEqual(None, uploaded.upload_id)
+        self.assertEqual('timed out', uploaded.error)
+
+    @patch('genrepo.file.views.FedoraUploadHandler')
+    @patch('genrepo.file.views.ingest_file')
+    def test_upload_handler_csrf(self, mockingest, mockhandler):
+        # files are only streamed to Fedora for requests with a CSRF cookie
+        mockhandler.side_effect = lambda request: MemoryFileUploadHandler(request)
+        self.client.login(**ADMIN_CREDENTIALS)
+        with patch.object(CollectionChoiceField, 'valid_value', new=Mock(return_value=True)):
+            self.client.post(reverse('file:ingest'),
+                {'collection': 'info:fedora/coll:1',
+                 'file': SimpleUploadedFile('hello.txt', 'hello world')})
+            self.assertFalse(mockhandler.called,
+                'file should not be sent to Fedora without a CSRF cookie')
+
+            self.client.cookies[settings.CSRF_COOKIE_NAME] = 'token'
+            self.client.post(reverse('file:ingest'),
+                {'collection': 'info:fedora/coll:1',
+                 'file': SimpleUploadedFile('hello.txt', 'hello world')})
+            self.assert_(mockhandler.called)
+
+
+class BulkIngestTest(TestCase):
+    'Tests for :mod:`genrepo.file.bulk`'
+
+    files = {'one.txt': 'one fish', 'sub/two.txt': 'two fish', 'sub/red.txt': 'red fish'}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='genrepo-bulk-')
+        self.filedir = os.path.join(self.tmpdir, 'files')
+        os.makedirs(os.path.join(self.filedir, 'sub'))
+        for name, content in self.files.iteritems():
+            with open(os.path.join(self.filedir, name), 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def entry_contents(self, path):
+        contents = {}
+        for entry in archive_entries(path):
+            f = entry.open()
+            contents[entry.name] = f.read()
+            f.close()
+            self.assertEqual(len(contents[entry.name]), entry.size)
+        return contents
+
+    def test_archive_entries(self):
+        self.assertEqual(self.files, self.entry_contents(self.filedir),
+            'directory entries should include all files in subdirectories')
+
+        zip_path = os.path.join(self.tmpdir, 'files.zip')
+        archive = zipfile.ZipFile(zip_path, 'w')
+        for name in self.files:
+            archive.write(os.path.join(self.filedir, name), name)
+        archive.close()
+        self.assertEqual(self.files, self.entry_contents(zip_path))
+
+        tar_path = os.path.join(self.tmpdir, 'files.tar.gz')
+        archive = tarfile.open(tar_path, 'w:gz')
+        archive.add(self.filedir, 'files')
+        archive.close()
+        expected = dict(('files/' + name, content) for name, content in self.files.iteritems())
+        self.assertEqual(expected, self.entry_contents(tar_path))
+
+        self.assertRaises(ValueError, archive_entries, os.path.join(self.filedir, 'one.txt'))
+
+    def test_run(self):
+        ingest = BulkIngest(Mock(), 'info:fedora/coll:1', workers=3)
+        def ingest_entry(entry):
+            if entry.name == 'bad':
+                return BulkIngestResult(entry.name, entry.size, None, 'error')
+            return BulkIngestResult(entry.name, entry.size, 'pid:%s' % entry.name, None)
+        ingest.ingest_entry = ingest_entry
+        entries = [ArchiveEntry(str(i), 10, None) for i in range(20)] + \
+                  [ArchiveEntry('bad', 5, None)]
+        results = ingest.run(entries)
+        self.assertEqual([e.name for e in entries], [r.name for r in results],
+            'results should be returned in entry order')
+        self.assertEqual(20, ingest.succeeded)
+        self.assertEqual(1, ingest.failed)
+        self.assertEqual(200, ingest.total_size)
+        self.assert_(ingest.elapsed is not None)
+
+    @patch('genrepo.file.bulk.ingest_local_file')
+    def test_ingest_entry(self, mockingest):
+        ingest = BulkIngest(Mock(), 'info:fedora/coll:1', workers=1)
+        entry = ArchiveEntry('sub/two.txt', 8,
+                             lambda: open(os.path.join(self.filedir, 'sub', 'two.txt')))
+        mockingest.return_value = Mock(pid='file:1', duplicate=False)
+        result = ingest.ingest_entry(entry)
+        self.assertEqual('file:1', result.pid)
+        self.assertEqual(None, result.warning)
+        self.assertEqual('two.txt', mockingest.call_args[0][2],
+            'file should be ingested with its base name')
+
+        mockingest.return_value = Mock(pid='file:2', duplicate=True)
+        result = ingest.ingest_entry(entry)
+        self.assertEqual('file:2', result.pid)
+        self.assertEqual('duplicate of file:2', result.warning,
+            'existing object used for a duplicate file should be reported')
+
+        mockingest.side_effect = ValueError('bad file')
+        result = ingest.ingest_entry(entry)
+        self.assertEqual(None, result.pid)
+        self.assertEqual('bad file', result.error)
+
+    def test_pool_imap(self):
+        taken = []
+        def items():
+            for i in range(100):
+                taken.append(i)
+                yield i
+        results = pool_imap(lambda i: i * 2, items(), 3)
+        self.assertEqual([0, 2, 4], [results.next() for i in range(3)],
+            'results should be generated in item order')
+        self.assert_(len(taken) <= 9,
+            'only a few items should be taken ahead of the results consumed')
+        results.close()
+
+        def fail(i):
+            if i == 2:
+                raise ValueError('bad item')
+            return i
+        results = pool_imap(fail, range(5), 2)
+        self.assertEqual([0, 1], [results.next() for i in range(2)])
+        self.assertRaises(ValueError, results.next)
+
+    @patch('genrepo.file.models.upload_file')
+    def test_ingest_entry_error(self, mockupload):
+        mockupload.side_effect = socket.error('connection refused')
+        ingest = BulkIngest(Mock(), 'info:fedora/coll:1')
+        entry = list(archive_entries(self.filedir))[0]
+        result = ingest.ingest_entry(entry)
+        self.assertFalse(result.success)
+        self.assertEqual(None, result.pid)
+        self.assert_('connection refused' in result.error)
+
+
+class IngestJobTest(TestCase):
+    'Tests for background ingest with :class:`genrepo.file.models.IngestJob`'
+    fixtures = ['users']
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(prefix='genrepo-job-')
+        os.write(fd, 'hello world')
+        os.close(fd)
+        self.job = IngestJob.objects.create(username=ADMIN_CREDENTIALS['username'],
+            session_key='abc', collection='info:fedora/coll:1', filename='hello.txt',
+            path=self.path, size=11)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_claim_next(self):
+        other = IngestJob.objects.create(username='someone', session_key='def',
+            collection='info:fedora/coll:1', filename='other.txt', path='/tmp/other', size=5)
+        job = IngestJob.claim_next()
+        self.assertEqual(self.job.pk, job.pk, 'oldest queued job should be claimed first')
+        self.assertEqual(IngestJob.RUNNING, job.status)
+        self.assert_(job.started is not None)
+        self.assertEqual(other.pk, IngestJob.claim_next().pk)
+        self.assertEqual(None, IngestJob.claim_next(),
+            'no job should be claimed when none are queued')
+
+    def test_fail_stale(self):
+        job = IngestJob.claim_next()
+        self.assertEqual(0, IngestJob.fail_stale())
+        IngestJob.objects.filter(pk=job.pk).update(started=datetime.now() - timedelta(hours=1))
+        with patch.object(settings, 'INGEST_JOB_TIMEOUT', new=60):
+            self.assertEqual(None, IngestJob.claim_next())
+        job = IngestJob.objects.get(pk=job.pk)
+        self.assertEqual(IngestJob.FAILED, job.status,
+            'job running for longer than the timeout should be failed')
+        self.assert_(job.error)
+        self.assert_(job.finished is not None)
+        self.assertFalse(os.path.exists(self.path),
+            'staged file for a stale job should be removed')
+
+    @patch('genrepo.file.jobs.ingest_local_file')
+    @patch('genrepo.file.jobs.job_repository')
+    def test_run_job(self, mockrepo, mockingest):
+        mockingest.return_value.pid = 'file:1'
+        mockingest.return_value.duplicate = False
+        job = run_job(IngestJob.claim_next())
+        self.assertEqual(IngestJob.COMPLETE, job.status)
+        self.assertEqual('file:1', IngestJob.objects.get(pk=job.pk).pid)
+        self.assertEqual(11, job.bytes_uploaded)
+        self.assert_(job.finished is not None)
+        self.assertEqual('hello.txt', mockingest.call_args[0][2])
+        self.assertEqual('info:fedora/coll:1', mockingest.call_args[0][3])
+        self.assertFalse(os.path.exists(self.path),
+            'uploaded file should be removed when the job is finished')
+
+        # errors should be recorded on the job
+        fd, self.path = tempfile.mkstemp(prefix='genrepo-job-')
+        os.close(fd)
+        job = IngestJob.objects.create(username='someone', session_key='abc',
+            collection='info:fedora/coll:1', filename='hello.txt', path=self.path, size=0)
+        mockingest.side_effect = socket.error('connection refused')
+        job = run_job(IngestJob.claim_next())
+        self.assertEqual(IngestJob.FAILED, job.status)
+        self.assert_('connection refused' in IngestJob.objects.get(pk=job.pk).error)
+
+    def test_status_view(self):
+        status_url = reverse('file:ingest-job-status', args=[self.job.pk])
+        self.client.login(**ADMIN_CREDENTIALS)
+        response = self.client.get(status_url)
+        self.assertEqual('application/json', response['Content-Type'])
+        progress = simplejson.loads(response.content)
+        self.assertEqual(self.job.pk, progress['id'])
+        self.assertEqual(IngestJob.QUEUED, progress['status'])
+        self.assertEqual(11, progress['size'])
+
+        response = self.client.get(reverse('file:ingest-job', args=[self.job.pk]))
+        self.assertContains(response, 'hello.txt')
+        self.assertContains(response, status_url)
+
+        # a duplicate used instead of a new object should be reported
+        self.job.status, self.job.pid, self.job.duplicate = IngestJob.COMPLETE, 'file:1', True
+        self.job.save()
+        response = self.client.get(reverse('file:ingest-job', args=[self.job.pk]))
+        self.assertContains(response, 'already in the repository')
+        self.assert_(simplejson.loads(self.client.get(status_url).content)['duplicate'])
+
+        # jobs are only visible to the user who submitted them
+        self.job.username = 'someone'
+        self.job.save()
+        response = self.client.get(status_url)
+        self.assertEqual(404, response.status_code)
+
+    def test_bulk_ingest_queued(self):
+        tmpdir = tempfile.mkdtemp(prefix='genrepo-bulk-')
+        zip_path = os.path.join(tmpdir, 'files.zip')
+        archive = zipfile.ZipFile(zip_path, 'w')
+        archive.writestr('one.txt', 'one fish')
+        archive.writestr('sub/two.txt', 'two fish')
+        archive.close()
+
+        self.client.login(**ADMIN_CREDENTIALS)
+        try:
+            with patch.object(settings, 'INGEST_IN_BACKGROUND', new=True):
+                with patch.object(settings, 'INGEST_JOB_DIR', new=tmpdir):
+                    with patch.object(CollectionChoiceField, 'valid_value',
+                                      new=Mock(return_value=True)):
+                        with patch('genrepo.file.views.BulkIngest') as mockingest:
+                            with open(zip_path, 'rb') as archive_file:
+                                response = self.client.post(reverse('file:bulk-ingest'),
+                                    {'collection': 'info:fedora/coll:1', 'archive': archive_file})
+                            self.assertFalse(mockingest.called,
+                                'files should not be ingested during the request')
+            jobs = IngestJob.objects.exclude(pk=self.job.pk).order_by('pk')
+            self.assertEqual(['one.txt', 'two.txt'], [job.filename for job in jobs])
+            self.assertEqual(1, len(set(job.batch for job in jobs)),
+                'files from one archive should be queued as a single batch')
+            self.assertEqual('two fish', open(jobs[1].path).read())
+            batch_url = reverse('file:ingest-batch', args=[jobs[0].batch])
+            self.assertEqual(303, response.status_code)
+            self.assert_(response['Location'].endswith(batch_url))
+
+            response = self.client.get(batch_url)
+            self.assertContains(response, 'two.txt')
+            self.assertEqual(2, response.context['counts'][IngestJob.QUEUED])
+            self.assertFalse(response.context['finished'])
+
+            # batches are only visible to the user who submitted them
+            jobs.update(username='someone')
+            response = self.client.get(batch_url)
+            self.assertEqual(404, response.status_code)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class UploadSessionTest(TestCase):
+    'Tests for resumable uploads with :class:`genrepo.file.models.UploadSession`'
+    fixtures = ['users']
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(prefix='genrepo-upload-')
+        os.close(fd)
+        self.upload = UploadSession.objects.create(username=ADMIN_CREDENTIALS['username'],
+            filename='hello.txt', size=11, path=self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_append_chunk(self):
+        self.assert_(self.upload.append_chunk('hello', 0))
+        self.assertEqual(5, UploadSession.objects.get(pk=self.upload.pk).offset)
+        self.assertFalse(self.upload.append_chunk('hello', 0),
+            'chunk at an old offset should not be accepted')
+        self.assertFalse(self.upload.append_chunk(' world and more', 5),
+            'chunk past the expected size should not be accepted')
+        self.assert_(self.upload.append_chunk(' world', 5))
+        self.assert_(self.upload.complete)
+        self.assertEqual('hello world', open(self.path).read())
+
+    def test_append_chunk_resent(self):
+        # another request that loaded the upload before the first chunk was written
+        stale = UploadSession.objects.get(pk=self.upload.pk)
+        self.assert_(self.upload.append_chunk('hello', 0))
+        self.assertFalse(self.upload.append_chunk('hello', 0),
+            'the same chunk sent twice should only be accepted once')
+        self.assertFalse(stale.append_chunk('HELLO', 0),
+            'chunk at a stale offset should not be accepted')
+        self.assertEqual('hello', open(self.path).read(),
+            'rejected chunks should not change the uploaded data')
+        self.assert_(self.upload.append_chunk(' world', 5))
+        self.assertFalse(stale.append_chunk('HELLO', 0))
+        self.assertEqual(11, UploadSession.objects.get(pk=self.upload.pk).offset)
+        self.assertEqual('hello world', open(self.path).read())
+
+    def test_upload_chunk_view(self):
+        upload_url = reverse('file:upload', args=[self.upload.pk])
+        self.client.login(**ADMIN_CREDENTIALS)
+        response = self.client.post(upload_url + '?offset=0', 'hello',
+            content_type='application/octet-stream',
+            HTTP_CONTENT_MD5=b64encode(hashlib.md5('hello').digest()))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(5, simplejson.loads(response.content)['offset'])
+
+        # resending the same chunk should report the offset to resume from
+        response = self.client.post(upload_url + '?offset=0', 'hello',
+            content_type='application/octet-stream')
+        self.assertEqual(409, response.status_code)
+        self.assertEqual(5, simplejson.loads(response.content)['offset'])
+
+        # chunk that doesn't match its checksum should be rejected
+        response = self.client.post(upload_url + '?offset=5', ' world',
+            content_type='application/octet-stream',
+            HTTP_CONTENT_MD5=b64encode(hashlib.md5('hello').digest()))
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(5, UploadSession.objects.get(pk=self.upload.pk).offset)
+
+        response = self.client.get(upload_url)
+        self.assertEqual(5, simplejson.loads(response.content)['offset'])
+
+        # uploads are only visible to the user who started them
+        self.upload.username = 'someone'
+        self.upload.save()
+        response = self.client.get(upload_url)
+        self.assertEqual(404, response.status_code)
+
+    @patch('genrepo.file.views.ingest_local_file')
+    def test_complete_upload(self, mockingest):
+        complete_url = reverse('file:complete-upload', args=[self.upload.pk])
+        self.client.login(**ADMIN_CREDENTIALS)
+        with patch.object(CollectionChoiceField, 'valid_value', new=Mock(return_value=True)):
+            response = self.client.post(complete_url, {'collection': 'info:fedora/coll:1'})
+            self.assertEqual(409, response.status_code,
+                'incomplete upload should not be ingested')
+
+            self.upload.append_chunk('hello world', 0)
+            mockingest.return_value.pid = 'file:1'
+            mockingest.return_value.duplicate = False
+            response = self.client.post(complete_url, {'collection': 'info:fedora/coll:1'})
+        self.assertEqual(201, response.status_code)
+        self.assertEqual('file:1', simplejson.loads(response.content)['pid'])
+        self.assertEqual('hello.txt', mockingest.call_args[0][2])
+        self.assertEqual('info:fedora/coll:1', mockingest.call_args[0][3])
+        self.assertFalse(os.path.exists(self.path),
+            'uploaded file should be removed once it is ingested')
+        self.assertEqual(0, UploadSession.objects.filter(pk=self.upload.pk).count())
+
+
+class FileObjectTest(TestCase):
+    'Tests for :class:`genrepo.file.models.FileObject`'
+
+    @patch.object(CollectionObject, 'members_changed')
+    @patch.object(CachedDigitalObject, 'save', new=Mock(return_value=True))
+    @patch.object(FileObject, 'is_modified', new=Mock(return_value=True))
+    def test_save_notifies_collections(self, mockchanged):
+        # metadata change that doesn't affect the label
+        obj = FileObject(Mock(), 'file:1')
+        obj.info_modified = False
+        obj.save()
+        self.assertEqual(0, mockchanged.call_count)
+        self.assert_('RELS-EXT' not in obj.dscache,
+            'RELS-EXT should not be retrieved just to notify collections')
+
+        # collections are known when RELS-EXT has already been loaded
+        rels_ext = Mock(name='MockRelsExt')
+        rels_ext._content = rels_ext.content = Graph()
+        rels_ext.content.add((obj.uriref, relsext.isMemberOfCollection,
+                              URIRef('info:fedora/coll:1')))
+        obj.dscache['RELS-EXT'] = rels_ext
+        obj.save()
+        mockchanged.assert_called_with('info:fedora/coll:1')
+
+
+class DeduplicationTest(TestCase):
+    'Tests for duplicate detection with :class:`genrepo.file.models.ContentChecksum`'
+    fixtures = ['users']
+
+    checksum = 'b94d27b9934d3e08a52e52d7da7dabfac484efe37a5380ee9088f7ace2efcde9'  # hello world
+
+    def setUp(self):
+        self.repo = Mock()
+        self.fobj = Mock()
+        self.fobj.exists = True
+        self.fobj.pid = 'file:1'
+        self.fobj.dc.content.identifier_list = ['file:1', 'urn:sha256:%s' % self.checksum]
+        self.fobj.rels_ext.content = set()
+        self.repo.get_object.return_value = self.fobj
+
+    def test_find_duplicate(self):
+        self.assertEqual(None, find_duplicate(self.repo, self.checksum),
+            'no duplicate should be found when the checksum is not indexed')
+        ContentChecksum.objects.create(checksum=self.checksum, pid='file:1')
+        self.assertEqual(self.fobj, find_duplicate(self.repo, self.checksum))
+        self.fobj.dc.content.identifier_list = ['file:1']
+        self.assertEqual(None, find_duplicate(self.repo, self.checksum),
+            'indexed object should not be returned if its content has changed')
+
+    @patch('genrepo.file.models.upload_file')
+    def test_ingest_duplicate(self, mockupload):
+        ContentChecksum.objects.create(checksum=self.checksum, pid='file:1')
+        fileobj = StringIO('hello world')
+        with patch.object(settings, 'DEDUPLICATE_INGEST', new=True):
+            obj = ingest_local_file(self.repo, fileobj, 'hello.txt', 'info:fedora/coll:2')
+        self.assertEqual(self.fobj, obj)
+        self.assert_(obj.duplicate)
+        self.assertEqual(0, mockupload.call_count,
+            'duplicate content should not be uploaded to Fedora')
+        self.assert_((self.fobj.uriref, relsext.isMemberOfCollection,
+                      URIRef('info:fedora/coll:2')) in self.fobj.rels_ext.content,
+            'existing object should be added to the collection')
+        self.assertEqual(1, self.fobj.save.call_count)
+
+        mockupload.return_value.checksums = {}
+        ingest_local_file(self.repo, fileobj, 'hello.txt', 'info:fedora/coll:2')
+        self.assertEqual(1, mockupload.call_count,
+            'content should be uploaded when deduplication is not enabled')
+
+    @patch('genrepo.file.upload.FedoraUpload')
+    @patch('genrepo.file.views.ingest_file')
+    def test_duplicate_warning(self, mockingest, mockupload):
+        # upload to Fedora is skipped, so the file is kept in a temporary file
+        mockupload.side_effect = socket.error('connection refused')
+        mockingest.return_value = Mock(pid='file:1', duplicate=True)
+        self.client.login(**ADMIN_CREDENTIALS)
+        with patch.object(CollectionChoiceField, 'valid_value', new=Mock(return_value=True)):
+            response = self.client.post(reverse('file:ingest'),
+                {'collection': 'info:fedora/coll:1',
+                 'file': SimpleUploadedFile('hello.txt', 'hello world')}, follow=True)
+        messages = list(response.context['messages'])
+        self.assertEqual(1, len(messages))
+        self.assertEqual('warning', messages[0].tags,
+            'user should be warned when a duplicate was used instead of a new object')
+        self.assert_('already in the repository' in str(messages[0]))
+        self.assert_(reverse('file:view', args=['file:1']) in str(messages[0]))
+
+class ManifestIngestTest(TestCase):
+    'Tests for :mod:`genrepo.file.manifest`'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='genrepo-manifest-')
+        for name in ('one.txt', 'two.txt'):
+            with open(os.path.join(self.tmpdir, name), 'w') as f:
+                f.write('%s fish' % name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_manifest(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_read_manifest(self):
+        path = self.write_manifest('manifest.csv',
+            'path,collection,title,subject\n' +
+            'one.txt,coll:1,One Fish,fish | counting\n' +
+            'two.txt,info:fedora/coll:2,,\n')
+        entries = read_manifest(path)
+        self.assertEqual(2, len(entries))
+        self.assertEqual(os.path.join(self.tmpdir, 'one.txt'), entries[0].path,
+            'relative paths should be resolved from the manifest directory')
+        self.assertEqual('info:fedora/coll:1', entries[0].collection)
+        self.assertEqual({'title': ['One Fish'], 'subject': ['fish', 'counting']},
+                         entries[0].metadata)
+        self.assertEqual('info:fedora/coll:2', entries[1].collection)
+        self.assertEqual({}, entries[1].metadata)
+
+        path = self.write_manifest('manifest.json', simplejson.dumps([
+            {'path': 'one.txt', 'collection': 'coll:1', 'creator': ['Seuss', 'Geisel']}]))
+        entries = read_manifest(path)
+        self.assertEqual({'creator': ['Seuss', 'Geisel']}, entries[0].metadata)
+
+        path = self.write_manifest('bad.csv', 'path,collection,colour\none.txt,coll:1,red\n')
+        self.assertRaises(ManifestError, read_manifest, path)
+        path = self.write_manifest('bad.json', '{"path": "one.txt"}')
+        self.assertRaises(ManifestError, read_manifest, path)
+
+    def test_is_transient(self):
+        self.assert_(is_transient(socket.error('connection reset')))
+        response = Mock(status=503, reason='Service Unavailable')
+        self.assert_(is_transient(RequestFailed(response)))
+        response = Mock(status=401, reason='Unauthorized')
+        self.assertFalse(is_transient(PermissionDenied(response)))
+        self.assertFalse(is_transient(ValueError('bad value')))
+
+    @patch('genrepo.file.manifest.ingest_local_file')
+    def test_retry_and_checkpoint(self, mockingest):
+        entries = [ManifestEntry(os.path.join(self.tmpdir, name), 'coll:1')
+                   for name in ('one.txt', 'two.txt')]
+        obj = Mock(pid='file:1', duplicate=False)
+        mockingest.side_effect = [socket.error('connection reset'), obj, obj]
+        checkpoint_path = os.path.join(self.tmpdir, 'checkpoint')
+        checkpoint = Checkpoint(checkpoint_path)
+        ingest = ManifestIngest(Mock(), workers=1, backoff=0, checkpoint=checkpoint)
+        results = ingest.run(entries)
+        checkpoint.close()
+        self.assertEqual(2, ingest.succeeded,
+            'files should be ingested after a transient error is retried')
+        self.assertEqual(3, mockingest.call_count)
+
+        # restarting from the checkpoint should skip files already ingested
+        checkpoint = Checkpoint(checkpoint_path)
+        ingest = ManifestIngest(Mock(), workers=1, checkpoint=checkpoint)
+        results = ingest.run(entries)
+        checkpoint.close()
+        self.assertEqual(2, ingest.skipped)
+        self.assertEqual([], results)
+        self.assertEqual(3, mockingest.call_count)
+
+        # errors that are not transient should not be retried
+        mockingest.side_effect = ValueError('bad content')
+        ingest = ManifestIngest(Mock(), workers=1, backoff=0)
+        results = ingest.run(entries[:1])
+        self.assertFalse(results[0].success)
+        self.assertEqual(4, mockingest.call_count)
+
+    @patch('genrepo.file.manifest.ingest_local_file')
+    def test_duplicate(self, mockingest):
+        entries = [ManifestEntry(os.path.join(self.tmpdir, 'one.txt'), 'coll:1',
+                                 {'title': 'One Fish'}),
+                   ManifestEntry(os.path.join(self.tmpdir, 'two.txt'), 'coll:1')]
+        mockingest.return_value = Mock(pid='file:1', duplicate=True)
+        ingest = ManifestIngest(Mock(), workers=1)
+        results = ingest.run(entries)
+        self.assertEqual(False, mockingest.call_args[1]['deduplicate'],
+            'manifest ingest should not deduplicate unless requested')
+        self.assert_(all(result.success for result in results))
+        self.assertEqual('duplicate of file:1, metadata not applied', results[0].warning,
+            'duplicate should be reported when manifest metadata is not applied')
+        self.assertEqual('duplicate of file:1', results[1].warning)
+
+
+class ParseRangeTest(TestCase):
+    'Tests for :func:`genrepo.file.download.parse_range`'
+
+    def test_parse_range(self):
+        self.assertEqual([ByteRange(0, 499)], parse_range('bytes=0-499', 1000))
+        self.assertEqual([ByteRange(500, 999)], parse_range('bytes=500-', 1000))
+        self.assertEqual([ByteRange(900, 999)], parse_range('bytes=-100', 1000))
+        self.assertEqual([ByteRange(0, 999)], parse_range('bytes=-2000', 1000))
+        self.assertEqual([ByteRange(990, 999)], parse_range('bytes=990-1500', 1000),
+            'range past the end of the file should be shortened')
+        self.assertEqual([ByteRange(0, 99), ByteRange(200, 299)],
+                         parse_range('bytes=200-299, 0-99', 1000))
+        self.assertEqual([ByteRange(0, 299)], parse_range('bytes=0-150,100-299', 1000),
+            'overlapping ranges should be combined')
+        self.assertEqual([], parse_range('bytes=1000-1100', 1000),
+            'unsatisfiable range should return an empty list')
+        self.assertEqual([], parse_range('bytes=1000-', 1000),
+            'open-ended range starting at the end of the file is unsatisfiable')
+        self.assertEqual([], parse_range('bytes=1500-,2000-2100', 1000))
+        self.assertEqual([ByteRange(0, 5)], parse_range('bytes=0-5,1000-', 1000),
+            'unsatisfiable range should not invalidate the other ranges')
+        self.assertEqual([ByteRange(0, 5)], parse_range('bytes=1000-1100, 0-5', 1000))
+        self.assertEqual(None, parse_range('bytes=0-5,10-5', 1000),
+            'invalid range should invalidate the whole header')
+        for header in ('items=0-10', 'bytes=abc', 'bytes=10-5', 'bytes=-'):
+            self.assertEqual(None, parse_range(header, 1000),
+                'invalid range %s should be ignored' % header)
+        self.assertEqual(10, ByteRange(0, 9).length)
+        self.assertEqual('bytes 0-9/1000', ByteRange(0, 9).content_range(1000))
+
+
+class ListStream(list):
+    # stand-in for a DatastreamStream: iterable content that can be closed
+    closed = False
+    def close(self):
+        self.closed = True
+
+class DatastreamCacheTest(TestCase):
+    'Tests for :class:`genrepo.file.download.DatastreamCache`'
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='genrepo-test-cache-')
+        self.cache = DatastreamCache(self.cache_dir, max_size=20)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _store(self, pid, content, version='MASTER.0'):
+        stream = ListStream([content[:5], content[5:]])
+        cached = self.cache.caching_stream(stream, pid, 'MASTER', version, len(content))
+        self.assertEqual(content, ''.join(cached))
+        self.assert_(stream.closed)
+
+    def test_store_and_get(self):
+        self.assertEqual(None, self.cache.get('pid:1', 'MASTER', 'MASTER.0'))
+        self._store('pid:1', 'hello world')
+        path = self.cache.get('pid:1', 'MASTER', 'MASTER.0', 11)
+        self.assert_(path.startswith(self.cache_dir))
+        self.assertEqual('hello world', open(path).read())
+        self.assertEqual(None, self.cache.get('pid:1', 'MASTER', 'MASTER.1'),
+            'other datastream versions should not be cached')
+        self.assertEqual(None, self.cache.get('pid:1', 'MASTER', 'MASTER.0', 12),
+            'cached file of the wrong size should be ignored')
+
+        # incomplete download should not be cached
+        stream = ListStream(['hello'])
+        ''.join(self.cache.caching_stream(stream, 'pid:2', 'MASTER', 'MASTER.0', 11))
+        self.assertEqual(None, self.cache.get('pid:2', 'MASTER', 'MASTER.0'))
+        leftover = [f for dirpath, dirnames, files in os.walk(self.cache_dir) for f in files
+                    if f != DatastreamCache.SIZE_FILE]
+        self.assertEqual(1, len(leftover), 'temporary file should be removed')
+
+        # disabled cache or content too large should pass the stream through
+        stream = ListStream()
+        self.assert_(DatastreamCache('', 20).caching_stream(stream, 'pid:3', 'MASTER',
+                                                            'MASTER.0', 11) is stream)
+        self.assert_(self.cache.caching_stream(stream, 'pid:3', 'MASTER',
+                                               'MASTER.0', 21) is stream)
+
+    def test_evict(self):
+        self._store('pid:1', 'first file')
+        path = self.cache.get('pid:1', 'MASTER', 'MASTER.0')
+        os.utime(path, (1, 1))   # least recently used
+        self._store('pid:2', 'second file')
+        self.assertEqual(None, self.cache.get('pid:1', 'MASTER', 'MASTER.0'),
+            'least recently used file should be removed when the cache is full')
+        self.assertNotEqual(None, self.cache.get('pid:2', 'MASTER', 'MASTER.0'))
+        size_file = os.path.join(self.cache_dir, DatastreamCache.SIZE_FILE)
+        self.assertEqual('11', open(size_file).read(),
+            'total size of the cache should be recorded')
+
+        # the cache should only be scanned when it is full
+        with patch('genrepo.file.download.os.walk') as mockwalk:
+            self._store('pid:3', 'red')
+            self.assertEqual(0, mockwalk.call_count)
+        self.assertEqual('14', open(size_file).read())
+
+        # recorded size is corrected when the cache is scanned
+        os.remove(self.cache.get('pid:3', 'MASTER', 'MASTER.0'))
+        self.cache.evict()
+        self.assertEqual('11', open(size_file).read())
+
+
+class MetadataPatchTest(TestCase):
+    'Tests for :class:`genrepo.file.forms.MetadataPatch`'
+
+    def test_validation(self):
+        for changes in ({}, {'identifier': {'set': 'foo'}}, {'creator': {'replace': 'foo'}},
+                        {'title': {'append': 'foo'}}, {'title': {'set': ['one', 'two']}},
+                        {'title': {'set': ''}}, {'type': {'set': 'NotADcmiType'}},
+                        {'subject': {'remove': []}}):
+            self.assertRaises(forms.ValidationError, MetadataPatch, changes)
+        patch = MetadataPatch({'type': {'set': 'Text'}, 'subject': {'append': ' maps '}})
+        self.assertEqual({'type': {'set': ['Text']}, 'subject': {'append': ['maps']}},
+                         patch.changes)
+
+    def test_repeatable_field_validation(self):
+        # values of repeatable fields are validated with the field used for
+        # each value in the formset on the single-object edit form
+        value_field = Mock()
+        value_field.clean.side_effect = forms.ValidationError('Not a valid subject')
+        subject_form = DublinCoreEditForm.formsets['subject_list'].form
+        with patch.dict(subject_form.base_fields, {'val': value_field}):
+            self.assertRaises(forms.ValidationError, MetadataPatch,
+                              {'subject': {'append': 'maps'}})
+            self.assertRaises(forms.ValidationError, MetadataPatch,
+                              {'subject': {'set': ['maps', 'charts']}})
+            MetadataPatch({'subject': {'remove': 'maps'}})
+        self.assertEqual((('maps',), {}), value_field.clean.call_args)
+
+    def test_apply(self):
+        dc = DublinCore()
+        dc.title = 'title'
+        dc.date = '2011'
+        dc.subject_list.extend(['maps', 'charts'])
+        patch = MetadataPatch({'subject': {'remove': 'charts', 'append': ['atlases', 'maps']},
+                               'creator': {'set': ['Smith, J.']},
+                               'date': {'remove': '2011'}})
+        self.assertTrue(patch.apply(dc))
+        self.assertEqual(['maps', 'atlases'], list(dc.subject_list))
+        self.assertEqual(['Smith, J.'], list(dc.creator_list))
+        self.assertEqual(None, dc.date)
+        self.assertFalse(patch.apply(dc), 'applying a patch again should not change anything')
+
+
+class BatchEditTest(TestCase):
+    'Tests for :class:`genrepo.file.batch.BatchEdit`'
+
+    def test_run(self):
+        objs = {}
+        for pid in ('pid:1', 'pid:2', 'pid:3'):
+            obj = Mock(name='MockDigitalObject')
+            obj.pid = pid
+            obj.dc.content = DublinCore()
+            obj.dc.content.title = 'title'
+            objs[pid] = obj
+        objs['pid:2'].dc.content.creator = 'Smith, J.'
+        err_resp = Mock()
+        err_resp.status = 401
+        objs['pid:3'].save.side_effect = PermissionDenied(err_resp)
+        repo = Mock()
+        repo.get_object.side_effect = lambda pid, type: objs[pid]
+
+        edit = BatchEdit(repo, MetadataPatch({'creator': {'set': 'Smith, J.'}}), workers=2)
+        results = edit.run(['pid:1', 'pid:2', 'pid:3'])
+        self.assertEqual(['pid:1', 'pid:2', 'pid:3'], [r.pid for r in results])
+        self.assertEqual((True, None), (results[0].changed, results[0].error))
+        objs['pid:1'].save.assert_called_once_with(BatchEdit.log_message)
+        self.assertEqual((False, None), (results[1].changed, results[1].error))
+        self.assertFalse(objs['pid:2'].save.called, 'unchanged object should not be saved')
+        self.assert_('permission' in results[2].error)
+        self.assertEqual((1, 1, 1), (edit.changed, edit.unchanged, edit.failed))
+
+        # removing the title is not allowed
+        edit = BatchEdit(repo, MetadataPatch({'title': {'remove': 'title'}}))
+        self.assertEqual('Title is required', edit.run(['pid:1'])[0].error)
+
+
+class MetadataImportTest(TestCase):
+    'Tests for :class:`genrepo.file.batch.MetadataImport`'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='genrepo-import-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_csv(self, content):
+        path = os.path.join(self.tmpdir, 'metadata.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(content)
+        return path
+
+    def test_read_metadata_csv(self):
+        path = self.write_csv('pid,title,subject,format,error\n' +
+                              'pid:1,One Fish,fish| counting,text/plain,\n' +
+                              'pid:2,Two | Fish,,,\n')
+        rows = read_metadata_csv(path)
+        self.assertEqual(['pid:1', 'pid:2'], [row.pid for row in rows])
+        self.assertEqual({'title': ['One Fish'], 'subject': ['fish', 'counting']},
+                         rows[0].values,
+            'read-only and error columns should be ignored')
+        self.assertEqual({'title': ['Two | Fish'], 'subject': []}, rows[1].values,
+            'only repeatable fields should be split into multiple values')
+
+        self.assertRaises(MetadataImportError, read_metadata_csv,
+                          self.write_csv('title\nOne Fish\n'))
+        self.assertRaises(MetadataImportError, read_metadata_csv,
+                          self.write_csv('pid,title,colour\npid:1,One Fish,red\n'))
+        self.assertRaises(MetadataImportError, read_metadata_csv,
+                          self.write_csv('pid,title\npid:1,One Fish\npid:1,Two Fish\n'))
+
+    def test_run(self):
+        objs = {}
+        for pid in ('pid:1', 'pid:2', 'pid:3'):
+            obj = Mock(name='MockDigitalObject')
+            obj.pid = pid
+            obj.dc.content = DublinCore()
+            obj.dc.content.title = 'title'
+            obj.dc.content.subject_list.append('fish')
+            objs[pid] = obj
+        objs['pid:2'].is_modified.return_value = False
+        repo = Mock()
+        repo.get_object.side_effect = lambda pid, type: objs[pid]
+        rows = [MetadataRow('pid:1', {'creator': ['Smith, J.'], 'subject': ['fish', 'maps']}),
+                MetadataRow('pid:2', {'title': ['title']}),
+                MetadataRow('pid:3', {'title': []})]
+
+        checkpoint = MetadataCheckpoint(os.path.join(self.tmpdir, 'checkpoint'))
+        metadata_import = MetadataImport(repo, workers=2, checkpoint=checkpoint)
+        results = metadata_import.run(rows)
+        self.assertEqual(['pid:1', 'pid:2', 'pid:3'], [r.pid for r in results])
+        dc = objs['pid:1'].dc.content
+        self.assertEqual(('Smith, J.', ['fish', 'maps'], 'title'),
+                         (dc.creator, list(dc.subject_list), dc.title),
+            'fields in the row should be set; other fields should be unchanged')
+        objs['pid:1'].save.assert_called_once_with(MetadataImport.log_message)
+        self.assertEqual((False, None), (results[1].changed, results[1].error))
+        self.assertFalse(objs['pid:2'].save.called, 'unchanged object should not be saved')
+        self.assert_('title' in results[2].error,
+            'row should be validated as on the edit form')
+        self.assertFalse(objs['pid:3'].save.called)
+        self.assertEqual((1, 1, 1), (metadata_import.changed, metadata_import.unchanged,
+                                     metadata_import.failed))
+        checkpoint.close()
+
+        # rows already imported are skipped; changed rows are imported again
+        rows[1] = MetadataRow('pid:2', {'title': ['new title']})
+        checkpoint = MetadataCheckpoint(os.path.join(self.tmpdir, 'checkpoint'))
+        metadata_import = MetadataImport(repo, checkpoint=checkpoint)
+        results = metadata_import.run(rows)
+        checkpoint.close()
+        self.assertEqual(1, metadata_import.skipped)
+        self.assertEqual(['pid:2', 'pid:3'], [r.pid for r in results])
@@ -0,0 +1,329 @@
+'''Upload handling for ingesting files into Fedora.
+
+:class:`FedoraUploadHandler` sends uploaded files on to the Fedora
+upload endpoint (``management/upload``) in chunks as they are received,
+rather than writing them to a temporary file that then has to be read
+back and sent to Fedora.  The resulting :class:`FedoraUploadedFile`
+holds the Fedora upload id, which can be referenced when the new
+object is ingested; see
+:class:`~genrepo.file.models.FileObject`.  Checksums of the file
+content are calculated as it is received, and the mimetype is
+detected from the first bytes of the file (see
+:func:`detect_mimetype`), so the content never has to be read again.
+
+Upload handlers must be installed before the request body is read; see
+:func:`genrepo.file.views.ingest_form`.
+'''
+
+import hashlib
+import httplib
+import logging
+import mimetools
+import mimetypes
+import socket
+import threading
+
+import magic
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+from eulcore.fedora.util import RequestFailed
+
+from genrepo.repository import current_repository, direct_connection
+
+logger = logging.getLogger(__name__)
+
+CHECKSUM_ALGORITHMS = (
+    # Fedora checksum type, hashlib algorithm
+    ('MD5', 'md5'),
+    ('SHA-1', 'sha1'),
+    ('SHA-256', 'sha256'),
+)
+'checksums calculated for uploaded files'
+
+SNIFF_SIZE = 8192
+'number of bytes at the start of a file used to detect its mimetype'
+
+GENERIC_MIMETYPES = ('application/octet-stream', 'text/plain', 'application/zip')
+'''detected mimetypes that are not specific enough to be preferred over
+the mimetype expected for the file name'''
+
+_magic = threading.local()
+
+def detect_mimetype(data, filename=None, content_type=None):
+    '''Detect the mimetype of a file from the first bytes of its
+    content, using libmagic.  If the content is only recognized as one
+    of the :data:`GENERIC_MIMETYPES` (e.g., text/plain for a CSV file),
+    a more specific mimetype guessed from the file name or reported for
+    the file is used instead.
+
+    :param data: content at the start of the file; only the first
+        :data:`SNIFF_SIZE` bytes are used
+    :param filename: name of the file
+    :param content_type: mimetype reported for the file (e.g., by the
+        browser), if any
+    :returns: mimetype
+    '''
+    detected = None
+    if data:
+        try:
+            # magic instances can't be shared between threads
+            if getattr(_magic, 'mime', None) is None:
+                _magic.mime = magic.Magic(mime=True)
+            detected = _magic.mime.from_buffer(data[:SNIFF_SIZE])
+        except Exception as err:
+            logger.warning('Could not detect mimetype of %s: %s' % (filename, err))
+    if detected:
+        # some versions of libmagic include the charset
+        detected = detected.split(';')[0].strip()
+        if detected not in GENERIC_MIMETYPES:
+            return detected
+
+    guessed = mimetypes.guess_type(filename)[0] if filename else None
+    for mimetype in (guessed, content_type):
+        if mimetype and mimetype not in GENERIC_MIMETYPES:
+            return mimetype
+    return detected or guessed or content_type or 'application/octet-stream'
+
+
+class FedoraUpload(object):
+    '''A single file upload to the Fedora upload endpoint.  The
+    request is sent with chunked transfer encoding, so the size of the
+    file does not need to be known in advance and content is sent as
+    it is written, without being buffered.
+
+    :param repo: :class:`~genrepo.repository.Repository`, used for the
+        Fedora url and credentials
+    :param filename: name of the file being uploaded
+    :param content_type: mimetype of the file being uploaded
+    '''
+    def __init__(self, repo, filename, content_type=None):
+        self.connection, path, headers = direct_connection(repo)
+        self.boundary = mimetools.choose_boundary()
+        self.size = 0
+
+        self.connection.putrequest('POST', path + 'management/upload')
+        self.connection.putheader('Content-Type',
+                                  'multipart/form-data; boundary=%s' % self.boundary)
+        self.connection.putheader('Transfer-Encoding', 'chunked')
+        for header, value in headers.iteritems():
+            self.connection.putheader(header, value)
+        self.connection.endheaders()
+
+        filename = (filename or 'upload').replace('"', '').encode('utf-8')
+        self._send('--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\n' \
+                   'Content-Type: %s\r\n\r\n' % \
+                   (self.boundary, filename, content_type or 'application/octet-stream'))
+
+    def _send(self, data):
+        # send data as a single chunk of the request body
+        if data:
+            self.connection.send('%x\r\n%s\r\n' % (len(data), data))
+
+    def write(self, data):
+        'Send the next portion of the file content to Fedora.'
+        self._send(data)
+        self.size += len(data)
+
+    def finish(self):
+        '''Complete the upload.
+
+        :returns: the upload id assigned by Fedora, for use as the
+            content location of a managed datastream
+        :raises: :class:`~eulcore.fedora.util.RequestFailed` if the
+            upload was not successful
+        '''
+        try:
+            self._send('\r\n--%s--\r\n' % self.boundary)
+            # zero-length chunk marks the end of the request body
+            self.connection.send('0\r\n\r\n')
+            response = self.connection.getresponse()
+            if response.status != httplib.CREATED:
+                raise RequestFailed(response)
+            return response.read().strip()
+        finally:
+            self.connection.close()
+
+    def abort(self):
+        'Abandon the upload; anything sent so far is discarded by Fedora.'
+        self.connection.close()
+
+
+class FedoraUploadedFile(UploadedFile):
+    '''A file that has been uploaded to Fedora by
+    :class:`FedoraUploadHandler`.  The content is not available
+    locally; it can only be referenced by :attr:`upload_id` (e.g., as
+    the content of a new managed datastream) until Fedora discards
+    unused uploads.  :attr:`content_type` is the mimetype detected from
+    the file content (see :func:`detect_mimetype`).
+
+    :attr:`checksums` is a dictionary of hex digests of the file
+    content, keyed on Fedora checksum type (see
+    :data:`CHECKSUM_ALGORITHMS`).
+
+    If the upload to Fedora failed after it was started, :attr:`error`
+    is a message describing the failure and :attr:`upload_id` is None;
+    the file should be rejected when the form is validated.'''
+
+    def __init__(self, upload_id, name, content_type, size, charset, checksums=None,
+                 error=None):
+        super(FedoraUploadedFile, self).__init__(None, name, content_type, size, charset)
+        self.upload_id = upload_id
+        self.checksums = checksums or {}
+        self.error = error
+
+    def __repr__(self):
+        return '<%s: %s (%s)>' % (self.__class__.__name__, self.name, self.upload_id)
+
+
+class FedoraUploadHandler(FileUploadHandler):
+    '''Upload handler that streams each uploaded file to Fedora as it
+    is received, using the credentials of the
+    :func:`~genrepo.repository.current_repository`, and returns a
+    :class:`FedoraUploadedFile`.  At most one chunk of the file is held
+    in memory at a time.
+
+    If the upload to Fedora can't be started, the file is passed on to
+    the next upload handler (normally a temporary file), so that the
+    form can be validated and redisplayed as usual.  If the upload fails
+    partway through, the rest of the file is discarded, and the
+    :class:`FedoraUploadedFile` returned for that field has an
+    :attr:`~FedoraUploadedFile.error` instead of an upload id, so the
+    form can report the failure.
+
+    Checksums of each file are calculated incrementally as chunks are
+    received (see :data:`CHECKSUM_ALGORITHMS`), and the mimetype is
+    detected as soon as the first :data:`SNIFF_SIZE` bytes have been
+    received.'''
+
+    def new_file(self, *args, **kwargs):
+        super(FedoraUploadHandler, self).new_file(*args, **kwargs)
+        self.upload = None
+        self.error = None
+        self.head = ''
+        self.mimetype = None
+        self.hashes = [(checksum_type, hashlib.new(algorithm))
+                       for checksum_type, algorithm in CHECKSUM_ALGORITHMS]
+        try:
+            self.upload = FedoraUpload(current_repository(self.request),
+                                       self.file_name, self.content_type)
+        except (socket.error, httplib.HTTPException) as err:
+            logger.warning('Could not start upload of %s to Fedora (%s); using next upload handler' \
+                           % (self.file_name, err))
+
+    def receive_data_chunk(self, raw_data, start):
+        for checksum_type, hash in self.hashes:
+            hash.update(raw_data)
+        if self.mimetype is None:
+            self.head += raw_data[:SNIFF_SIZE - len(self.head)]
+            if len(self.head) >= SNIFF_SIZE:
+                self.detect_mimetype()
+        if self.upload is None:
+            return raw_data
+        if self.error is None:
+            try:
+                self.write_chunk(raw_data)
+            except (socket.error, httplib.HTTPException) as err:
+                logger.error('Error uploading %s to Fedora: %s' % (self.file_name, err))
+                self.upload.abort()
+                self.error = unicode(err) or repr(err)
+        return None
+
+    def write_chunk(self, raw_data):
+        'Send a chunk of the file being received to Fedora.'
+        self.upload.write(raw_data)
+
+    def file_complete(self, file_size):
+        if self.upload is None:
+            return None
+        upload_id = None
+        if self.error is None:
+            try:
+                upload_id = self.upload.finish()
+                logger.debug('Uploaded %s to Fedora as %s (%d bytes)' % \
+                             (self.file_name, upload_id, file_size))
+            except (RequestFailed, socket.error, httplib.HTTPException) as err:
+                logger.error('Error completing upload of %s to Fedora: %s' % (self.file_name, err))
+                self.error = unicode(err) or repr(err)
+        if self.mimetype is None:
+            # file was smaller than SNIFF_SIZE
+            self.detect_mimetype()
+        # a failed upload is still returned, so the error is not hidden
+        # by the next upload handler reporting an empty file
+        return FedoraUploadedFile(upload_id, self.file_name, self.mimetype,
+                                  file_size, self.charset, self.checksums(), self.error)
+
+    def detect_mimetype(self):
+        'Detect the mimetype of the current file from the content received so far.'
+        self.mimetype = detect_mimetype(self.head, self.file_name, self.content_type)
+        self.head = ''
+
+    def checksums(self):
+        '''Checksums of the content received so far for the current
+        file, as a dictionary of hex digests keyed on Fedora checksum
+        type.'''
+        return dict((checksum_type, hash.hexdigest())
+                    for checksum_type, hash in self.hashes)
+
+
+def file_checksum(fileobj, algorithm='sha256', chunk_size=65536):
+    '''Calculate a checksum of a file-like object from its current
+    position to the end, and then return to that position, so the
+    content can be read again.
+
+    :param fileobj: file-like object
+    :param algorithm: :mod:`hashlib` algorithm name
+    :returns: hex digest, or None if the file is not seekable
+    '''
+    try:
+        start = fileobj.tell()
+    except (AttributeError, IOError):
+        return None
+    hash = hashlib.new(algorithm)
+    while True:
+        data = fileobj.read(chunk_size)
+        if not data:
+            break
+        hash.update(data)
+    fileobj.seek(start)
+    return hash.hexdigest()
+
+def upload_file(repo, fileobj, name, content_type=None, chunk_size=65536, progress=None):
+    '''Upload the contents of a local file (or any file-like object) to
+    Fedora with :class:`FedoraUpload`, reading it one chunk at a time
+    and calculating checksums along the way.  The mimetype is detected
+    from the first chunk (see :func:`detect_mimetype`).
+
+    :param repo: :class:`~genrepo.repository.Repository`, used for the
+        Fedora url and credentials
+    :param fileobj: file-like object to read content from
+    :param name: file name
+    :param content_type: expected mimetype of the file, if known
+    :param chunk_size: number of bytes to read and send at a time
+    :param progress: optional callable, called with the number of
+        bytes sent so far after each chunk
+    :returns: :class:`FedoraUploadedFile`
+    :raises: :class:`~eulcore.fedora.util.RequestFailed`,
+        :class:`socket.error`, or :class:`httplib.HTTPException` if the
+        upload fails
+    '''
+    data = fileobj.read(chunk_size)
+    content_type = detect_mimetype(data, name, content_type)
+    upload = FedoraUpload(repo, name, content_type)
+    hashes = [(checksum_type, hashlib.new(algorithm))
+              for checksum_type, algorithm in CHECKSUM_ALGORITHMS]
+    try:
+        while data:
+            for checksum_type, hash in hashes:
+                hash.update(data)
+            upload.write(data)
+            if progress is not None:
+                progress(upload.size)
+            data = fileobj.read(chunk_size)
+    except:
+        upload.abort()
+        raise
+    upload_id = upload.finish()
+    checksums = dict((checksum_type, hash.hexdigest()) for checksum_type, hash in hashes)
+    return FedoraUploadedFile(upload_id, name, content_type, upload.size, None, checksums)
@@ -2,6 +2,14 @@ from django.conf.urls.defaults import *
 
 urlpatterns = patterns('genrepo.file.views',
     url(r'^ingest/$', 'ingest_form', name='ingest'),
+    url(r'^ingest/bulk/$', 'bulk_ingest', name='bulk-ingest'),
+    url(r'^ingest/uploads/$', 'start_upload', name='start-upload'),
+    url(r'^ingest/uploads/(?P<id>\d+)/$', 'upload_chunk', name='upload'),
+    url(r'^ingest/uploads/(?P<id>\d+)/complete/$', 'complete_upload', name='complete-upload'),
+    url(r'^ingest/jobs/(?P<id>\d+)/$', 'ingest_job', name='ingest-job'),
+    url(r'^ingest/jobs/(?P<id>\d+)/status/$', 'ingest_job_status', name='ingest-job-status'),
+    url(r'^ingest/batches/(?P<batch>[0-9a-f]+)/$', 'ingest_batch', name='ingest-batch'),
+    url(r'^batch-edit/$', 'batch_edit', name='batch-edit'),
     url(r'^(?P<pid>[^/]+)/$', 'view_metadata', name='view'),
     url(r'^(?P<pid>[^/]+)/edit/$', 'edit_metadata', name='edit'),
     url(r'^(?P<pid>[^/]+)/master/$', 'download_file', name='download'),
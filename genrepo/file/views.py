@@ -1,43 +1,93 @@
+from base64 import b64encode
+import calendar
+import hashlib
+import httplib
+import mimetools
+import mimetypes
+import socket
+
+from django import forms
+from django.conf import settings
 from django.contrib import messages
 from django.core.urlresolvers import reverse
-from django.http import Http404
-from rdflib import URIRef
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from django.shortcuts import get_object_or_404
+from django.utils import simplejson
+from django.utils.http import http_date
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import condition, require_POST
 
 from eulcore.django.auth.decorators import permission_required_with_403
-from eulcore.django.fedora.server import Repository
-from eulcore.django.fedora.views import raw_datastream
 from eulcore.django.http import HttpResponseSeeOtherRedirect
 from eulcore.fedora.models import DigitalObjectSaveFailure
-from eulcore.fedora.rdfns import relsext
 from eulcore.fedora.util import RequestFailed, PermissionDenied
 
-from genrepo.file.forms import IngestForm, DublinCoreEditForm
-from genrepo.file.models import FileObject
-from genrepo.util import render_to_response
+from genrepo.collection.models import CollectionObject
+from genrepo.file.batch import BatchEdit
+from genrepo.file.bulk import BulkIngest, archive_entries
+from genrepo.file.download import DatastreamCache, DatastreamStream, \
+     LocalFileStream, MultipartRangeStream, MAX_RANGES, parse_range
+from genrepo.file.forms import IngestForm, BulkIngestForm, DublinCoreEditForm, \
+     UploadSessionForm, UploadCompleteForm, BatchEditForm, MetadataPatch
+from genrepo.file.jobs import queue_entries, queue_ingest, queue_file, staging_path
+from genrepo.file.models import FileObject, IngestJob, UploadSession, ingest_file, \
+     ingest_local_file
+from genrepo.file.upload import FedoraUploadHandler
+from genrepo.repository import Repository, current_repository
+from genrepo.util import render_to_response, page_etag, page_last_modified
 
+@csrf_exempt
 @permission_required_with_403('file.add_file')
 def ingest_form(request):
     """Display or process the file ingest form. On GET, display the form. On
     valid POST, reposit the submitted file in a new digital object.
+
+    Uploaded files are streamed directly to Fedora as they are received
+    (see :class:`~genrepo.file.upload.FedoraUploadHandler`).  If
+    ``INGEST_IN_BACKGROUND`` is enabled, the file is instead queued to
+    be ingested by a background worker (see :mod:`genrepo.file.jobs`),
+    and the user is redirected to a page showing the job progress.
+
+    The upload handler has to be installed before the request body is
+    read, so the file is streamed to Fedora before the CSRF token in
+    the body can be checked.  The user's permission has already been
+    checked at that point, and the content is uploaded with the user's
+    own Fedora credentials; if the CSRF check then fails, the upload is
+    never referenced and Fedora discards it.  Requests without a CSRF
+    cookie would fail the check in any case, so their files are not
+    sent to Fedora at all.
     """
+    # upload handlers must be set before the request body is read, which
+    # the CSRF check would do; CSRF protection is applied below instead
+    if request.method == 'POST' and not _ingest_in_background() and \
+           settings.CSRF_COOKIE_NAME in request.COOKIES:
+        request.upload_handlers.insert(0, FedoraUploadHandler(request))
+    return _ingest_form(request)
+
+def _ingest_in_background():
+    return getattr(settings, 'INGEST_IN_BACKGROUND', False)
+
+@csrf_protect
+def _ingest_form(request):
     if request.method == 'POST':
         form = IngestForm(request.POST, request.FILES)
         if form.is_valid():
-            # TODO: set label/dc:title based on filename;
-            # set file mimetype in dc:format
-            # TODO: file checksum?
-            repo = Repository(request=request)
-            fobj = repo.get_object(type=FileObject)
-            st = (fobj.uriref, relsext.isMemberOfCollection, 
-                  URIRef(form.cleaned_data['collection']))
-            fobj.rels_ext.content.add(st)
-            fobj.master.content = request.FILES['file']
-            # pre-populate the object label and dc:title with the uploaded filename
-            fobj.label = fobj.dc.content.title = request.FILES['file'].name
-            fobj.save('ingesting user content')
-
-            messages.success(request, 'Successfully ingested <a href="%s"><b>%s</b></a>' % \
-                             (reverse('file:view', args=[fobj.pid]), fobj.pid))
+            if _ingest_in_background():
+                job = queue_ingest(request, request.FILES['file'],
+                                   form.cleaned_data['collection'])
+                messages.success(request, 'Queued <b>%s</b> for ingest' % job.filename)
+                return HttpResponseSeeOtherRedirect(reverse('file:ingest-job', args=[job.id]))
+
+            fobj = ingest_file(current_repository(request), request.FILES['file'],
+                               form.cleaned_data['collection'])
+
+            if fobj.duplicate:
+                messages.warning(request, '<b>%s</b> is already in the repository as <a href="%s"><b>%s</b></a>; ' \
+                                 'added it to the collection' % \
+                                 (request.FILES['file'].name, reverse('file:view', args=[fobj.pid]), fobj.pid))
+            else:
+                messages.success(request, 'Successfully ingested <a href="%s"><b>%s</b></a>' % \
+                                 (reverse('file:view', args=[fobj.pid]), fobj.pid))
             return HttpResponseSeeOtherRedirect(reverse('site-index'))
     else:
         initial_data = {}
@@ -49,6 +99,204 @@ def ingest_form(request):
     return render_to_response('file/ingest.html', 
         {'form': form}, request=request)
 
+@permission_required_with_403('file.add_file')
+def ingest_job(request, id):
+    """Display the status of a background
+    :class:`~genrepo.file.models.IngestJob`; the page polls
+    :meth:`ingest_job_status` for progress.  Only available to the user
+    who submitted the job (or a superuser)."""
+    job = _get_ingest_job(request, id)
+    return render_to_response('file/ingest_job.html',
+        {'job': job}, request=request)
+
+@permission_required_with_403('file.add_file')
+def ingest_job_status(request, id):
+    """Status and progress of a background
+    :class:`~genrepo.file.models.IngestJob`, as JSON."""
+    job = _get_ingest_job(request, id)
+    return _json_response(job.progress())
+
+def _json_response(data, status=200):
+    response = HttpResponse(simplejson.dumps(data), mimetype='application/json',
+                            status=status)
+    # status and progress information changes; don't let browsers cache it
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+def _get_ingest_job(request, id):
+    # get a job visible to the current user, or 404
+    job = get_object_or_404(IngestJob, pk=id)
+    if job.username != request.user.username and not request.user.is_superuser:
+        raise Http404
+    return job
+
+@permission_required_with_403('file.add_file')
+@require_POST
+def start_upload(request):
+    """Start a resumable, chunked upload of a large file, to be
+    ingested when the upload is complete.  Expects POSTed ``filename``
+    and ``size`` (in bytes); returns the new upload status as JSON with
+    a 201 Created response, with the url for the upload (see
+    :meth:`upload_chunk`) in the Location header."""
+    form = UploadSessionForm(request.POST)
+    if not form.is_valid():
+        return _json_response({'errors': form.errors}, status=400)
+    # clean up any abandoned uploads before starting a new one
+    UploadSession.remove_expired()
+    upload = UploadSession.objects.create(username=request.user.username,
+                                          filename=form.cleaned_data['filename'],
+                                          size=form.cleaned_data['size'],
+                                          path=staging_path('upload-'))
+    response = _json_response(upload.progress(), status=201)
+    response['Location'] = reverse('file:upload', args=[upload.id])
+    return response
+
+@permission_required_with_403('file.add_file')
+def upload_chunk(request, id):
+    """On GET, return the status of a resumable upload as JSON,
+    including the ``offset`` where the next chunk should start.  On
+    POST, append the request body as the next chunk of the file; the
+    ``offset`` of the chunk must be specified as a url parameter, and
+    should match the current upload offset.  If a ``Content-MD5``
+    header is included, the chunk is only accepted if it matches.
+
+    Returns the upload status as JSON; 409 Conflict if the offset does
+    not match (the returned status includes the offset to resume
+    from), 400 Bad Request if the chunk checksum does not match, or
+    413 if the chunk is larger than ``UPLOAD_CHUNK_MAX_SIZE``.
+    """
+    upload = _get_upload(request, id)
+    if request.method == 'POST':
+        try:
+            offset = int(request.GET['offset'])
+        except (KeyError, ValueError):
+            return _json_response({'error': 'chunk offset is required'}, status=400)
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+        if length > getattr(settings, 'UPLOAD_CHUNK_MAX_SIZE', 16777216):
+            return _json_response({'error': 'chunk is too large'}, status=413)
+
+        data = request.raw_post_data
+        md5 = request.META.get('HTTP_CONTENT_MD5', None)
+        if md5 is not None and b64encode(hashlib.md5(data).digest()) != md5:
+            status = upload.progress()
+            status['error'] = 'chunk checksum does not match'
+            return _json_response(status, status=400)
+        if not upload.append_chunk(data, offset):
+            status = UploadSession.objects.get(pk=upload.pk).progress()
+            status['error'] = 'chunk offset does not match upload offset'
+            return _json_response(status, status=409)
+    return _json_response(upload.progress())
+
+@permission_required_with_403('file.add_file')
+@require_POST
+def complete_upload(request, id):
+    """Ingest the file from a completed resumable upload into the
+    POSTed ``collection``, with a single repository write.  Returns the
+    pid and url of the new object as JSON, with a 201 Created
+    response; ``duplicate`` is true if an existing object with the same
+    content was added to the collection instead.  If
+    ``INGEST_IN_BACKGROUND`` is enabled, the file is queued for ingest
+    instead, and the job status is returned with a 202 Accepted
+    response."""
+    upload = _get_upload(request, id)
+    form = UploadCompleteForm(request.POST)
+    if not form.is_valid():
+        return _json_response({'errors': form.errors}, status=400)
+    if not upload.complete:
+        status = upload.progress()
+        status['error'] = 'upload is not complete'
+        return _json_response(status, status=409)
+
+    if _ingest_in_background():
+        job = queue_file(request, upload.path, upload.filename, upload.size,
+                         form.cleaned_data['collection'])
+        upload.delete()
+        status = job.progress()
+        status['url'] = reverse('file:ingest-job', args=[job.id])
+        return _json_response(status, status=202)
+
+    repo = current_repository(request)
+    try:
+        with open(upload.path, 'rb') as content:
+            fobj = ingest_local_file(repo, content, upload.filename,
+                                     form.cleaned_data['collection'],
+                                     content_type=mimetypes.guess_type(upload.filename)[0])
+    except (DigitalObjectSaveFailure, RequestFailed, socket.error, httplib.HTTPException) as err:
+        # keep the upload, so ingest can be tried again
+        return _json_response({'error': 'There was an error communicating with the repository: %s' % err},
+                              status=getattr(err, 'code', None) or 500)
+    upload.discard()
+    return _json_response({'pid': fobj.pid, 'url': reverse('file:view', args=[fobj.pid]),
+                           'duplicate': fobj.duplicate},
+                          status=201)
+
+def _get_upload(request, id):
+    # get an upload started by the current user, or 404
+    return get_object_or_404(UploadSession, pk=id, username=request.user.username)
+
+@permission_required_with_403('file.add_file')
+def bulk_ingest(request):
+    """Display or process the bulk ingest form.  On GET, display the
+    form.  On valid POST, ingest every file in the submitted archive
+    or server directory as a new digital object in the selected
+    collection.
+
+    If ``INGEST_IN_BACKGROUND`` is enabled, each file is queued for
+    ingest by a background worker (see :func:`~genrepo.file.jobs.queue_entries`)
+    and the user is redirected to a page showing the status of the
+    queued files.  Otherwise, the files are ingested while the request
+    is processed (see :class:`~genrepo.file.bulk.BulkIngest`), and the
+    result for each file is displayed.
+    """
+    ingest = None
+    if request.method == 'POST':
+        form = BulkIngestForm(request.POST, request.FILES)
+        if form.is_valid():
+            entries = archive_entries(form.cleaned_data['path'])
+            if _ingest_in_background():
+                batch = queue_entries(request, entries, form.cleaned_data['collection'])
+                messages.success(request, 'Queued %d files for ingest' % \
+                                 IngestJob.objects.filter(batch=batch).count())
+                return HttpResponseSeeOtherRedirect(reverse('file:ingest-batch', args=[batch]))
+
+            # worker threads share the repository, so it should not
+            # keep every ingested object for the rest of the request
+            ingest = BulkIngest(Repository(request=request), form.cleaned_data['collection'])
+            ingest.run(entries)
+            if ingest.failed:
+                messages.error(request, 'Ingested %d of %d files; see below for errors.' % \
+                               (ingest.succeeded, len(ingest.results)))
+            else:
+                messages.success(request, 'Successfully ingested %d files' % ingest.succeeded)
+    else:
+        initial_data = {}
+        if 'collection' in request.GET:
+            initial_data['collection'] = request.GET['collection']
+        form = BulkIngestForm(initial=initial_data)
+    return render_to_response('file/bulk_ingest.html',
+        {'form': form, 'ingest': ingest}, request=request)
+
+@permission_required_with_403('file.add_file')
+def ingest_batch(request, batch):
+    """Display the status of a batch of background
+    :class:`~genrepo.file.models.IngestJob` queued together by
+    :meth:`bulk_ingest`; the page reloads until every job is finished.
+    Only available to the user who submitted the jobs (or a
+    superuser)."""
+    jobs = IngestJob.objects.filter(batch=batch)
+    if not request.user.is_superuser:
+        jobs = jobs.filter(username=request.user.username)
+    jobs = list(jobs)
+    if not jobs:
+        raise Http404
+    counts = dict((status, 0) for status, label in IngestJob.STATUS_CHOICES)
+    for job in jobs:
+        counts[job.status] += 1
+    return render_to_response('file/ingest_batch.html',
+        {'jobs': jobs, 'counts': counts,
+         'finished': counts[IngestJob.COMPLETE] + counts[IngestJob.FAILED] == len(jobs)},
+        request=request)
+
 @permission_required_with_403('file.change_file')
 def edit_metadata(request, pid):
     """View to edit the metadata for an existing
@@ -58,7 +306,7 @@ def edit_metadata(request, pid):
     thes object.
     """
     status_code = None
-    repo = Repository(request=request)
+    repo = current_repository(request)
     # get the object (if pid is not None), or create a new instance
     obj = repo.get_object(pid, type=FileObject)
    
@@ -74,6 +322,11 @@ def edit_metadata(request, pid):
             form.update_instance()
             # also use dc:title as object label
             obj.label = obj.dc.content.title
+            if not obj.is_modified():
+                # nothing to save; don't create a new version in Fedora
+                messages.info(request, 'No changes to save for <a href="%s"><b>%s</b></a>' % \
+                              (reverse('file:view', args=[obj.pid]), obj.pid))
+                return HttpResponseSeeOtherRedirect(reverse('site-index'))
             try:
                 result = obj.save('updated metadata')
                 messages.success(request,
@@ -102,8 +355,110 @@ def edit_metadata(request, pid):
         response.status_code = status_code
     return response
 
+@permission_required_with_403('file.change_file')
+def batch_edit(request):
+    """Change Dublin Core metadata for many
+    :class:`~genrepo.file.models.FileObject` instances at once, selected
+    by pid or as all members of a collection.  Objects are saved by a
+    bounded pool of worker threads (see
+    :class:`~genrepo.file.batch.BatchEdit`); objects that already have
+    the requested values are not saved.
+
+    On GET, display the form.  On valid POST, change one field (see
+    :class:`~genrepo.file.forms.BatchEditForm`) and display the result
+    for each object.
+
+    A POST with a JSON request body may change several fields at once.
+    The body should contain either ``pids`` (a list) or ``collection``,
+    and ``changes`` (see :class:`~genrepo.file.forms.MetadataPatch`);
+    the result for each object is returned as JSON, or 400 Bad Request
+    if the request is not valid.
+    """
+    if request.method == 'POST' and \
+           request.META.get('CONTENT_TYPE', '').startswith('application/json'):
+        return _batch_edit_json(request)
+
+    edit = None
+    if request.method == 'POST':
+        form = BatchEditForm(request.POST)
+        if form.is_valid():
+            edit = _run_batch_edit(request, form.cleaned_data['patch'],
+                                   form.cleaned_data['pids'], form.cleaned_data['collection'])
+            if edit.failed:
+                messages.error(request, 'Updated %d of %d items; see below for errors.' % \
+                               (edit.changed, len(edit.results)))
+            else:
+                messages.success(request, 'Successfully updated %d items' % edit.changed)
+    else:
+        initial_data = {}
+        if 'collection' in request.GET:
+            initial_data['collection'] = request.GET['collection']
+        form = BatchEditForm(initial=initial_data)
+    return render_to_response('file/batch_edit.html',
+        {'form': form, 'edit': edit}, request=request)
+
+def _batch_edit_json(request):
+    try:
+        data = simplejson.loads(request.raw_post_data)
+        if not isinstance(data, dict):
+            raise ValueError('request must be a JSON object')
+    except ValueError as err:
+        return _json_response({'errors': ['Invalid JSON: %s' % err]}, status=400)
+    try:
+        patch = MetadataPatch(data.get('changes'))
+    except forms.ValidationError as err:
+        return _json_response({'errors': err.messages}, status=400)
+
+    pids = data.get('pids') or []
+    collection = data.get('collection')
+    if bool(pids) == bool(collection):
+        return _json_response({'errors': ['Please specify either pids or a collection.']},
+                              status=400)
+    if collection:
+        if not collection.startswith('info:fedora/'):
+            collection = 'info:fedora/' + collection
+        if not BatchEditForm.base_fields['collection'].valid_value(collection):
+            return _json_response({'errors': ['%s is not an available collection.' % collection]},
+                                  status=400)
+
+    edit = _run_batch_edit(request, patch, pids, collection)
+    return _json_response({'changed': edit.changed, 'unchanged': edit.unchanged,
+                           'failed': edit.failed,
+                           'results': [result._asdict() for result in edit.results]})
+
+def _run_batch_edit(request, patch, pids, collection_uri=None):
+    # apply a metadata patch to the specified pids or collection members;
+    # objects are edited in worker threads, with a repository that doesn't
+    # keep every object for the rest of the request
+    if collection_uri:
+        coll = current_repository(request).get_object(collection_uri, type=CollectionObject)
+        pids = [info.pid for info in coll.members]
+    edit = BatchEdit(Repository(request=request), patch)
+    edit.run(pids)
+    return edit
+
+def _file_modified(request, pid):
+    # last modification date of a file object, for conditional GET;
+    # None if the object is not accessible
+    obj = current_repository(request).get_object(pid, type=FileObject)
+    try:
+        return obj.modified
+    except RequestFailed:
+        return None
+
+def _file_etag(request, pid):
+    modified = _file_modified(request, pid)
+    if modified is not None:
+        return page_etag(request, modified)
+
+def _file_last_modified(request, pid):
+    return page_last_modified(request, _file_modified(request, pid))
+
+@condition(etag_func=_file_etag, last_modified_func=_file_last_modified)
 def view_metadata(request, pid):
-    repo = Repository(request=request)
+    '''View the metadata for a :class:`~genrepo.file.models.FileObject`.
+    Supports conditional GET, based on the object modification date.'''
+    repo = current_repository(request)
     obj = repo.get_object(pid, type=FileObject)
     # if the object doesn't exist or user doesn't have sufficient
     # permissions to know that it exists, 404
@@ -113,14 +468,145 @@ def view_metadata(request, pid):
             {'obj': obj}, request=request)
 
 
+def _master_info(request, pid):
+    # datastream profile for the master file, retrieved only once per
+    # request; returns a tuple of profile and error (if the profile
+    # could not be retrieved)
+    if not hasattr(request, '_genrepo_master_info'):
+        obj = current_repository(request).get_object(pid, type=FileObject)
+        try:
+            request._genrepo_master_info = \
+                (obj.getDatastreamProfile(FileObject.master.id), None)
+        except RequestFailed as rf:
+            request._genrepo_master_info = (None, rf)
+    return request._genrepo_master_info
+
+def _master_etag(request, pid):
+    # the master checksum identifies the content, regardless of user
+    info = _master_info(request, pid)[0]
+    if info is not None and info.checksum_type != 'DISABLED' and info.checksum:
+        return info.checksum
+
+def _master_last_modified(request, pid):
+    info = _master_info(request, pid)[0]
+    if info is not None:
+        return info.created
+
+def _download_error(rf):
+    # response for a Fedora error when downloading: 404 if the object or
+    # datastream does not exist, 403 if the current user may not read
+    # it; otherwise, pass the fedora error code back in the response
+    if rf.code == 404:
+        raise Http404
+    if isinstance(rf, PermissionDenied):
+        return HttpResponseForbidden('You don\'t have permission to download this file.')
+    return HttpResponse('There was an error communicating with the repository.',
+                        mimetype='text/plain', status=rf.code)
+
+@condition(etag_func=_master_etag, last_modified_func=_master_last_modified)
 def download_file(request, pid):
     '''Download the master file datastream associated with a
-    :class:`~genrepo.file.models.FileObject`'''
-    repo = Repository(request=request)
+    :class:`~genrepo.file.models.FileObject`.  Content is streamed from
+    Fedora in fixed-size chunks (see :mod:`genrepo.file.download`).
+
+    Supports HTTP range requests, so that clients can resume
+    downloads and seek within audio and video: a valid ``Range`` header
+    returns 206 Partial Content with only the requested bytes (as
+    ``multipart/byteranges`` if several ranges are requested), or 416
+    if none of the ranges can be satisfied.  If the request has an
+    ``If-Range`` header that does not match the current ETag or
+    Last-Modified date, the full content is returned instead.
+
+    Supports conditional GET: the ETag is the master datastream
+    checksum and Last-Modified is the date of the current version, so
+    an unchanged file is answered with 304 Not Modified after a single
+    datastream profile lookup, without any content being read.
+
+    If ``MASTER_CACHE_DIR`` is configured, the full content is saved to
+    a local :class:`~genrepo.file.download.DatastreamCache` as it is
+    downloaded, and later requests for the same datastream version are
+    served from the cached file.  If ``XSENDFILE`` is also enabled, the
+    response for a cached file only names the file in an
+    ``XSENDFILE_HEADER`` header (e.g., for Apache mod_xsendfile), and
+    the web server sends the content (and handles any range request).
+    '''
+    repo = current_repository(request)
+    obj = repo.get_object(pid, type=FileObject)
+    info, error = _master_info(request, pid)
+    if error is not None:
+        return _download_error(error)
+    try:
+        # only download the master datastream of file objects
+        if not obj.has_requisite_content_models:
+            raise Http404
+    except RequestFailed as rf:
+        return _download_error(rf)
+
+    size = info.size
+    mimetype = info.mimetype or 'application/octet-stream'
+    etag = _master_etag(request, pid)
+    if etag is not None:
+        etag = '"%s"' % etag
+    last_modified = None
+    if info.created:
+        last_modified = http_date(calendar.timegm(info.created.utctimetuple()))
+
+    ranges = None
+    # ranges can only be served if Fedora reports the size of the content
+    if size and 'HTTP_RANGE' in request.META:
+        if_range = request.META.get('HTTP_IF_RANGE', None)
+        if if_range is None or if_range in (etag, last_modified):
+            ranges = parse_range(request.META['HTTP_RANGE'], size)
+            if ranges is not None and len(ranges) > MAX_RANGES:
+                ranges = None
+
+    cache = DatastreamCache()
+    cached = cache.get(obj.pid, obj.master.id, info.version_id, size)
+    if cached is not None and getattr(settings, 'XSENDFILE', False):
+        response = HttpResponse(mimetype=mimetype)
+        response[getattr(settings, 'XSENDFILE_HEADER', 'X-Sendfile')] = cached
+        response['Content-Disposition'] = 'attachment; filename=%s' % pid
+        return response
+
+    if ranges == []:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    if cached is not None:
+        open_range = lambda byte_range=None: LocalFileStream(cached, byte_range)
+    else:
+        open_range = lambda byte_range=None: \
+            DatastreamStream(repo, obj.pid, obj.master.id, byte_range)
+
+    try:
+        if not ranges:
+            content = open_range()
+            if cached is None:
+                content = cache.caching_stream(content, obj.pid, obj.master.id,
+                                               info.version_id, size)
+            response = HttpResponse(content, mimetype=mimetype)
+            if size:
+                response['Content-Length'] = size
+            if info.checksum_type == 'MD5' and info.checksum:
+                response['Content-MD5'] = b64encode(info.checksum.decode('hex'))
+        elif len(ranges) == 1:
+            byte_range = ranges[0]
+            response = HttpResponse(open_range(byte_range), mimetype=mimetype, status=206)
+            response['Content-Range'] = byte_range.content_range(size)
+            response['Content-Length'] = byte_range.length
+        else:
+            boundary = mimetools.choose_boundary()
+            response = HttpResponse(MultipartRangeStream(open_range, ranges, size,
+                                                         mimetype, boundary),
+                                    mimetype='multipart/byteranges; boundary=%s' % boundary,
+                                    status=206)
+    except RequestFailed as rf:
+        return _download_error(rf)
+
+    # ETag and Last-Modified are added by the condition decorator
+    if size:
+        response['Accept-Ranges'] = 'bytes'
     # FIXME: what should the default download filename be?
-    extra_headers = {
-        'Content-Disposition': "attachment; filename=%s" % (pid)
-    } 
-    # use generic raw datastream view from eulcore
-    return raw_datastream(request, pid, FileObject.master.id, type=FileObject,
-                          repo=repo, headers=extra_headers)
+    response['Content-Disposition'] = 'attachment; filename=%s' % pid
+    return response
@@ -0,0 +1,249 @@
+'''Fedora repository access for genrepo.
+
+:class:`Repository` is a drop-in replacement for
+:class:`eulcore.django.fedora.server.Repository` that sends requests
+through persistent (keep-alive) HTTP connections shared by all
+repository instances in the current process, rather than opening new
+connections for every :class:`Repository`.  All genrepo code should
+use this class to access Fedora.
+
+Connections are pooled separately for each Fedora root url and user.
+While a Django request is being processed, the handling thread keeps
+the connection it was given; when the request finishes, the
+connection is returned to the pool for use by the next request.  The
+number of idle connections kept per pool is configured by
+``FEDORA_CONNECTION_POOL_SIZE``; this should normally match the number
+of threads in each mod_wsgi daemon process.
+
+Within a request, :func:`current_repository` should be used to get the
+repository for the current request (created on first use, with the
+credentials of the logged-in user).  It keeps an identity map, so
+every request for the same object returns the same
+:class:`~eulcore.fedora.models.DigitalObject` instance and information
+already retrieved from Fedora is not requested again.  This requires
+:class:`RepositoryMiddleware`.
+'''
+
+from base64 import b64encode
+import httplib
+import logging
+import threading
+from urlparse import urlsplit
+
+from django.conf import settings
+from django.core.signals import request_finished
+
+from eulcore.django.fedora.server import Repository as BaseRepository
+from eulcore.fedora.util import RelativeServerConnection
+
+logger = logging.getLogger(__name__)
+
+
+class PooledServerConnection(RelativeServerConnection):
+    '''Extends :class:`~eulcore.fedora.util.RelativeServerConnection`
+    to take connections from (and return them to) a bounded pool of
+    idle keep-alive connections shared by all threads, instead of
+    opening a new connection per thread.
+
+    :param base_url: base Fedora url
+    :param maxsize: maximum number of idle connections to keep
+    '''
+    def __init__(self, base_url, maxsize=None):
+        super(PooledServerConnection, self).__init__(base_url)
+        if maxsize is None:
+            maxsize = getattr(settings, 'FEDORA_CONNECTION_POOL_SIZE', 10)
+        self.maxsize = maxsize
+        self._idle = []
+        self._lock = threading.Lock()
+        self.stats = {
+            'created': 0,     # new connections opened
+            'reused': 0,      # idle connections handed out again
+            'released': 0,    # connections returned to the pool
+            'discarded': 0,   # connections closed (failed or pool full)
+        }
+
+    def _get_connection(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+            if conn is not None:
+                self.stats['reused'] += 1
+        if conn is None:
+            super(PooledServerConnection, self)._get_connection()
+            with self._lock:
+                self.stats['created'] += 1
+            logger.debug('Opened new Fedora connection for %s; pool stats %s' \
+                         % (self, self.stats))
+        else:
+            self.thread_local.connection = conn
+
+    def _reset_connection(self):
+        # a connection that failed should not go back into the pool
+        super(PooledServerConnection, self)._reset_connection()
+        with self._lock:
+            self.stats['discarded'] += 1
+
+    def release(self):
+        '''Return the connection held by the current thread (if any) to
+        the pool of idle connections, or close it if the pool is full.'''
+        conn = getattr(self.thread_local, 'connection', None)
+        if conn is None:
+            return
+        self.thread_local.connection = None
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                self.stats['released'] += 1
+                return
+            self.stats['discarded'] += 1
+        conn.close()
+
+    def get_stats(self):
+        'Current pool statistics, as a dictionary'
+        with self._lock:
+            stats = self.stats.copy()
+            stats['idle'] = len(self._idle)
+        stats['maxsize'] = self.maxsize
+        return stats
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def connection_pool(base_url, username=None):
+    '''Get the :class:`PooledServerConnection` for the specified
+    Fedora url and user, creating it if necessary.'''
+    key = (base_url, username)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = PooledServerConnection(base_url)
+        return _pools[key]
+
+def pool_stats():
+    '''Statistics for all connection pools in the current process, as
+    a dictionary keyed on (Fedora url, username).  Useful for tuning
+    ``FEDORA_CONNECTION_POOL_SIZE``.'''
+    with _pools_lock:
+        pools = _pools.items()
+    return dict((key, pool.get_stats()) for key, pool in pools)
+
+def release_connections(**kwargs):
+    '''Return any connections held by the current thread to their
+    pools.  Connected to Django's
+    :data:`~django.core.signals.request_finished` signal.'''
+    with _pools_lock:
+        pools = _pools.values()
+    for pool in pools:
+        pool.release()
+
+request_finished.connect(release_connections)
+
+def direct_connection(repo):
+    '''Open a new HTTP connection to Fedora, outside of the connection
+    pool, for a single request that streams large content (e.g., a file
+    upload or download) and may hold the connection for a long time.
+
+    :param repo: :class:`Repository`, used for the Fedora url and
+        credentials
+    :returns: tuple of :class:`httplib.HTTPConnection`, base path of
+        the Fedora url (ending in ``/``), and a dictionary of headers
+        with the repository credentials, if any
+    '''
+    url = urlsplit(repo.opener.base_url)
+    if url.scheme == 'https':
+        connection = httplib.HTTPSConnection(url.netloc)
+    else:
+        connection = httplib.HTTPConnection(url.netloc)
+    path = url.path
+    if not path.endswith('/'):
+        path += '/'
+    headers = {}
+    username = getattr(repo.opener, 'username', None)
+    if username:
+        password = getattr(repo.opener, 'password', None)
+        headers['Authorization'] = 'Basic ' + b64encode('%s:%s' % (username, password))
+    return connection, path, headers
+
+def _clear_current_request(**kwargs):
+    _local.request = None
+request_finished.connect(_clear_current_request)
+
+
+class Repository(BaseRepository):
+    '''Extends :class:`eulcore.django.fedora.server.Repository` to
+    access Fedora through the pooled connection for the configured
+    Fedora url and the current credentials.  Takes the same
+    parameters as the base class, plus:
+
+    :param identity_map: if True, :meth:`get_object` returns the same
+        instance every time an existing object is requested with the
+        same pid and type; intended for repositories that only live as
+        long as a single request (see :func:`current_repository`)
+    '''
+
+    def __init__(self, *args, **kwargs):
+        identity_map = kwargs.pop('identity_map', False)
+        super(Repository, self).__init__(*args, **kwargs)
+        # credentials are sent with each request by the opener, so only the
+        # underlying http connection needs to be replaced
+        self.opener.base = connection_pool(self.opener.base_url, self.fedora_user)
+        self._objects = {} if identity_map else None
+
+    @property
+    def fedora_user(self):
+        'username used to access Fedora (None for guest access)'
+        return getattr(self.opener, 'username', None)
+
+    def get_object(self, pid=None, type=None, create=None):
+        get_opts = {}
+        if type is not None:
+            get_opts['type'] = type
+        if create is not None:
+            get_opts['create'] = create
+        get_object = super(Repository, self).get_object
+
+        # new objects are never shared
+        if self._objects is None or pid is None or callable(pid) or create:
+            return get_object(pid, **get_opts)
+
+        if pid.startswith('info:fedora/'):
+            pid = pid[len('info:fedora/'):]
+        key = (pid, type)
+        if key not in self._objects:
+            self._objects[key] = get_object(pid, **get_opts)
+        return self._objects[key]
+
+
+_local = threading.local()
+
+class RepositoryMiddleware(object):
+    '''Middleware to track the current request, so that
+    :func:`current_repository` can find the repository for it without
+    a request being passed through every function.'''
+
+    def process_request(self, request):
+        _local.request = request
+
+    def process_response(self, request, response):
+        _local.request = None
+        return response
+
+def current_repository(request=None):
+    '''Get the request-scoped :class:`Repository` for a request, which
+    uses the credentials of the logged-in user (if any) and keeps an
+    identity map of the objects retrieved through it.  The repository
+    is created on first use and reused for the rest of the request.
+
+    :param request: :class:`~django.http.HttpRequest`; if not
+        specified, the request currently being processed is used
+    :returns: :class:`Repository`; when called outside of a request,
+        a new repository with default (guest) credentials
+    '''
+    if request is None:
+        request = getattr(_local, 'request', None)
+    if request is None:
+        return Repository()
+    repo = getattr(request, '_genrepo_repository', None)
+    if repo is None:
+        repo = Repository(request=request, identity_map=True)
+        request._genrepo_repository = repo
+    return repo
@@ -0,0 +1,246 @@
+'''Local full-text index of the Dublin Core metadata of files and
+collections, stored in an SQLite database with full-text search (FTS4,
+or FTS3 with older versions of SQLite).
+
+The index is kept current as objects are saved through genrepo (see
+:data:`~genrepo.collection.models.object_saved`), and can be rebuilt
+from Fedora with the ``rebuild_search_index`` management command.
+Searching never contacts Fedora; results only include the pid, type,
+and title of each object, so they must still be checked for access
+before they are displayed (see :func:`genrepo.util.accessible`).
+'''
+
+from collections import namedtuple
+import logging
+import re
+import sqlite3
+import struct
+
+from django.conf import settings
+from django.utils.html import escape
+
+from genrepo.collection.models import DC_FIELDS
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('title', 'creator', 'subject', 'description', 'other')
+'''indexed columns: the most significant Dublin Core fields each have
+their own column, and all other fields are combined'''
+
+COLUMN_WEIGHTS = (10.0, 4.0, 4.0, 2.0, 1.0)
+'relative weight of a match in each of the :data:`COLUMNS` when ranking results'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    id INTEGER PRIMARY KEY,
+    pid TEXT UNIQUE NOT NULL,
+    type TEXT NOT NULL,
+    title TEXT
+);
+CREATE VIRTUAL TABLE dc USING %s (%s);
+'''
+
+# marks around matching terms in snippets, replaced after escaping
+_START_MATCH, _END_MATCH = '\x02', '\x03'
+
+
+class SearchResult(namedtuple('SearchResult', 'pid type title snippet')):
+    '''A single search result: pid, type of object (``file`` or
+    ``collection``), title, and an HTML snippet of matching text, with
+    matching terms in ``<b>`` tags.'''
+    __slots__ = ()
+
+
+def _snippet_html(snippet):
+    # escape metadata text, then mark the matching terms
+    return escape(snippet or '').replace(_START_MATCH, '<b>').replace(_END_MATCH, '</b>')
+
+
+def _rank(matchinfo, *weights):
+    # relevance of a row, from fts matchinfo in the default 'pcx' format:
+    # for each phrase and column, hits in this row, hits in all rows,
+    # and rows with hits; matches on terms that are rare across the
+    # index count for more
+    info = struct.unpack('@%dI' % (len(matchinfo) // 4), str(matchinfo))
+    phrases, columns = info[0], info[1]
+    score = 0.0
+    for phrase in range(phrases):
+        for column in range(columns):
+            offset = 2 + 3 * (phrase * columns + column)
+            hits, total_hits = info[offset], info[offset + 1]
+            if hits:
+                score += weights[column] * float(hits) / total_hits
+    return score
+
+
+_term = re.compile(r'\w+\*?', re.UNICODE)
+
+def match_expression(query):
+    '''Convert a user's search terms into an FTS query that matches
+    all terms, ignoring punctuation and FTS query syntax.  A term
+    ending in ``*`` matches any word starting with the term.
+
+    :returns: FTS match expression, or None if there are no terms
+    '''
+    terms = ['"%s"' % term for term in _term.findall(query)]
+    return ' '.join(terms) or None
+
+
+class SearchIndex(object):
+    '''Full-text index of object metadata.  A new SQLite connection is
+    opened for each operation, so an index may be used from several
+    threads or processes; writes are serialized by SQLite.
+
+    :param path: path to the index database; defaults to the
+        configured ``SEARCH_INDEX_PATH``.  The database is created if it
+        does not exist.
+    '''
+
+    def __init__(self, path=None):
+        if path is None:
+            path = getattr(settings, 'SEARCH_INDEX_PATH', None)
+        self.path = path
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.create_function('rank', len(COLUMNS) + 1, _rank)
+        if not self._exists(connection):
+            self._create(connection)
+        return connection
+
+    def _exists(self, connection):
+        return connection.execute("SELECT name FROM sqlite_master WHERE name = 'dc'").fetchone() \
+               is not None
+
+    def _create(self, connection):
+        # create tables with the best full-text module available
+        for module in ('fts4', 'fts3'):
+            try:
+                connection.executescript(_SCHEMA % (module, ', '.join(COLUMNS)))
+                return
+            except sqlite3.OperationalError as err:
+                if self._exists(connection):
+                    # created by another process in the meantime
+                    return
+                logger.debug('Could not create search index with %s: %s' % (module, err))
+        raise sqlite3.OperationalError('SQLite full-text search is not available')
+
+    def update(self, pid, type, dc):
+        '''Add or update the metadata for an object.
+
+        :param pid: object pid
+        :param type: ``file`` or ``collection``
+        :param dc: :class:`~eulcore.xmlmap.dc.DublinCore`
+        '''
+        self.update_many([(pid, type, dc)])
+
+    def update_many(self, objects):
+        '''Add or update the metadata for several objects at once, in a
+        single transaction.
+
+        :param objects: iterable of ``(pid, type, dc)`` tuples; see
+            :meth:`update`
+        '''
+        connection = self._connect()
+        try:
+            with connection:
+                for pid, type, dc in objects:
+                    self._update(connection, pid, type, dc)
+        finally:
+            connection.close()
+
+    def _update(self, connection, pid, type, dc):
+        values = {}
+        for field in DC_FIELDS:
+            values[field] = [value for value in getattr(dc, '%s_list' % field)
+                             if value and value.strip()]
+        title = values['title'][0] if values['title'] else None
+        text = [' '.join(values[column]) for column in COLUMNS[:-1]]
+        text.append(' '.join(value for field in DC_FIELDS if field not in COLUMNS
+                             for value in values[field]))
+
+        row = connection.execute('SELECT id FROM objects WHERE pid = ?', (pid,)).fetchone()
+        if row is None:
+            cursor = connection.execute('INSERT INTO objects (pid, type, title) VALUES (?, ?, ?)',
+                                        (pid, type, title))
+            rowid = cursor.lastrowid
+        else:
+            rowid = row[0]
+            connection.execute('UPDATE objects SET type = ?, title = ? WHERE id = ?',
+                               (type, title, rowid))
+            connection.execute('DELETE FROM dc WHERE docid = ?', (rowid,))
+        connection.execute('INSERT INTO dc (docid, %s) VALUES (?, %s)' % \
+                           (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                           [rowid] + text)
+
+    def remove(self, pid):
+        'Remove an object from the index.'
+        connection = self._connect()
+        try:
+            with connection:
+                row = connection.execute('SELECT id FROM objects WHERE pid = ?',
+                                         (pid,)).fetchone()
+                if row is not None:
+                    connection.execute('DELETE FROM dc WHERE docid = ?', (row[0],))
+                    connection.execute('DELETE FROM objects WHERE id = ?', (row[0],))
+        finally:
+            connection.close()
+
+    def pids(self):
+        'Set of the pids of all objects in the index.'
+        connection = self._connect()
+        try:
+            return set(row[0] for row in connection.execute('SELECT pid FROM objects'))
+        finally:
+            connection.close()
+
+    def clear(self):
+        'Remove all objects from the index.'
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute('DELETE FROM dc')
+                connection.execute('DELETE FROM objects')
+        finally:
+            connection.close()
+
+    def count(self, query):
+        '''Number of objects matching a search (see :func:`match_expression`).'''
+        match = match_expression(query)
+        if match is None:
+            return 0
+        connection = self._connect()
+        try:
+            return connection.execute('SELECT COUNT(*) FROM dc WHERE dc MATCH ?',
+                                      (match,)).fetchone()[0]
+        finally:
+            connection.close()
+
+    def search(self, query, offset=0, limit=None):
+        '''Search the index (see :func:`match_expression`).
+
+        :param query: search terms
+        :param offset: number of results to skip
+        :param limit: maximum number of results
+        :returns: list of :class:`SearchResult`, most relevant first
+        '''
+        match = match_expression(query)
+        if match is None:
+            return []
+        connection = self._connect()
+        try:
+            rows = connection.execute('''SELECT objects.pid, objects.type, objects.title,
+                    snippet(dc, ?, ?, '...')
+                FROM dc JOIN objects ON objects.id = dc.docid
+                WHERE dc MATCH ?
+                ORDER BY rank(matchinfo(dc), %s) DESC, objects.title
+                LIMIT ? OFFSET ?''' % ', '.join(str(w) for w in COLUMN_WEIGHTS),
+                (_START_MATCH, _END_MATCH, match, limit if limit is not None else -1, offset))
+            return [SearchResult(pid, type, title, _snippet_html(snippet))
+                    for pid, type, title, snippet in rows]
+        finally:
+            connection.close()
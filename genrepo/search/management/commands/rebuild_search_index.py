@@ -0,0 +1,94 @@
+from getpass import getpass
+from itertools import islice
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from eulcore.fedora.rdfns import model as modelns
+
+from genrepo.collection.models import AccessibleObject, CollectionObject, \
+     ObjectInfoList, object_info_query
+from genrepo.file.bulk import pool_imap
+from genrepo.file.models import FileObject
+from genrepo.repository import Repository
+from genrepo.search.index import SearchIndex
+from genrepo.search.models import invalidate_search_results
+
+
+class Command(BaseCommand):
+    '''Add every file and collection in the repository to the search
+    index (see :mod:`genrepo.search.index`), updating any objects
+    already indexed, and remove objects that are no longer in the
+    repository.  The index can be searched while it is rebuilt.'''
+    help = __doc__
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=4,
+            help='Number of objects to retrieve from Fedora at once [%default]'),
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help='Number of objects to add to the index in each transaction [%default]'),
+        make_option('--username', dest='username', default=None,
+            help='Fedora username to read objects as (prompts for password) [FEDORA_USER]'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        index = SearchIndex()
+        if not index.enabled:
+            raise CommandError('No search index is configured (SEARCH_INDEX_PATH)')
+
+        if options['username']:
+            password = getpass('Fedora password for %s: ' % options['username'])
+            repo = Repository(username=options['username'], password=password)
+        else:
+            repo = Repository()
+
+        # files and collections both have the public access content model;
+        # collections are identified by a separate query, since the content
+        # models of an object may be split across pages of the object list
+        collections = set(info.pid for info in object_info_query(repo,
+            '?obj <%s> <%s> .' % (modelns.hasModel, CollectionObject.COLLECTION_CONTENT_MODEL)))
+        objects = ObjectInfoList(repo, '?obj <%s> <%s> .' % \
+                                 (modelns.hasModel, AccessibleObject.PUBLIC_ACCESS_CMODEL))
+        start = time.time()
+        counts = {'indexed': 0, 'failed': 0}
+        seen = set()
+
+        def load(info):
+            if info.pid in collections:
+                type, cls = 'collection', CollectionObject
+            else:
+                type, cls = 'file', FileObject
+            try:
+                return info.pid, type, repo.get_object(info.pid, type=cls).dc.content
+            except Exception as err:
+                if verbosity > 0:
+                    print 'Error: %s: %s' % (info.pid, err)
+                return None
+
+        loaded = pool_imap(load, objects.iterate(), max(options['workers'], 1))
+        while True:
+            batch = list(islice(loaded, options['batch_size']))
+            if not batch:
+                break
+            indexed = [obj for obj in batch if obj is not None]
+            index.update_many(indexed)
+            seen.update(pid for pid, type, dc in indexed)
+            counts['indexed'] += len(indexed)
+            counts['failed'] += len(batch) - len(indexed)
+            if verbosity > 1:
+                print 'Indexed %d object(s)' % counts['indexed']
+
+        # only remove objects if the whole repository could be read, so
+        # that a failure doesn't empty the index
+        removed = 0
+        if not counts['failed']:
+            for pid in index.pids() - seen:
+                index.remove(pid)
+                removed += 1
+        invalidate_search_results()
+
+        if verbosity > 0:
+            print 'Indexed %d object(s) in %.1f seconds; removed %d; %d could not be read' % \
+                  (counts['indexed'], time.time() - start, removed, counts['failed'])
@@ -0,0 +1,44 @@
+import logging
+import time
+
+from django.core.cache import cache
+
+from genrepo.collection.models import CollectionObject, object_saved
+from genrepo.file.models import FileObject
+from genrepo.search.index import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+# the search app has no database models; the search index is updated
+# here whenever a file or collection is saved through genrepo
+
+OBJECT_TYPES = {
+    FileObject: 'file',
+    CollectionObject: 'collection',
+}
+'object classes included in the search index, with the type of result for each'
+
+# changed whenever cached search results should be discarded
+SEARCH_GENERATION_KEY = 'genrepo-search-generation'
+
+
+def invalidate_search_results():
+    '''Discard cached search results for all users (see
+    :func:`genrepo.search.views.search`), e.g. because the search index
+    has changed.'''
+    cache.set(SEARCH_GENERATION_KEY, '%f' % time.time())
+
+
+def _update_search_index(sender, obj, **kwargs):
+    # a search index failure should never cause a save to fail
+    index = SearchIndex()
+    if not index.enabled:
+        return
+    try:
+        index.update(obj.pid, OBJECT_TYPES[sender], obj.dc.content)
+    except Exception:
+        logger.exception('Could not update search index for %s' % obj.pid)
+    invalidate_search_results()
+
+for _cls in OBJECT_TYPES:
+    object_saved.connect(_update_search_index, sender=_cls)
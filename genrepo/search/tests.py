@@ -0,0 +1,142 @@
+from mock import patch, Mock
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.test import Client, TestCase
+
+from eulcore.xmlmap.dc import DublinCore
+
+from genrepo.collection.models import CollectionObject, object_saved
+from genrepo.file.models import FileObject
+from genrepo.search.index import SearchIndex, match_expression
+from genrepo.search.models import invalidate_search_results
+
+
+def dublin_core(**values):
+    dc = DublinCore()
+    for field, field_values in values.iteritems():
+        getattr(dc, '%s_list' % field).extend(field_values)
+    return dc
+
+
+class SearchIndexTest(TestCase):
+    'Tests for :class:`genrepo.search.index.SearchIndex`'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='genrepo-search-')
+        self.index = SearchIndex(os.path.join(self.tmpdir, 'search.db'))
+        self.index.update_many([
+            ('file:1', 'file', dublin_core(title=['Red Fish'], subject=['fish'])),
+            ('file:2', 'file', dublin_core(title=['Blue Whale'],
+                                           description=['not a <fish>, a mammal'])),
+            ('coll:1', 'collection', dublin_core(title=['Ocean Things'],
+                                                 rights=['fish & whales'])),
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_match_expression(self):
+        self.assertEqual('"red" "fish"', match_expression('red fish'))
+        self.assertEqual('"fi*"', match_expression('fi*'))
+        self.assertEqual('"fish" "OR" "NEAR"', match_expression('fish OR "NEAR'),
+            'search terms should not be interpreted as fts query syntax')
+        self.assertEqual(None, match_expression(' -- '))
+
+    def test_search(self):
+        results = self.index.search('fish')
+        self.assertEqual(3, self.index.count('fish'))
+        self.assertEqual('file:1', results[0].pid,
+            'object with search term in the title should be ranked first')
+        self.assertEqual(('file', 'Red Fish'), (results[0].type, results[0].title))
+        self.assertEqual('coll:1', results[2].pid,
+            'object with search term only in minor fields should be ranked last')
+        self.assertEqual('collection', results[2].type)
+        self.assert_('not a &lt;<b>fish</b>&gt;' in results[1].snippet,
+            'snippet should be escaped, with search terms marked')
+
+        self.assertEqual(['file:2'], [r.pid for r in self.index.search('whale mammal')])
+        self.assertEqual(['file:2', 'coll:1'], [r.pid for r in self.index.search('wha*')])
+        self.assertEqual(['file:2'], [r.pid for r in self.index.search('fish', offset=1, limit=1)])
+        self.assertEqual([], self.index.search('!!'))
+
+    def test_update_remove(self):
+        self.index.update('file:1', 'file', dublin_core(title=['Red Snapper']))
+        self.assertEqual(['file:1'], [r.pid for r in self.index.search('snapper')])
+        self.assertEqual(2, self.index.count('fish'),
+            'previous metadata should be removed from the index when updated')
+        self.index.remove('file:1')
+        self.assertEqual(0, self.index.count('snapper'))
+        self.assertEqual(set(['file:2', 'coll:1']), self.index.pids())
+
+    def test_object_saved(self):
+        obj = Mock(name='MockFileObject')
+        obj.pid = 'file:3'
+        obj.dc.content = dublin_core(title=['Green Eggs'])
+        with patch.object(settings, 'SEARCH_INDEX_PATH', new=self.index.path):
+            object_saved.send(sender=FileObject, obj=obj)
+        self.assertEqual(['file:3'], [r.pid for r in self.index.search('eggs')],
+            'saved objects should be added to the search index')
+
+
+class SearchViewsTest(TestCase):
+    'Tests for :mod:`genrepo.search.views`'
+
+    def setUp(self):
+        self.client = Client()
+        self.tmpdir = tempfile.mkdtemp(prefix='genrepo-search-')
+        self.index = SearchIndex(os.path.join(self.tmpdir, 'search.db'))
+        self.index.update_many(('file:%d' % i, 'file', dublin_core(title=['Fish %d' % i]))
+                               for i in range(30))
+        self.index.update('coll:1', 'collection', dublin_core(title=['Fish Collection']))
+        self.settings_patch = patch.object(settings, 'SEARCH_INDEX_PATH', new=self.index.path)
+        self.settings_patch.start()
+        invalidate_search_results()
+
+    def tearDown(self):
+        self.settings_patch.stop()
+        shutil.rmtree(self.tmpdir)
+
+    @patch('genrepo.search.views.accessible')
+    def test_search(self, mockaccessible):
+        # every result is accessible except file:0
+        mockaccessible.side_effect = lambda results: [r for r in results if r.pid != 'file:0']
+        search_url = reverse('search:search')
+
+        response = self.client.get(search_url)
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(mockaccessible.called, 'no search should be run without search terms')
+
+        with patch.object(settings, 'SEARCH_RESULTS_PER_PAGE', new=20):
+            response = self.client.get(search_url, {'q': 'fish'})
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(30, response.context['page'].paginator.count,
+                'inaccessible results should not be counted')
+            self.assertEqual(1, mockaccessible.call_count,
+                'access should be checked once for all results')
+            self.assertEqual(20, len(response.context['results']))
+            self.assertContains(response, reverse('collection:view', args=['coll:1']))
+            self.assertNotContains(response, reverse('file:view', args=['file:0']),
+                msg_prefix='inaccessible results should not be displayed')
+
+            response = self.client.get(search_url, {'q': 'fish', 'page': 2})
+            self.assertEqual(10, len(response.context['results']))
+            self.assertEqual(1, mockaccessible.call_count,
+                'accessible results should be cached for other pages of the same search')
+            self.assert_(all(result.snippet for result in response.context['results']),
+                'search results should be displayed as returned by the index')
+
+            with patch.object(settings, 'SEARCH_MAX_RESULTS', new=10):
+                response = self.client.get(search_url, {'q': 'fish'})
+                self.assertEqual(9, response.context['page'].paginator.count)
+                self.assert_(response.context['truncated'])
+
+        response = self.client.get(search_url, {'q': 'nothing'})
+        self.assertContains(response, 'No results found')
+
+        with patch.object(settings, 'SEARCH_INDEX_PATH', new=None):
+            response = self.client.get(search_url, {'q': 'fish'})
+            self.assertEqual(404, response.status_code)
@@ -0,0 +1,6 @@
+from django.conf.urls.defaults import patterns, url
+
+
+urlpatterns = patterns('genrepo.search.views',
+    url(r'^$', 'search', name='search'),
+)
@@ -0,0 +1,67 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.http import Http404
+
+from genrepo.repository import current_repository
+from genrepo.search.index import SearchIndex
+from genrepo.search.models import SEARCH_GENERATION_KEY
+from genrepo.util import render_to_response, accessible
+
+SEARCH_CACHE_KEY = 'genrepo-search'
+
+def _search_cache_key(query, max_results):
+    # accessible results depend on the fedora credentials in use, so
+    # results are cached separately for each user
+    generation = cache.get(SEARCH_GENERATION_KEY, 0)
+    return '%s-%s-%s-%d-%s' % (SEARCH_CACHE_KEY, generation,
+                               hashlib.md5(query.encode('utf-8')).hexdigest(), max_results,
+                               current_repository().fedora_user or '')
+
+def _accessible_results(index, query):
+    # the most relevant accessible results for a search, and whether
+    # there may be more; cached briefly, so that paging through the
+    # results doesn't check them all for access again
+    max_results = getattr(settings, 'SEARCH_MAX_RESULTS', 500)
+    cache_key = _search_cache_key(query, max_results)
+    cached = cache.get(cache_key)
+    if cached is None:
+        matches = index.search(query, limit=max_results)
+        cached = (list(accessible(matches)), len(matches) == max_results)
+        cache.set(cache_key, cached, getattr(settings, 'SEARCH_CACHE_TIMEOUT', 300))
+    return cached
+
+
+def search(request):
+    '''Search the Dublin Core metadata of files and collections, with
+    the search terms in the ``q`` url parameter.  Results are ranked by
+    relevance and paginated (``page`` url parameter).
+
+    Searches use the local search index (see
+    :mod:`genrepo.search.index`).  Up to ``SEARCH_MAX_RESULTS`` of the
+    most relevant results are checked for access before they are
+    paginated, so results the current user can't access are neither
+    displayed nor counted.  The accessible results are cached for each
+    user for ``SEARCH_CACHE_TIMEOUT`` seconds (or until an object is
+    saved), so only the first page of a search checks access.
+    '''
+    index = SearchIndex()
+    if not index.enabled:
+        raise Http404
+
+    query = request.GET.get('q', '').strip()
+    context = {'query': query}
+    if query:
+        results, truncated = _accessible_results(index, query)
+        paginator = Paginator(results, getattr(settings, 'SEARCH_RESULTS_PER_PAGE', 20))
+        try:
+            page = paginator.page(request.GET.get('page', 1))
+        except PageNotAnInteger:
+            page = paginator.page(1)
+        except EmptyPage:
+            page = paginator.page(paginator.num_pages)
+        context.update({'page': page, 'results': page.object_list,
+                        'truncated': truncated})
+    return render_to_response('search/search.html', context, request=request)
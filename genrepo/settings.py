@@ -49,6 +49,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'genrepo.repository.RepositoryMiddleware',
 )
 
 ROOT_URLCONF = 'genrepo.urls'
@@ -77,6 +78,7 @@ INSTALLED_APPS = (
     'genrepo.accounts',
     'genrepo.collection',
     'genrepo.file',
+    'genrepo.search',
 )
 
 
@@ -87,6 +89,8 @@ AUTHENTICATION_BACKENDS = (
 
 FILE_UPLOAD_HANDLERS = (
     # removing default MemoryFileUploadHandler so all uploaded files can be treated the same
+    # NOTE: file ingest adds genrepo.file.upload.FedoraUploadHandler ahead of this,
+    # so ingested files only use a temporary file if they can't be sent to Fedora
     'django.core.files.uploadhandler.TemporaryFileUploadHandler',
 )
 
@@ -96,6 +100,80 @@ SESSION_COOKIE_AGE = 604800   # 1 week (Django default is 2 weeks)
 SESSION_COOKIE_SECURE = True  # mark cookie as secure, only transfer via HTTPS
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 
+# maximum number of idle keep-alive connections to Fedora kept per process
+# (see genrepo.repository); should match the number of mod_wsgi threads
+FEDORA_CONNECTION_POOL_SIZE = 10
+
+# collection index cache (see genrepo.collection.models.CollectionObject.index)
+COLLECTION_INDEX_TIMEOUT = 300          # seconds the cached index is considered current
+COLLECTION_INDEX_STALE_TIMEOUT = 3600   # seconds a stale index may be served while it is
+                                        # refreshed in the background; 0 to always wait for Fedora
+
+# object profile and Dublin Core cache (see genrepo.collection.models.CachedDigitalObject)
+OBJECT_CACHE_TIMEOUT = 60               # seconds cached information is used without checking
+                                        # the object last modification date in Fedora
+OBJECT_CACHE_MAX_AGE = 86400            # seconds cached information is kept for validation
+
+# checksum type passed to Fedora for verification of ingested files
+# (MD5, SHA-1, or SHA-256; see genrepo.file.models.FileObject.record_checksums)
+FILE_CHECKSUM_TYPE = 'MD5'
+
+# background ingest (see genrepo.file.jobs); requires running process_ingest_jobs workers
+INGEST_IN_BACKGROUND = False
+INGEST_JOB_DIR = '/tmp/genrepo-ingest'  # uploaded files waiting to be ingested
+INGEST_JOB_TIMEOUT = 6 * 60 * 60   # seconds a job may run before it is marked as failed
+
+# resumable uploads (see genrepo.file.views.start_upload); partial uploads are stored in INGEST_JOB_DIR
+UPLOAD_CHUNK_MAX_SIZE = 16 * 1024 * 1024   # largest chunk accepted in a single request, in bytes
+UPLOAD_SESSION_TIMEOUT = 7 * 24 * 60 * 60  # seconds an unfinished upload is kept without new data
+
+# when a file is ingested with the same content as an existing object, add the
+# existing object to the collection instead of storing the content again (the
+# user is warned, and no new object is created)
+DEDUPLICATE_INGEST = False
+
+# local disk cache of downloaded master files (see genrepo.file.download); set
+# MASTER_CACHE_DIR to a directory writable by the web server to enable
+MASTER_CACHE_DIR = None
+MASTER_CACHE_MAX_SIZE = 10 * 1024 ** 3  # least recently used files are removed beyond this size
+# let the web server send cached files (requires mod_xsendfile; see apache/genrepo.conf)
+XSENDFILE = False
+XSENDFILE_HEADER = 'X-Sendfile'   # header naming the cached file's full filesystem path
+
+# bulk ingest (see genrepo.file.bulk)
+BULK_INGEST_WORKERS = 4                 # number of files ingested at once
+BULK_INGEST_ROOT = None                 # server directory containing directories that may be
+                                        # bulk ingested; None to only allow uploaded archives
+
+# number of objects saved at once by batch metadata edits and imports (see genrepo.file.batch)
+BATCH_EDIT_WORKERS = 4
+
+# seconds to cache collection choices for the file ingest form
+COLLECTION_OPTIONS_TIMEOUT = 60
+
+# maximum number of objects checked per Resource Index query in genrepo.util.accessible
+ACCESSIBLE_BATCH_SIZE = 50
+
+# collection member browsing (see genrepo.collection.views.view_collection)
+COLLECTION_MEMBERS_PER_PAGE = 50        # default number of members per page
+COLLECTION_MEMBERS_MAX_PER_PAGE = 500   # maximum number of members per page a user may request
+COLLECTION_MEMBERS_MAX_AGE = 300        # seconds a member list may be cached by clients, unless changed through genrepo
+
+# zip download of whole collections (see genrepo.collection.archive)
+COLLECTION_DOWNLOAD_PREFETCH = 3        # number of member files read ahead in background threads
+COLLECTION_DOWNLOAD_COMPRESS = False    # deflate member files (costs cpu; masters are often compressed)
+
+# number of member objects read at once by collection metadata exports (see genrepo.collection.export)
+METADATA_EXPORT_WORKERS = 4
+
+# local full-text index of file and collection metadata (see genrepo.search.index);
+# must be writable by the web server; None disables search (set in localsettings)
+SEARCH_INDEX_PATH = None
+SEARCH_RESULTS_PER_PAGE = 20
+# maximum number of results per search, checked for access before display
+SEARCH_MAX_RESULTS = 500
+SEARCH_CACHE_TIMEOUT = 300              # seconds accessible results are kept for paging
+
 # using default django login url
 LOGIN_URL = SITE_URL_PREFIX + '/accounts/login/'
 
@@ -17,6 +17,8 @@ urlpatterns = patterns('',
     url(r'^collections/', include('genrepo.collection.urls', namespace='collection')),
     # files
     url(r'^files/', include('genrepo.file.urls', namespace='file')),
+    # search
+    url(r'^search/', include('genrepo.search.urls', namespace='search')),
 
     # enable django db-admin
     (r'^db-admin/', include(admin.site.urls)),
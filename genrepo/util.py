@@ -1,19 +1,100 @@
+from datetime import datetime
+import hashlib
+import logging
+import time
+
+from django.conf import settings
 import django.shortcuts
 from django.template import RequestContext
+from eulcore.fedora.rdfns import model as modelns
 from eulcore.fedora.util import RequestFailed
 
+from genrepo.collection.models import AccessibleObject
+from genrepo.repository import current_repository
+
+logger = logging.getLogger(__name__)
+
 def render_to_response(*args, **kwargs):
     if 'request' in kwargs:
         kwargs['context_instance'] = RequestContext(kwargs.pop('request'))
     return django.shortcuts.render_to_response(*args, **kwargs)
 
 
+def page_etag(request, *values):
+    '''ETag for a page that displays information identified by the
+    specified values (e.g., object modification dates).  The current
+    user is included, since pages display user-specific content (e.g.,
+    links to edit).'''
+    values = values + (request.user.username,)
+    return hashlib.md5(u'|'.join(unicode(v) for v in values).encode('utf-8')).hexdigest()
+
+def page_last_modified(request, *dates):
+    '''Last-Modified date (UTC) for a page that displays information
+    modified on the specified dates: the latest of those dates and the
+    time the current user last logged in, since pages display
+    user-specific content.  Returns None if no dates are available.'''
+    dates = [d for d in dates if d is not None]
+    if not dates:
+        return None
+    user = request.user
+    if user.is_authenticated() and user.last_login:
+        # last login is stored in local time
+        dates.append(datetime.utcfromtimestamp(time.mktime(user.last_login.timetuple())))
+    return max(dates)
+
+
 def accessible(olist):
     '''Iterate through an input object list, and yield only those that exist
-    and don't throw Fedora exceptions.'''
+    and don't throw Fedora exceptions.
+
+    Objects may be :class:`~eulcore.fedora.models.DigitalObject`
+    instances or anything else with a ``pid``, such as
+    :class:`~genrepo.collection.models.ObjectInfo`; accessible objects
+    are yielded as they were passed in.  Objects that the
+    Resource Index reports as active and publicly accessible are
+    resolved in bulk, with one query for every ``ACCESSIBLE_BATCH_SIZE``
+    objects; only the remaining objects, whose access may depend on
+    Fedora credentials, are checked one at a time (with the
+    credentials of the :func:`~genrepo.repository.current_repository`).'''
+    olist = list(olist)
+    batch_size = getattr(settings, 'ACCESSIBLE_BATCH_SIZE', 50)
+    repo = current_repository()
+    public = set()
+    for i in range(0, len(olist), batch_size):
+        public.update(_public_pids(repo, [obj.pid for obj in olist[i:i+batch_size]]))
+
     for obj in olist:
+        if obj.pid in public:
+            yield obj
+            continue
+        # status is ambiguous; fall back to checking the object itself
         try:
-            if obj.exists:
+            fetched = obj if hasattr(obj, 'exists') else repo.get_object(obj.pid)
+            if fetched.exists:
                 yield obj
         except RequestFailed:
             pass
+
+def _public_pids(repo, pids):
+    # query the Resource Index for the subset of pids that are active
+    # and have the content model used to grant public access in Fedora
+    if not pids:
+        return []
+    query = '''SELECT ?obj
+    WHERE {
+        ?obj <%(hasmodel)s> <%(public)s> .
+        ?obj <%(state)s> <%(active)s> .
+        FILTER (%(pids)s)
+    }''' % {
+        'hasmodel': modelns.hasModel, 'public': AccessibleObject.PUBLIC_ACCESS_CMODEL,
+        'state': 'info:fedora/fedora-system:def/model#state',
+        'active': 'info:fedora/fedora-system:def/model#Active',
+        'pids': ' || '.join('?obj = <info:fedora/%s>' % pid for pid in pids),
+    }
+    try:
+        return [row['obj'][len('info:fedora/'):] for row in repo.risearch.sparql_query(query)]
+    except RequestFailed:
+        # if the query fails, every object will be checked individually
+        logger.warning('Resource Index query for accessible objects failed; checking %d objects individually' \
+                       % len(pids))
+        return []